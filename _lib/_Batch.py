@@ -0,0 +1,868 @@
+import os, sys, json, zlib, time, queue, threading, logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
+from _Utility import get_sfrm_name, convert_frame_to_mask, get_mask_name, verify_frame, write_bruker_buffers, read_pilatus_cbf, clear_run_caches
+from _Sites import FRAME_EXTS, get_site
+from _Index import scan_directory
+from _FramePool import FramePool, attach_slot
+from _Stack import RunStacks, export_stack, parse_frames
+from _Profile import enable_profiling, disable_profiling, drain_events,\
+                     summarize_events, print_summary, write_trace, profile_stage
+
+log = logging.getLogger('pilatus3-fc.batch')
+
+# conversion manifest, stored in the output directory
+MANIFEST_NAME = '.pilatus3-fc_manifest.jsonl'
+# beamstop geometry, stored in the output directory
+MASK_GEOMETRY_NAME = 'beamstop_masks.json'
+
+def get_frame_format(site):
+    '''
+     how to read the frames of a facility (see _Sites.py)
+     returns: reader, (rows, cols, offset), rotate
+     or None if the facility is unknown
+    '''
+    plugin = get_site(site)
+    if plugin is None:
+        return None
+    return plugin.reader, (plugin.rows, plugin.cols, plugin.offset), plugin.rotate
+
+def find_frames(path_input, exts=FRAME_EXTS):
+    '''
+     return all frames in path_input that match
+     any of the extensions in exts, sorted by name
+    '''
+    return list(scan_directory(path_input, exts).frames)
+
+def get_conversion(site, fPath, path_input, path_output, overwrite=True):
+    '''
+     the conversion of a facility (see _Sites.py)
+      - conversion: what _Utility.py function to call
+      - parameters: parameters for the conversion function
+         - path_output, overwrite_flag
+         - more if needed, e.g. SP8 2-th correction value
+      - fPath: first frame of the dataset (SP8 timestamp)
+     returns None if the facility is unknown
+    '''
+    plugin = get_site(site)
+    if plugin is None:
+        return None
+    kwargs = plugin.options(fPath, path_input)
+    kwargs['overwrite'] = overwrite
+    return plugin.converter, [path_output], kwargs
+
+def file_checksum(fname, blocksize=2**20):
+    '''
+     crc32 of a file as 8 digit hex string
+    '''
+    crc = 0
+    with open(fname, 'rb') as ofile:
+        for block in iter(lambda: ofile.read(blocksize), b''):
+            crc = zlib.crc32(block, crc)
+    return '{:08x}'.format(crc)
+
+def frame_record(fname, path_output):
+    '''
+     manifest record of a converted frame
+      - source: path, size and mtime of the frame
+      - output: path, size and checksum of the .sfrm
+    '''
+    src = os.stat(fname)
+    outName = get_sfrm_name(fname, path_output)
+    return {'source':fname,
+            'size':src.st_size,
+            'mtime':src.st_mtime_ns,
+            'output':outName,
+            'output_size':os.path.getsize(outName),
+            'checksum':file_checksum(outName)}
+
+def buffers_record(fname, src, outName, buffers):
+    '''
+     manifest record of a frame written by the pipeline
+      - src: os.stat_result of the frame when it was read
+      - size and checksum from the written buffers, the
+        .sfrm is not read back
+    '''
+    crc = 0
+    size = 0
+    for buffer in buffers:
+        with memoryview(buffer) as view:
+            crc = zlib.crc32(view, crc)
+            size += view.nbytes
+    return {'source':fname,
+            'size':src.st_size,
+            'mtime':src.st_mtime_ns,
+            'output':outName,
+            'output_size':size,
+            'checksum':'{:08x}'.format(crc)}
+
+class ConversionManifest():
+    '''
+     append-only record of the converted frames (JSON lines)
+      - one record per frame, the last record of a frame wins
+      - a torn last line of a killed job is ignored on load
+      - a frame is complete if size/mtime of the source and the
+        size of the output still match its record
+      - close() rewrites the manifest (temp file + os.replace)
+        to drop stale and duplicate records
+    '''
+    def __init__(self, path_output):
+        self.path_output = path_output
+        self.fname = os.path.join(path_output, MANIFEST_NAME)
+        self.records = {}
+        self.ofile = None
+        self.load()
+    
+    def load(self):
+        if not os.path.exists(self.fname):
+            return
+        with open(self.fname) as ofile:
+            for line in ofile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.records[record['source']] = record
+    
+    def is_complete(self, fname, out_sizes):
+        '''
+         out_sizes: {output name: size} of the output directory
+        '''
+        record = self.records.get(fname)
+        if record is None:
+            return False
+        try:
+            src = os.stat(fname)
+        except OSError:
+            return False
+        return (src.st_size == record['size'] and
+                src.st_mtime_ns == record['mtime'] and
+                out_sizes.get(record['output']) == record['output_size'])
+    
+    def pending(self, fList):
+        '''
+         return the frames of fList that need to be (re)converted
+          - the output directory is scanned once instead of
+            calling stat for every single output file
+        '''
+        out_sizes = {}
+        if os.path.isdir(self.path_output):
+            with os.scandir(self.path_output) as it:
+                for entry in it:
+                    if entry.name.endswith('.sfrm') and entry.is_file():
+                        out_sizes[entry.path] = entry.stat().st_size
+        return [fname for fname in fList if not self.is_complete(fname, out_sizes)]
+    
+    def add(self, record, flush=True):
+        '''
+         flush: False, the record is written with the next flush()
+        '''
+        self.records[record['source']] = record
+        if self.ofile is None:
+            self.ofile = open(self.fname, 'a')
+        self.ofile.write(json.dumps(record) + '\n')
+        if flush:
+            self.ofile.flush()
+    
+    def flush(self):
+        if self.ofile is not None:
+            self.ofile.flush()
+    
+    def close(self):
+        if self.ofile is not None:
+            self.ofile.close()
+            self.ofile = None
+        tmpName = '{}.{}.part'.format(self.fname, os.getpid())
+        with open(tmpName, 'w') as ofile:
+            for record in self.records.values():
+                ofile.write(json.dumps(record) + '\n')
+        os.replace(tmpName, self.fname)
+
+def get_verify_format(site):
+    '''
+     keyword arguments of verify_frame for a facility
+     or None if the facility is unknown
+    '''
+    frame_format = get_frame_format(site)
+    if frame_format is None:
+        return None
+    reader, (rows, cols, offset), rotate = frame_format
+    return {'reader':reader, 'rows':rows, 'cols':cols, 'offset':offset, 'rotate':rotate}
+
+def convert_chunk(conversion, fnames, args, kwargs, record=False, verify=None):
+    '''
+     convert a list of frames in a single worker process
+     returns a list of (result, manifest record) tuples
+      - result: the conversion result (True/False)
+      - the record is None if the conversion failed or
+        no record was requested
+      - verify: verify_frame keyword arguments, a written frame
+        is compared with its source while it is still cached,
+        a mismatch counts as failed conversion
+     a broken frame must not take the whole chunk down
+    '''
+    results = []
+    for fname in fnames:
+        try:
+            result = conversion(fname, *args, **kwargs)
+            if result and verify is not None:
+                mismatch = verify_frame(fname, args[0], **verify)
+                if mismatch:
+                    print('ERROR: Verification failed for {}: {}'.format(fname, '; '.join(mismatch)))
+                    result = False
+            if result and record:
+                results.append((result, frame_record(fname, args[0])))
+            else:
+                results.append((result, None))
+        except Exception as e:
+            print('ERROR: Conversion failed for {}: {}'.format(fname, e))
+            log.debug('conversion failed frame=%s', fname, exc_info=True)
+            results.append((False, None))
+    return results
+
+def profile_chunk(*args):
+    '''
+     convert_chunk with profiling enabled in the worker
+     returns the results and the profiling events of the chunk
+    '''
+    enable_profiling()
+    try:
+        return convert_chunk(*args), drain_events()
+    finally:
+        disable_profiling()
+
+def convert_batch(conversion, fList, args, kwargs, workers=None, chunksize=16, callback=None, record=False, verify=None, events=None):
+    '''
+     convert all frames in fList using a pool of worker processes
+      - each process runs its own interpreter, the regex header
+        parsing and formatting no longer compete for the GIL
+      - frames are submitted in chunks of 'chunksize' frames
+        to keep the per-task (pickling) overhead low
+      - at most 2 * workers chunks are in flight at any time,
+        results are collected as soon as a chunk finishes
+      - callback(fname, result, record) is called for every frame,
+        record is the manifest record if requested (see convert_chunk)
+      - verify: verify every frame after its conversion (see convert_chunk)
+      - events: list the profiling events of the workers are
+        appended to (see _Profile), profiling is off if None
+     returns a dict: {fname: result}
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = [fList[i:i + chunksize] for i in range(0, len(fList), chunksize)]
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=clear_run_caches) as pool:
+        pending = {}
+        submitted = {}
+        while chunks or pending:
+            # keep the pool busy, but don't queue everything at once
+            while chunks and len(pending) < 2 * workers:
+                chunk = chunks.pop(0)
+                if events is None:
+                    future = pool.submit(convert_chunk, conversion, chunk, args, kwargs, record, verify)
+                else:
+                    future = pool.submit(profile_chunk, conversion, chunk, args, kwargs, record, verify)
+                pending[future] = chunk
+                submitted[future] = time.perf_counter()
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                # time from submit to result, includes the queueing
+                log.debug('chunk done first=%s frames=%d pending=%d duration_ms=%.1f', os.path.basename(chunk[0]),
+                          len(chunk), len(pending), (time.perf_counter() - submitted.pop(future)) * 1e3)
+                if events is None:
+                    chunk_results = future.result()
+                else:
+                    chunk_results, chunk_events = future.result()
+                    events.extend(chunk_events)
+                for fname, (result, frame_rec) in zip(chunk, chunk_results):
+                    results[fname] = result
+                    if callback is not None:
+                        callback(fname, result, frame_rec)
+    return results
+
+@profile_stage('fetch', lambda result, args, kwargs: result[0] if type(result[0]) == int else len(result[0]))
+def fetch_frame(fname, frame_pool=None, index=None):
+    '''
+     I/O stage of the pipeline: the raw bytes of a frame
+      - frame_pool: the frame is read into the slot 'index'
+        of the FramePool, unless it does not fit
+     returns the bytes (the number of bytes if read into the
+     slot) and the os.stat_result of the frame
+    '''
+    if frame_pool is not None:
+        nbytes, src = frame_pool.read_into(fname, index)
+        if nbytes is not None:
+            return nbytes, src
+    with open(fname, 'rb') as ofile:
+        src = os.fstat(ofile.fileno())
+        return ofile.read(), src
+
+def transform_frame(conversion, fname, stream, args, kwargs, profile=False):
+    '''
+     CPU stage of the pipeline: decode, preprocess, render
+     the header and build the tables of a frame from its raw
+     bytes, the conversion is called with encode=True
+     returns the buffers of the .sfrm (False: not converted)
+     and the profiling events of the frame
+    '''
+    if not profile:
+        return conversion(fname, *args, stream=stream, encode=True, **kwargs), []
+    enable_profiling()
+    try:
+        return conversion(fname, *args, stream=stream, encode=True, **kwargs), drain_events()
+    finally:
+        disable_profiling()
+
+def transform_slot(conversion, fname, spec, index, nbytes, args, kwargs, profile=False):
+    '''
+     transform_frame on a FramePool slot (shared memory)
+      - the frame is read from the raw region of the slot,
+        decoded and preprocessed in place and the image is
+        cast back into the raw region (see FrameSlot)
+     returns the buffers, the image replaced by its size
+    (stack: the header, the frame stays in the slot)
+    '''
+    slot = attach_slot(spec, index)
+    buffers, frame_events = transform_frame(conversion, fname, slot.raw[:nbytes], args, dict(kwargs, slot=slot), profile)
+    if buffers:
+        buffers = list(buffers)
+        buffers[1] = None if kwargs.get('stack') else buffers[1].nbytes
+    return buffers, frame_events
+
+def convert_pipeline(conversion, fList, args, kwargs, workers=None, io_threads=4, inflight=None, batch=16,
+                     callback=None, flush=None, record=False, verify=None, events=None, frame_format=None, stacks=None):
+    '''
+     convert all frames in fList in three overlapping stages
+      - read: a pool of 'io_threads' threads fetches the raw
+        bytes of the frames (fetch_frame), the disk/network
+        is busy while the workers compute
+      - transform: a pool of 'workers' processes decodes,
+        preprocesses and encodes the frames (transform_frame)
+      - write: a single writer thread drains up to 'batch'
+        encoded frames at a time and writes them, flush()
+        is called once per batch (e.g. the manifest)
+      - at most 'inflight' frames (default: 4 * workers) are
+        between fetched and written, this bounds the memory
+      - frame_format: (reader, (rows, cols, offset), rotate)
+        as from get_frame_format, the frames are passed in
+        shared memory (see FramePool, transform_slot) instead
+        of being pickled, one slot per inflight frame
+      - stacks: RunStacks, the frames are written to one HDF5
+        stack per run instead of .sfrm files (see _Stack.py),
+        the workers return the header and the preprocessed
+        frame (stack=True), no records, no verification
+      - conversion: convert_frame_* accepting stream/encode/slot/stack,
+        args[0] is the output directory
+      - callback(fname, result, record), record, verify and
+        events as for convert_batch, the records are built
+        from the written buffers (see buffers_record) and the
+        verification runs in the worker processes
+      - if the worker processes fail (e.g. a worker was
+        killed), no new frames are queued, the frames in
+        flight and those not queued fail
+      - every frame finishes exactly once, an exception in a
+        stage (or in the callback) fails the frame and
+        returns its ticket
+     returns a dict: {fname: result}
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if inflight is None:
+        inflight = 4 * workers
+    path_output = args[0]
+    profile = events is not None
+    # a frame finishes once
+    fList = list(dict.fromkeys(fList))
+    if stacks is not None:
+        kwargs = dict(kwargs, stack=True)
+    # a ticket is taken before a frame is fetched and
+    # returned once its result is known
+    tickets = threading.BoundedSemaphore(inflight)
+    encoded = queue.Queue()
+    lock = threading.Lock()
+    results = {}
+    # fatal errors of the pipeline, stop queueing frames
+    fatal = []
+    frame_pool = None
+    if frame_format is not None:
+        reader, (rows, cols, offset), rotate = frame_format
+        # compressed frames are decoded into a region of their own
+        frame_pool = FramePool(inflight, rows, cols, offset, rotate, decode=reader is read_pilatus_cbf)
+
+    # the FramePool slot of a frame: {fname: index}
+    slots = {}
+
+    def free(fname):
+        with lock:
+            index = slots.pop(fname, None)
+        if index is not None:
+            frame_pool.release(index)
+
+    def finish(fname, result, frame_rec=None):
+        with lock:
+            if fname in results:
+                return
+            results[fname] = result
+        try:
+            if stacks is not None and not result:
+                stacks.handled(fname)
+            if callback is not None:
+                with lock:
+                    callback(fname, result, frame_rec)
+        finally:
+            tickets.release()
+
+    def stage(funct):
+        '''
+         exceptions raised in a done-callback are swallowed
+         (concurrent.futures), the frame fails instead
+        '''
+        def wrapper(fname, *stage_args):
+            try:
+                funct(fname, *stage_args)
+            except Exception as e:
+                print('ERROR: Conversion failed for {}: {}'.format(fname, e))
+                log.debug('stage failed frame=%s', fname, exc_info=True)
+                free(fname)
+                finish(fname, False)
+        return wrapper
+
+    def submit(fname, funct, *funct_args, **funct_kwargs):
+        '''
+         submit to the worker processes, a frame that
+         cannot be submitted fails (returns None)
+        '''
+        if not fatal:
+            try:
+                return cpu_pool.submit(funct, *funct_args, **funct_kwargs)
+            except Exception as e:
+                if not fatal:
+                    print('ERROR: Worker processes failed: {}'.format(e))
+                log.debug('submit failed frame=%s', fname, exc_info=True)
+                fatal.append(e)
+        free(fname)
+        finish(fname, False)
+        return None
+
+    @stage
+    def fetched(fname, index, future):
+        try:
+            stream, src = future.result()
+        except Exception as e:
+            print('ERROR: Reading failed for {}: {}'.format(fname, e))
+            free(fname)
+            finish(fname, False)
+            return
+        if type(stream) == int:
+            future = submit(fname, transform_slot, conversion, fname, frame_pool.spec, index, stream, args, kwargs, profile)
+        else:
+            # not read into the slot (too large)
+            free(fname)
+            index = None
+            future = submit(fname, transform_frame, conversion, fname, stream, args, kwargs, profile)
+        if future is not None:
+            future.add_done_callback(lambda future: transformed(fname, index, src, future))
+
+    @stage
+    def transformed(fname, index, src, future):
+        try:
+            buffers, frame_events = future.result()
+        except Exception as e:
+            print('ERROR: Conversion failed for {}: {}'.format(fname, e))
+            log.debug('conversion failed frame=%s', fname, exc_info=future.exception())
+            free(fname)
+            finish(fname, False)
+            return
+        if profile:
+            events.extend(frame_events)
+        if not buffers:
+            free(fname)
+            finish(fname, False)
+            return
+        if index is not None:
+            # the image (the frame for stacks) is in the slot
+            buffers[1] = frame_pool.data(index) if stacks is not None else frame_pool.raw(index, buffers[1])
+        encoded.put((fname, index, src, buffers))
+
+    @stage
+    def verified(fname, frame_rec, future):
+        try:
+            mismatch = future.result()
+        except Exception as e:
+            mismatch = [str(e)]
+        if mismatch:
+            print('ERROR: Verification failed for {}: {}'.format(fname, '; '.join(mismatch)))
+            finish(fname, False)
+            return
+        finish(fname, True, frame_rec)
+
+    def write(fname, index, src, buffers):
+        outName = get_sfrm_name(fname, path_output)
+        try:
+            if stacks is not None:
+                # header and preprocessed frame
+                stacks.write(fname, *buffers)
+                frame_rec = None
+            else:
+                write_bruker_buffers(outName, buffers)
+                frame_rec = buffers_record(fname, src, outName, buffers) if record else None
+        except Exception as e:
+            print('ERROR: Writing failed for {}: {}'.format(outName, e))
+            log.debug('writing failed frame=%s', fname, exc_info=True)
+            frame_rec = False
+        finally:
+            if index is not None:
+                if stacks is None:
+                    buffers[1].release()
+                buffers[1] = None
+                free(fname)
+        if frame_rec is False:
+            finish(fname, False)
+            return
+        if verify is None:
+            finish(fname, True, frame_rec)
+            return
+        future = submit(fname, verify_frame, fname, path_output, **verify)
+        if future is not None:
+            future.add_done_callback(lambda future: verified(fname, frame_rec, future))
+
+    def writer():
+        while True:
+            items = [encoded.get()]
+            while len(items) < batch:
+                try:
+                    items.append(encoded.get_nowait())
+                except queue.Empty:
+                    break
+            start = time.perf_counter()
+            for item in items:
+                if item is None:
+                    return
+                try:
+                    write(*item)
+                except Exception as e:
+                    # keep draining, the frame fails
+                    print('ERROR: Writing failed for {}: {}'.format(item[0], e))
+                    log.debug('writer failed frame=%s', item[0], exc_info=True)
+                    fatal.append(e)
+                    free(item[0])
+                    finish(item[0], False)
+            if flush is not None:
+                with lock:
+                    flush()
+            log.debug('batch written frames=%d queued=%d duration_ms=%.1f', len(items), encoded.qsize(),
+                      (time.perf_counter() - start) * 1e3)
+
+    if profile:
+        enable_profiling()
+    io_pool = ThreadPoolExecutor(max_workers=io_threads)
+    cpu_pool = ProcessPoolExecutor(max_workers=workers, initializer=clear_run_caches)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    try:
+        for fname in fList:
+            tickets.acquire()
+            if fatal:
+                tickets.release()
+                break
+            index = None if frame_pool is None else frame_pool.acquire()
+            if index is not None:
+                with lock:
+                    slots[fname] = index
+            future = io_pool.submit(fetch_frame, fname, frame_pool, index)
+            future.add_done_callback(lambda future, fname=fname, index=index: fetched(fname, index, future))
+        # all tickets returned: every frame is done
+        for _ in range(inflight):
+            tickets.acquire()
+        if fatal:
+            with lock:
+                for fname in fList:
+                    results.setdefault(fname, False)
+    finally:
+        encoded.put(None)
+        writer_thread.join()
+        io_pool.shutdown()
+        cpu_pool.shutdown()
+        if frame_pool is not None:
+            frame_pool.close()
+        if profile:
+            events.extend(drain_events())
+            disable_profiling()
+    return results
+
+def run_convert(path_input, path_output, site, workers=None, chunksize=16, overwrite=True, resume=False, verify=False, profile=False, trace=None,
+                io_threads=4, inflight=None, hdf5=False):
+    '''
+     headless conversion of all frames in path_input
+     to Bruker .sfrm format in path_output
+      - the frames are read, converted and written in
+        overlapping stages (see convert_pipeline), 'chunksize'
+        frames are written per batch, at most 'inflight'
+        frames are held in shared memory
+      - every converted frame is recorded in the manifest
+        of the output directory (see ConversionManifest)
+      - resume: skip the frames the manifest lists as complete,
+        (re)convert all others
+      - verify: compare every written frame with its source,
+        frames that fail are not recorded
+      - profile: time the stages of every frame, a summary is
+        printed at the end, trace: save them as Chrome trace
+      - hdf5: write one HDF5 stack per run instead of .sfrm
+        files (see _Stack.py, needs h5py), the stacks are
+        always written completely (no manifest)
+     returns False if a frame failed
+    '''
+    path_input = os.path.abspath(path_input)
+    path_output = os.path.abspath(path_output)
+
+    if hdf5:
+        if resume or verify:
+            print('ERROR: --resume and --verify need the .sfrm output')
+            return False
+        try:
+            import h5py
+        except ImportError:
+            print('ERROR: h5py is required for the HDF5 output')
+            return False
+
+    fList = find_frames(path_input)
+    if not fList:
+        print('ERROR: No suitable image files found in: {}'.format(path_input))
+        return False
+
+    # stale or truncated frames must be replaced
+    # a stack replaces all frames of the run
+    setup = get_conversion(site, fList[0], path_input, path_output, overwrite or resume or hdf5)
+    if setup is None:
+        print('ERROR: Unknown facility: {}'.format(site))
+        return False
+    conversion, args, kwargs = setup
+
+    # Make directories recursively
+    if not os.path.exists(path_output):
+        os.makedirs(path_output)
+
+    stacks = RunStacks(path_output, fList) if hdf5 else None
+    manifest = None if hdf5 else ConversionManifest(path_output)
+    if resume:
+        num_total = len(fList)
+        fList = manifest.pending(fList)
+        print('Resuming: {} of {} images already converted'.format(num_total - len(fList), num_total))
+    elif not overwrite and not hdf5:
+        # existing frames are skipped, not failed
+        num_total = len(fList)
+        fList = [fname for fname in fList if not os.path.exists(get_sfrm_name(fname, path_output))]
+        print('Skipping: {} of {} images already exist'.format(num_total - len(fList), num_total))
+
+    num_to_convert = len(fList)
+    converted = []
+    def progress(fname, result, record):
+        converted.append(result)
+        if record is not None:
+            manifest.add(record, flush=False)
+        print('{:>6}/{} {}'.format(len(converted), num_to_convert, os.path.basename(fname)), flush=True)
+
+    events = [] if profile or trace else None
+    t0 = time.perf_counter()
+    try:
+        results = convert_pipeline(conversion, fList, args, kwargs, workers=workers, io_threads=io_threads, inflight=inflight,
+                                   batch=chunksize, callback=progress, flush=None if hdf5 else manifest.flush, record=not hdf5,
+                                   verify=get_verify_format(site) if verify else None, events=events,
+                                   frame_format=get_frame_format(site), stacks=stacks)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        if stacks is not None:
+            stacks.close()
+    print('Successfully converted {} images!'.format(sum(1 for r in results.values() if r)))
+    failed = sum(1 for r in results.values() if not r)
+    if failed:
+        print('ERROR: {} images failed!'.format(failed))
+    if events:
+        print_summary(summarize_events(events, time.perf_counter() - t0))
+        if trace is not None:
+            write_trace(trace, events)
+            print('Profiling trace saved to: {}'.format(trace))
+    return failed == 0
+
+def run_export(fstacks, path_output, frames=None, overwrite=False):
+    '''
+     write the .sfrm files of HDF5 run stacks (see export_stack)
+      - frames: frame numbers, e.g. ['1', '5-10'], all if None
+      - only missing .sfrm are written unless overwrite
+    '''
+    try:
+        import h5py
+    except ImportError:
+        print('ERROR: h5py is required to read HDF5 stacks')
+        return False
+    path_output = os.path.abspath(path_output)
+    if frames is not None:
+        frames = parse_frames(frames)
+    # Make directories recursively
+    if not os.path.exists(path_output):
+        os.makedirs(path_output)
+    for fstack in fstacks:
+        if not os.path.isfile(fstack):
+            print('ERROR: Stack not found: {}'.format(fstack))
+            return False
+        print('{}: {} images exported'.format(os.path.basename(fstack), export_stack(fstack, path_output, frames, overwrite)), flush=True)
+    return True
+
+def verify_output(fname, path_output, **kwargs):
+    '''
+     verify the .sfrm of a frame (see verify_frame)
+     returns the mismatches and the checksum of the .sfrm
+     (None if it is missing)
+    '''
+    mismatch = verify_frame(fname, path_output, **kwargs)
+    outName = get_sfrm_name(fname, path_output)
+    if not os.path.exists(outName):
+        return mismatch, None
+    return mismatch, file_checksum(outName)
+
+def run_verify(path_input, path_output, site, workers=None, chunksize=16):
+    '''
+     verify the converted frames in path_output against
+     the frames in path_input
+      - the source frames are transformed as by the conversion
+        and compared pixel by pixel (including the overflow
+        tables), NCOUNTS, MAXIMUM and NOVERFL are checked
+      - the checksum of the .sfrm is compared with the manifest
+        record, if there is one
+      - frames are verified in parallel (see convert_batch),
+        mismatches are reported per frame
+     returns True if all frames agree
+    '''
+    path_input = os.path.abspath(path_input)
+    path_output = os.path.abspath(path_output)
+
+    fList = find_frames(path_input)
+    if not fList:
+        print('ERROR: No suitable image files found in: {}'.format(path_input))
+        return False
+
+    kwargs = get_verify_format(site)
+    if kwargs is None:
+        print('ERROR: Unknown facility: {}'.format(site))
+        return False
+
+    manifest = ConversionManifest(path_output)
+    num_to_verify = len(fList)
+    verified = []
+    failed = []
+    def progress(fname, result, record):
+        verified.append(fname)
+        if result is False:
+            failed.append(fname)
+            return
+        mismatch, checksum = result
+        record = manifest.records.get(fname)
+        if record is not None and checksum is not None and record['checksum'] != checksum:
+            mismatch = mismatch + ['checksum {}, manifest {}'.format(checksum, record['checksum'])]
+        if mismatch:
+            failed.append(fname)
+            print('{:>6}/{} {} MISMATCH: {}'.format(len(verified), num_to_verify, os.path.basename(fname), '; '.join(mismatch)), flush=True)
+        else:
+            print('{:>6}/{} {} ok'.format(len(verified), num_to_verify, os.path.basename(fname)), flush=True)
+
+    convert_batch(verify_output, fList, [path_output], kwargs, workers=workers, chunksize=chunksize, callback=progress)
+    print('Verified {} images, {} mismatches!'.format(len(verified), len(failed)))
+    return not failed
+
+def mask_geometry_entry(geometry):
+    '''
+     JSON compatible copy of the patches of a mask
+     {'rect':[xy, w, h, angle], 'elli':[xy, w, h, angle]}
+    '''
+    entry = {}
+    for name in ('rect', 'elli'):
+        xy, w, h, a = geometry[name]
+        entry[name] = [[float(xy[0]), float(xy[1])], float(w), float(h), float(a)]
+    return entry
+
+def write_mask_geometry(fname, masks, default=None):
+    '''
+     store the beamstop geometry of the masks
+      - masks: {frame path: {'rect':[...], 'elli':[...]}}
+        as kept by FrameView.masks
+      - default: geometry used for runs without an own entry,
+        the last entry of masks if None
+      - runs are stored by the frame name, the geometry
+        stays valid if the data is moved
+    '''
+    if not masks:
+        return
+    if default is None:
+        default = masks[list(masks)[-1]]
+    geometry = {'default':mask_geometry_entry(default),
+                'runs':{os.path.basename(f):mask_geometry_entry(g) for f, g in masks.items()}}
+    tmpName = '{}.{}.part'.format(fname, os.getpid())
+    with open(tmpName, 'w') as ofile:
+        json.dump(geometry, ofile, indent=1)
+    os.replace(tmpName, fname)
+
+def read_mask_geometry(fname):
+    '''
+     read a beamstop geometry file (see write_mask_geometry)
+     returns: default geometry (or None), {frame name: geometry}
+    '''
+    with open(fname) as ofile:
+        geometry = json.load(ofile)
+    return geometry.get('default'), geometry.get('runs', {})
+
+def run_masks(path_input, path_output, site, geometry=None, workers=None):
+    '''
+     headless beamstop mask generation
+      - one mask (some_name_xa_rr_0001.sfrm) for every run in
+        path_input, written to path_output
+      - geometry: geometry file (default: path_output/MASK_GEOMETRY_NAME),
+        runs without an own entry use the default geometry
+     returns False if a mask was not written
+    '''
+    path_input = os.path.abspath(path_input)
+    path_output = os.path.abspath(path_output)
+    if geometry is None:
+        geometry = os.path.join(path_output, MASK_GEOMETRY_NAME)
+    if not os.path.exists(geometry):
+        print('ERROR: Beamstop geometry file not found: {}'.format(geometry))
+        return False
+    default, runs = read_mask_geometry(geometry)
+
+    frame_format = get_frame_format(site)
+    if frame_format is None:
+        print('ERROR: Unknown facility: {}'.format(site))
+        return False
+    reader, (rows, cols, offset), rotate = frame_format
+
+    # the first frame found marks a run
+    fList = [run.fname for run in scan_directory(path_input, FRAME_EXTS).runs]
+    if not fList:
+        print('ERROR: No suitable image files found in: {}'.format(path_input))
+        return False
+
+    # Make directories recursively
+    if not os.path.exists(path_output):
+        os.makedirs(path_output)
+
+    # runs sharing a geometry are masked in one batch
+    batches = {}
+    for fname in fList:
+        entry = runs.get(os.path.basename(fname), default)
+        if entry is None:
+            print('ERROR: No beamstop geometry for {}'.format(os.path.basename(fname)))
+            continue
+        batches.setdefault(json.dumps(entry, sort_keys=True), []).append(fname)
+
+    num_to_write = sum(len(b) for b in batches.values())
+    written = []
+    def progress(fname, result, record):
+        written.append(result)
+        print('{:>6}/{} {}'.format(len(written), num_to_write, os.path.basename(get_mask_name(fname, path_output))), flush=True)
+
+    for key, fBatch in batches.items():
+        kwargs = {'geometry':json.loads(key), 'reader':reader, 'rows':rows, 'cols':cols, 'offset':offset, 'rotate':rotate}
+        convert_batch(convert_frame_to_mask, fBatch, [path_output], kwargs, workers=workers, chunksize=1, callback=progress)
+    print('Successfully wrote {} masks!'.format(sum(1 for r in written if r)))
+    return len(written) == len(fList) and all(written)
@@ -0,0 +1,361 @@
+import os, sys, time, json, shutil, tempfile, platform
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
+from _Utility import _decode_pilatus_cbf, preprocess_frame,\
+                     bruker_header, format_bruker_header, build_bruker_tables,\
+                     _APS_STATIC, _APS_FRAME, _SP8_STATIC, _SP8_FRAME, _DLS_STATIC, _DLS_FRAME
+from _Batch import get_conversion, get_frame_format, find_frames, convert_batch, convert_pipeline
+from _Sites import SITES, get_site
+
+#########################################
+##  Add new format identifiers here!   ##
+#########################################
+# synthetic frame names of a facility: stem, run, frame number
+_SYNTHETIC = {'APS':'bench_{:02d}_{:04d}.tif',
+              'SP8':'bench_{:02d}{:03d}.tif',
+              'DLS':'bench_{:d}_{:05d}.cbf'}
+# header fields of a facility: parsers of the static and
+# per-frame fields, extension of the side file holding them
+# (None: the header of the frame)
+_FIELDS = {'APS':(_APS_STATIC, _APS_FRAME, None),
+           'SP8':(_SP8_STATIC, _SP8_FRAME, '.inf'),
+           'DLS':(_DLS_STATIC, _DLS_FRAME, None)}
+
+# timed stages of the conversion of a single frame
+STAGES = ('read', 'decode', 'preprocess', 'header', 'tables', 'write', 'convert')
+
+def synthetic_frame(rng, rows, cols):
+    '''
+     a Pilatus like frame (np.int32)
+      - Poisson background, some strong reflections
+      - a few pixels above 2**16 (32 bit overflow table)
+      - dead areas between the modules (-1), bad pixels (-2)
+    '''
+    import numpy as np
+    data = rng.poisson(2, (rows, cols)).astype(np.int32)
+    spots = rng.integers(0, rows * cols, rows * cols // 1000)
+    data.flat[spots] = rng.integers(200, 60000, spots.size)
+    hot = rng.integers(0, rows * cols, 50)
+    data.flat[hot] = rng.integers(65535, 3000000, hot.size)
+    # module gaps: 487 x 195 pixel modules, 7 and 17 pixel gaps
+    data[:, 487:494] = -1
+    data[:, 981:988] = -1
+    for row in range(195, rows, 212):
+        data[row:row + 17, :] = -1
+    data.flat[rng.integers(0, rows * cols, 20)] = -2
+    return data
+
+def encode_byte_offset(data):
+    '''
+     byte offset compression (CBF) of a frame, counterpart
+     of decByteOffset_vec: the differences of adjacent pixels
+     are stored in 1, 3, 7 or 15 bytes
+    '''
+    import numpy as np
+    delta = np.diff(data.ravel().astype(np.int64), prepend=0)
+    size = np.full(delta.size, 1, dtype=np.int64)
+    size[np.abs(delta) > 127] = 3
+    size[np.abs(delta) > 32767] = 7
+    size[np.abs(delta) > 2**31 - 1] = 15
+    pos = np.cumsum(size) - size
+    stream = np.zeros(int(size.sum()), dtype=np.uint8)
+    # 1 byte
+    idx = size == 1
+    stream[pos[idx]] = delta[idx].astype(np.int8).view(np.uint8)
+    # escape 0x80, 2 bytes / escape 0x80 0x0080, 4 bytes / ... 8 bytes
+    for nbytes, escape, dtype in ((3, b'\x80', '<i2'),
+                                  (7, b'\x80\x00\x80', '<i4'),
+                                  (15, b'\x80\x00\x80\x00\x00\x00\x80', '<i8')):
+        idx = size == nbytes
+        if not idx.any():
+            continue
+        start = pos[idx]
+        for i, byte in enumerate(escape):
+            stream[start + i] = byte
+        value = delta[idx].astype(dtype).view(np.uint8).reshape(-1, nbytes - len(escape))
+        for i in range(value.shape[1]):
+            stream[start + len(escape) + i] = value[:, i]
+    return stream.tobytes()
+
+def write_pilatus_tif(fname, data, ident, num, stamp='2019:05:03 10:11:12.123'):
+    '''
+     Pilatus .tif: 4096 byte header followed by the image (int32)
+    '''
+    header = ('II*\x00 S/N {}\r\n'
+              '# {}\r\n'
+              '# Pixel_size 172e-6 m x 172e-6 m\r\n'
+              '# Exposure_time 0.1000000 s\r\n'
+              '# Exposure_period 0.1020000 s\r\n'
+              '# Flux 12345.6700\r\n'
+              '# Wavelength 0.41328 A\r\n'
+              '# Detector_distance 0.10000 m\r\n'
+              '# Beam_xy (497.20, 521.40) pixels\r\n'
+              '# Omega 0.0000 deg.\r\n'
+              '# Kappa 10.0000 deg.\r\n'
+              '# Alpha 50.0000 deg.\r\n'
+              '# Phi {:.4f} deg.\r\n'
+              '# Phi_increment 0.2500 deg.\r\n').format(ident, stamp, 0.25 * num)
+    with open(fname, 'wb') as ofile:
+        ofile.write(header.encode().ljust(4096, b'\x00'))
+        ofile.write(data.astype('<i4').tobytes())
+
+def write_pilatus_cbf(fname, data, ident, num):
+    '''
+     Pilatus .cbf, byte offset compressed
+    '''
+    binary = encode_byte_offset(data)
+    header = ('###CBF: VERSION 1.5\r\n'
+              'data_{}\r\n'
+              '_diffrn.id {}\r\n'
+              '_array_data.header_convention "PILATUS_1.2"\r\n'
+              '_array_data.header_contents\r\n'
+              ';\r\n'
+              '# Exposure_time 0.1000000 s\r\n'
+              '# Exposure_period 0.1000000 s\r\n'
+              '# Wavelength 0.68890 A\r\n'
+              '# Detector_distance 0.12000 m\r\n'
+              '# Beam_xy (740.10, 830.20) pixels\r\n'
+              '# Detector_2theta 0.0000 deg.\r\n'
+              '# Omega 0.0000 deg.\r\n'
+              '# Omega_increment 0.0000 deg.\r\n'
+              '# Phi {:.4f} deg.\r\n'
+              '# Phi_increment 0.1000 deg.\r\n'
+              '# Chi -30.0000 deg.\r\n'
+              '# Chi_increment 0.0000 deg.\r\n'
+              ';\r\n'
+              '_array_data.data\r\n'
+              ';\r\n'
+              '--CIF-BINARY-FORMAT-SECTION--\r\n'
+              'Content-Type: application/octet-stream;\r\n'
+              '     conversions="x-CBF_BYTE_OFFSET"\r\n'
+              'X-Binary-Size: {}\r\n'
+              'X-Binary-Number-of-Elements: {}\r\n'
+              'X-Binary-Size-Fastest-Dimension: {}\r\n'
+              'X-Binary-Size-Second-Dimension: {}\r\n'
+              '\r\n').format(os.path.splitext(os.path.basename(fname))[0], ident, 0.1 * num,
+                             len(binary), data.size, data.shape[1], data.shape[0])
+    with open(fname, 'wb') as ofile:
+        ofile.write(header.encode() + b'\x0c\x1a\x04\xd5' + binary + b'\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n')
+
+def write_SP8_inf(fname, num):
+    '''
+     SPring-8 .inf side file of a frame
+    '''
+    with open(fname, 'w') as ofile:
+        ofile.write('CCD_SPATIAL_BEAM_POSITION = 497.20 521.40;\n'
+                    'SATURATED_VALUE = 1048575;\n'
+                    'SCAN_WAVELENGTH = 0.35000;\n'
+                    'SOURCE_AMPERAGE = 99.5000 mA;\n'
+                    'SOURCE_VOLTAGE = 8.0000 GeV;\n'
+                    'CRYSTAL_GONIO_VALUES = 0.0000 -10.0000 0.0000;\n'
+                    'SCAN_DET_RELZERO = 0.0000 20.0000 130.0000;\n'
+                    'ROTATION_AXIS_NAME = Omega;\n'
+                    'SCAN_SEQ_INFO = 1 1 180;\n'
+                    'SCAN_ROTATION = {:.4f} {:.4f} 1.0000 0.1000 0.0000 0.0000 0.0000 0.0000 0.0000 0.0000;\n'.format(num - 1.0, num))
+
+def write_APS_flux(fname, frames):
+    '''
+     APS beam flux of a run: frame number and flux per frame
+    '''
+    with open(fname, 'w') as ofile:
+        ofile.write(' '.join('{} {:.1f}'.format(num, 1000.0 + num) for num in range(1, frames + 1)))
+
+def make_dataset(path, site, runs=1, frames=20, seed=0):
+    '''
+     write a synthetic dataset of a facility to path
+      - APS: 1M .tif and ExperimentName_rr_flux.txt
+      - SP8: 1M .tif and .inf side files
+      - DLS: 2M .cbf
+     returns the list of frames
+    '''
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    _, (rows, cols, _), _ = get_frame_format(site)
+    # serial number / _diffrn.id, see _Sites.py
+    ident = get_site(site).ident
+    if not os.path.exists(path):
+        os.makedirs(path)
+    fList = []
+    for run in range(1, runs + 1):
+        for num in range(1, frames + 1):
+            fname = os.path.join(path, _SYNTHETIC[site].format(run, num))
+            data = synthetic_frame(rng, rows, cols)
+            if site == 'DLS':
+                write_pilatus_cbf(fname, data, ident, num)
+            else:
+                write_pilatus_tif(fname, data, ident, num)
+            if site == 'SP8':
+                write_SP8_inf(os.path.splitext(fname)[0] + '.inf', num)
+            fList.append(fname)
+        if site == 'APS':
+            write_APS_flux(os.path.join(path, 'bench_{:02d}_flux.txt'.format(run)), frames)
+    return fList
+
+def time_call(timings, stage, funct, *args, **kwargs):
+    '''
+     call funct, append the wall time to timings[stage]
+    '''
+    t0 = time.perf_counter()
+    result = funct(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - t0)
+    return result
+
+def time_stages(fList, site, path_output, repeat=5):
+    '''
+     time the stages of the conversion of single frames
+      - read: the file into memory
+      - decode: bytes to image (.cbf decompression, .tif view)
+      - preprocess: pad, rotate, dead/bad pixels, statistics
+      - header: format the Bruker header from scratch
+      - tables: build the overflow tables
+      - write: write header, image and tables
+      - convert: the complete conversion (convert_frame_*)
+     returns {stage: [seconds, ...]}
+    '''
+    import numpy as np
+    reader, (rows, cols, offset), rotate = get_frame_format(site)
+    conversion, args, kwargs = get_conversion(site, fList[0], os.path.dirname(fList[0]), path_output)
+    if not os.path.exists(path_output):
+        os.makedirs(path_output)
+    tmpName = os.path.join(path_output, 'stage.sfrm')
+    timings = {}
+    for i in range(repeat):
+        fname = fList[i % len(fList)]
+        def read_file():
+            with open(fname, 'rb') as ofile:
+                return ofile.read()
+        stream = time_call(timings, 'read', read_file)
+        if site == 'DLS':
+            _, data = time_call(timings, 'decode', _decode_pilatus_cbf, stream)
+        else:
+            data = time_call(timings, 'decode', lambda: np.frombuffer(stream, np.int32, rows * cols, offset).reshape((rows, cols)))
+        data, _, _, stats = time_call(timings, 'preprocess', preprocess_frame, data, rotate)
+        fheader = bruker_header()
+        fheader['DETTYPE'][:] = ['PILATUS3', 0.0, 0.00, 0, 0.001, 0.0, 0]
+        fheader['NROWS'] = [data.shape[0]]
+        fheader['NCOLS'] = [data.shape[1]]
+        fheader['NPIXELB'][:] = [1, 1]
+        header = time_call(timings, 'header', format_bruker_header, fheader).encode('ASCII')
+        tables = time_call(timings, 'tables', build_bruker_tables, data, 1, 1)
+        def write_file():
+            with open(tmpName, 'wb') as ofile:
+                ofile.write(header)
+                for table in tables[:4]:
+                    if table is not None:
+                        ofile.write(table.tobytes())
+        time_call(timings, 'write', write_file)
+        time_call(timings, 'convert', conversion, fname, *args, **kwargs)
+    os.remove(tmpName)
+    return timings
+
+def time_throughput(fList, site, path_output, workers, chunksize=4, pipeline=False):
+    '''
+     convert all frames of fList using 'workers' processes
+      - pipeline: overlapping read/convert/write stages
+        (convert_pipeline, shared memory frame buffers)
+        instead of chunks (convert_batch)
+     returns frames per second
+    '''
+    conversion, args, kwargs = get_conversion(site, fList[0], os.path.dirname(fList[0]), path_output)
+    if not os.path.exists(path_output):
+        os.makedirs(path_output)
+    t0 = time.perf_counter()
+    if pipeline:
+        convert_pipeline(conversion, fList, args, kwargs, workers=workers, batch=chunksize, frame_format=get_frame_format(site))
+    else:
+        convert_batch(conversion, fList, args, kwargs, workers=workers, chunksize=chunksize)
+    return len(fList) / (time.perf_counter() - t0)
+
+def time_run_headers(fList, site, frames=10000):
+    '''
+     time the Bruker headers of a run of 'frames' frames
+     (run_headers_*), the header fields and statistics of
+     the first frame are repeated
+      - build: the header columns of all frames at once
+      - views: yield the headers of all frames
+     returns {stage: seconds}
+    '''
+    import numpy as np
+    reader, (rows, cols, offset), rotate = get_frame_format(site)
+    static, per_frame, side_file = _FIELDS[site]
+    header, data = reader(fList[0], rows, cols, offset, np.int32)
+    if side_file is None:
+        text = str(header)
+    else:
+        with open(os.path.splitext(fList[0])[0] + side_file) as ofile:
+            text = ofile.read()
+    data, offset_rows, offset_cols, stats = preprocess_frame(data, rotate)
+    frm_info = per_frame.parse(text)
+    names = [('bench_01_{:05d}'.format(i), i, '2019-05-03 10:11:12') for i in range(1, frames + 1)]
+    timings = {}
+    headers = time_call(timings, 'build', get_site(site).headers, static.parse(text), [frm_info] * frames, [stats] * frames,
+                        names, data.shape, (offset_rows, offset_cols), rows, cols)
+    time_call(timings, 'views', lambda: sum(1 for fheader in headers))
+    return {stage:seconds[0] for stage, seconds in timings.items()}
+
+def stage_summary(seconds):
+    '''
+     median, min and max of a stage in ms
+    '''
+    seconds = sorted(seconds)
+    return {'median_ms':round(seconds[len(seconds) // 2] * 1e3, 3),
+            'min_ms':round(seconds[0] * 1e3, 3),
+            'max_ms':round(seconds[-1] * 1e3, 3)}
+
+def run_benchmark(sites=SITES, frames=20, workers=None, repeat=5, path=None, fjson='pilatus3-fc_benchmark.json', headers=10000):
+    '''
+     benchmark the conversion on synthetic frames
+      - a dataset per facility is written to path (a temporary
+        directory, removed afterwards, if None)
+      - the stages of a single frame conversion are timed
+        'repeat' times (see time_stages)
+      - end-to-end throughput (frames/s) with 1, 2, 4, ...
+        up to 'workers' processes, chunked and pipelined
+      - the Bruker headers of a run of 'headers' frames
+        (see time_run_headers)
+      - the results are saved as JSON to compare runs
+    '''
+    import numpy as np
+    if workers is None:
+        workers = os.cpu_count() or 1
+    steps = sorted(set([2**i for i in range(workers.bit_length()) if 2**i < workers] + [workers]))
+    remove = path is None
+    if remove:
+        path = tempfile.mkdtemp(prefix='pilatus3-fc_benchmark_')
+    results = {'created':time.strftime('%Y-%m-%d %H:%M:%S'),
+               'platform':platform.platform(),
+               'python':platform.python_version(),
+               'numpy':np.__version__,
+               'cpu_count':os.cpu_count(),
+               'frames':frames,
+               'repeat':repeat,
+               'headers':headers,
+               'sites':{}}
+    try:
+        for site in sites:
+            path_input = os.path.join(path, site)
+            path_output = os.path.join(path, site + '_sfrm')
+            print('{}: writing {} synthetic frames'.format(site, frames), flush=True)
+            make_dataset(path_input, site, frames=frames)
+            fList = find_frames(path_input)
+            timings = time_stages(fList, site, path_output, repeat)
+            stages = {stage:stage_summary(timings[stage]) for stage in STAGES}
+            for stage in STAGES:
+                print('{:>6} {:<10} {:>10.2f} ms'.format(site, stage, stages[stage]['median_ms']), flush=True)
+            throughput = {}
+            throughput_pipeline = {}
+            for num in steps:
+                throughput[num] = round(time_throughput(fList, site, path_output, num), 2)
+                throughput_pipeline[num] = round(time_throughput(fList, site, path_output, num, pipeline=True), 2)
+                print('{:>6} {:>2} workers {:>8.2f} frames/s, pipeline {:>8.2f} frames/s'.format(site, num,
+                      throughput[num], throughput_pipeline[num]), flush=True)
+            run_headers = {stage:round(seconds * 1e3, 3) for stage, seconds in time_run_headers(fList, site, headers).items()}
+            print('{:>6} {} headers {:>8.2f} ms, views {:>8.2f} ms'.format(site, headers, run_headers['build'], run_headers['views']), flush=True)
+            results['sites'][site] = {'stages':stages, 'throughput':throughput, 'throughput_pipeline':throughput_pipeline,
+                                      'run_headers_ms':run_headers}
+    finally:
+        if remove:
+            shutil.rmtree(path, ignore_errors=True)
+    with open(fjson, 'w') as ofile:
+        json.dump(results, ofile, indent=1)
+    print('Benchmark results saved to: {}'.format(fjson))
+    return True
@@ -1,5 +1,7 @@
 import logging
 import numpy as np
+
+log = logging.getLogger('pilatus3-fc.viewer')
 class DraggableObject:
     '''
      based on:
@@ -8,7 +10,6 @@ class DraggableObject:
     '''
     lock = None# only one can be animated at a time
     def __init__(self, obj):
-        logging.info(self.__class__.__name__)
         self.obj = obj
         self.press = None
         self.background = None
@@ -19,7 +20,6 @@ class DraggableObject:
             _, self.rect_o = self.obj.get_xy()
         
     def connect(self):
-        logging.info(self.__class__.__name__)
         'connect to all the events we need'
         self.cidpress = self.obj.figure.canvas.mpl_connect('button_press_event', self.on_press)
         self.cidrelease = self.obj.figure.canvas.mpl_connect('button_release_event', self.on_release)
@@ -44,7 +44,10 @@ class DraggableObject:
             a0 = self.obj.angle
             if event.dblclick:
                 if y0 == self.rect_o:
-                    self.obj.set_y(self.obj.figure.canvas.height() - self.rect_o)
+                    # flip to the bottom of the frame, the frame
+                    # might be shown downsampled (overview)
+                    rows = self.obj.axes.images[0].get_extent()[2] + 0.5
+                    self.obj.set_y(rows - self.rect_o)
                 else:
                     self.obj.set_y(self.rect_o)
                 self.obj.angle = 180 - a0
@@ -138,9 +141,9 @@ class DraggableObject:
 
         # redraw the full figure
         self.obj.figure.canvas.draw()
+        log.debug('patch released patch=%s', self.obj)
 
     def disconnect(self):
-        logging.info(self.__class__.__name__)
         'disconnect all the stored connection ids'
         self.obj.figure.canvas.mpl_disconnect(self.cidpress)
         self.obj.figure.canvas.mpl_disconnect(self.cidrelease)
@@ -3,14 +3,161 @@ matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
-from matplotlib import pyplot as plt
-from matplotlib.patches import Rectangle, Ellipse, PathPatch
+from matplotlib.patches import Rectangle, Ellipse
 from PyQt5 import QtCore
-import os, sys, logging
+import os, sys, time, logging
 import numpy as np
+from collections import OrderedDict
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
 from _Classes_DraggableObject import DraggableObject
-from _Utility import pilatus_pad, bruker_header, write_bruker_frame
+from _Utility import pilatus_pad, beamstop_mask, write_bruker_mask
+from _Profile import log_duration
+
+log = logging.getLogger('pilatus3-fc.viewer')
+
+def get_palette(cmap, n=256):
+    '''
+     RGBA palette of a matplotlib colormap, one uint32
+     (4 x uint8) per color to be used with np.take
+    '''
+    try:
+        colormap = matplotlib.colormaps[cmap]
+    except AttributeError:
+        colormap = matplotlib.cm.get_cmap(cmap)
+    return np.ascontiguousarray(colormap(np.arange(n), bytes=True)).view(np.uint32).ravel()
+
+def build_pyramid(data, levels=(2, 4, 8)):
+    '''
+     downsampled copies of a frame for the overview
+     - max-pool: every pixel of a level is the maximum of the
+       LxL block it covers, single hot pixels and the
+       edges of the beamstop shadow stay visible
+     - each level is pooled from the previous one
+     - the frame is zero padded to a multiple of the largest level
+     returns {1: data, 2: data/2, 4: data/4, ...}
+    '''
+    rows, cols = data.shape
+    step = max(levels)
+    pad_rows = -rows % step
+    pad_cols = -cols % step
+    if pad_rows or pad_cols:
+        data = np.pad(data, ((0, pad_rows), (0, pad_cols)), mode='constant')
+    pyramid = {1:data}
+    level, prev = 1, data
+    for next_level in sorted(levels):
+        f = next_level // level
+        r, c = prev.shape
+        prev = prev.reshape(r // f, f, c // f, f).max(axis=(1, 3))
+        pyramid[next_level] = prev
+        level = next_level
+    return pyramid
+
+def load_frame(fPath, rFunct, rows, cols, offset, rotate=True):
+    '''
+     read a frame and get it ready for display
+     - padded to a multiple of 8 pixels (pilatus_pad)
+     - rotated by 90 degrees if requested
+    '''
+    # memory-map the frame, pilatus_pad copies it anyway
+    _, data = rFunct(fPath, rows, cols, offset, np.uint32, mmap=True)
+    # get the frame saint ready 
+    # - multiple of 128x128 pixels
+    # - pad with zeros
+    data, offset_rows, offset_cols = pilatus_pad(data)
+    
+    # the frame has to be rotated by 90 degrees
+    if rotate:
+        data = np.rot90(data, k=1, axes=(1, 0))
+    return data
+
+class FrameLoader(QtCore.QObject):
+    '''
+     load frames in the background
+     - request(): load a frame, frame_ready is emitted
+       once it is available (at once if cached)
+     - prefetch(): load frames into the cache, e.g. the
+       neighbouring runs, without emitting frame_ready
+     - the decoded frames are kept in a small LRU cache,
+       the cache is only accessed from the GUI thread
+    '''
+    # signal frame_ready
+    # - str: image path
+    # - object: padded/rotated frame data
+    frame_ready = QtCore.pyqtSignal(str, object)
+    
+    class Loading(QtCore.QRunnable):
+        class Signals(QtCore.QObject):
+            '''
+             Custom signals can only be defined on objects derived from QObject
+            '''
+            finished = QtCore.pyqtSignal(object, object)
+        
+        def __init__(self, key):
+            '''
+             key: (fPath, rFunct, rows, cols, offset, rotate)
+            '''
+            super(self.__class__, self).__init__()
+            self.key = key
+            self.signals = self.__class__.Signals()
+        
+        def run(self):
+            # finished is always emitted, the key is released
+            # (FrameLoader.loading) even if loading failed
+            start = time.perf_counter()
+            data = None
+            try:
+                data = load_frame(*self.key)
+            except Exception as e:
+                log.warning('loading failed frame=%s error=%s', self.key[0], e)
+                log.debug('loading failed frame=%s', self.key[0], exc_info=True)
+            else:
+                log.debug('loaded frame=%s duration_ms=%.1f', self.key[0], (time.perf_counter() - start) * 1e3)
+            finally:
+                self.signals.finished.emit(self.key, data)
+    
+    def __init__(self, size=8, parent=None):
+        super(FrameLoader, self).__init__(parent)
+        self.size = size
+        self.cache = OrderedDict()
+        self.loading = set()
+        self.requested = None
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(2)
+    
+    def load(self, key):
+        if key in self.loading:
+            return
+        self.loading.add(key)
+        worker = self.__class__.Loading(key)
+        worker.signals.finished.connect(self.on_loaded)
+        self.pool.start(worker)
+    
+    def request(self, fPath, rFunct, rows, cols, offset, rotate=True):
+        key = (fPath, rFunct, rows, cols, offset, rotate)
+        self.requested = key
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.frame_ready.emit(fPath, self.cache[key])
+        else:
+            self.load(key)
+    
+    def prefetch(self, fPaths, rFunct, rows, cols, offset, rotate=True):
+        for fPath in fPaths:
+            key = (fPath, rFunct, rows, cols, offset, rotate)
+            if key not in self.cache:
+                self.load(key)
+    
+    def on_loaded(self, key, data):
+        self.loading.discard(key)
+        if data is None:
+            return
+        self.cache[key] = data
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        # only the latest request is shown
+        if key == self.requested:
+            self.frame_ready.emit(key[0], data)
 
 class FrameView(FigureCanvas):
     
@@ -24,8 +171,6 @@ class FrameView(FigureCanvas):
     frame_loaded = QtCore.pyqtSignal(int, int)
     
     def __init__(self, parent=None):
-        logging.info(self.__class__.__name__)
-        
         self.fig = Figure()
         FigureCanvas.__init__(self, self.fig)
         self.axes = self.fig.add_subplot(111)
@@ -55,12 +200,50 @@ class FrameView(FigureCanvas):
         self.cmap_max = 25
         self.cmap = 'hot'
         self.showFrame = None
+        # display path, see display_prepare
+        self.palette = get_palette(self.cmap)
+        self.disp_limit = 1000
+        self.disp_data = None
+        self.disp_lut = None
+        # overview pyramid, see display_prepare
+        # - fit_size: (w, h) available to the canvas, the overview
+        #   uses the finest level that fits (set by the GUI)
+        # - view_level: level of the overview
+        # - disp_level: level currently shown (1: zoomed in)
+        self.pyramid = None
+        self.fit_size = None
+        self.view_level = 1
+        self.disp_level = 1
+        # the mouse wheel zooms in/out
+        self.mpl_connect('scroll_event', self.on_scroll)
+        # full redraw once the contrast settled
+        self.redraw_timer = QtCore.QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.timeout.connect(self.display_redraw)
+        # frames are read in the background
+        self.loader = FrameLoader(parent=self)
+        self.loader.frame_ready.connect(self.frame_show)
+        self.frame_requested = None
+        self.frame_shown = None
     
     def frame_update(self, fPath, rFunct, rows, cols, offset, rotate=True):
-        logging.info(self.__class__.__name__)
+        '''
+         request a frame from the loader, it is
+         shown by frame_show once it is available
+        '''
+        self.frame_requested = (fPath, rows, cols)
+        self.loader.request(fPath, rFunct, rows, cols, offset, rotate)
+    
+    def frame_prefetch(self, fPaths, rFunct, rows, cols, offset, rotate=True):
+        self.loader.prefetch(fPaths, rFunct, rows, cols, offset, rotate)
+    
+    def frame_show(self, fPath, data):
         # initial frame dimensions
         # if the frame dimensions change we need to clear/redraw the figureCanvas
         # as set_data would distort the frame
+        if self.frame_requested is None or not self.frame_requested[0] == fPath:
+            return
+        _, rows, cols = self.frame_requested
         if not self.frame_rows == rows or not self.frame_cols == cols:
             self.frame_rows = rows
             self.frame_cols = cols
@@ -69,32 +252,181 @@ class FrameView(FigureCanvas):
                 self.has_patches = False
                 self.showFrame = None
         
-        _, data = rFunct(fPath, self.frame_rows, self.frame_cols, offset, np.uint32)
-        # get the frame saint ready 
-        # - multiple of 128x128 pixels
-        # - pad with zeros
-        self.data, offset_rows, offset_cols = pilatus_pad(data)
+        self.data = data
+        self.frame_shown = fPath
         
-        # the frame has to be rotated by 90 degrees
-        if rotate:
-            self.data = np.rot90(self.data, k=1, axes=(1, 0))
+        # overview: finest pyramid level that fits
+        rows, cols = self.data.shape
+        self.view_level = 1
+        if self.fit_size is not None:
+            for level in (1, 2, 4, 8):
+                self.view_level = level
+                if cols // level <= self.fit_size[0] and rows // level <= self.fit_size[1]:
+                    break
+        self.disp_level = self.view_level
         
         # send frame dimensions (w,h) to main window
         # - adjust/fix the widget size
-        self.frame_loaded.emit(*np.flip(self.data.shape))
+        self.frame_loaded.emit(cols // self.view_level, rows // self.view_level)
         
-        if self.showFrame == None:
-            self.showFrame = self.axes.imshow(self.data, interpolation='none')
+        # the frame is shown as colormapped RGBA image
+        # - always in native pixel coordinates (extent), the patches
+        #   and hence the masks don't depend on the level shown
+        with log_duration(log, 'frame shown frame=%s level=%d', fPath, self.view_level):
+            self.display_prepare()
+            extent = (-0.5, cols - 0.5, rows - 0.5, -0.5)
+            if self.showFrame == None:
+                self.showFrame = self.axes.imshow(self.display_rgba(), interpolation='none', extent=extent)
+            else:
+                self.showFrame.set_data(self.display_rgba())
+                self.showFrame.set_extent(extent)
+            self.axes.set_xlim(-0.5, cols - 0.5)
+            self.axes.set_ylim(rows - 0.5, -0.5)
+            
+            self.add_patches_and_draw(fPath)
+    
+    def on_scroll(self, event):
+        '''
+         mouse wheel
+         - up: show the native resolution around the cursor
+         - down: back to the overview
+        '''
+        if event.inaxes != self.axes or self.showFrame is None:
+            return
+        if event.button == 'up':
+            self.view_zoom(event.xdata, event.ydata)
         else:
-            self.showFrame.set_data(self.data)
-        
-        self.showFrame.set_cmap(self.cmap)
-        self.showFrame.set_clim(vmin=self.cmap_min, vmax=self.cmap_max)
+            self.view_overview()
+    
+    def view_zoom(self, x, y):
+        if self.view_level == 1:
+            return
+        rows, cols = self.data.shape
+        # the canvas shows canvas-size native pixels
+        width, height = self.figure.bbox.width, self.figure.bbox.height
+        x0 = min(max(x - width / 2.0, -0.5), cols - 0.5 - width)
+        y0 = min(max(y - height / 2.0, -0.5), rows - 0.5 - height)
+        self.disp_level = 1
+        self.showFrame.set_data(self.display_rgba())
+        self.axes.set_xlim(x0, x0 + width)
+        self.axes.set_ylim(y0 + height, y0)
+        self.draw()
+    
+    def view_overview(self):
+        if self.disp_level == self.view_level:
+            return
+        rows, cols = self.data.shape
+        self.disp_level = self.view_level
+        self.showFrame.set_data(self.display_rgba())
+        self.axes.set_xlim(-0.5, cols - 0.5)
+        self.axes.set_ylim(rows - 0.5, -0.5)
+        self.draw()
+    
+    def display_prepare(self):
+        '''
+         fast display path
+         - matplotlib normalizes and colormaps all pixels on
+           every contrast change (set_clim + draw)
+         - instead the frame is clipped to the range of the contrast
+           slider once per frame (disp_data, uint16) and every value
+           is mapped to its color by a lookup table (disp_lut)
+         - a contrast change only recomputes the small LUT and
+           maps the frame with a single np.take
+        '''
+        with log_duration(log, 'display prepared shape=%s', self.data.shape):
+            self.disp_limit = max(self.disp_limit, int(np.ceil(self.cmap_max)))
+            self.disp_data = np.clip(self.data, 0, self.disp_limit).astype(np.uint16)
+            # the overview levels, max-pool commutes with the clipping
+            self.pyramid = build_pyramid(self.disp_data)
+            self.display_lut()
+    
+    def display_lut(self):
+        # same binning as matplotlib: Normalize + Colormap(N=256)
+        # values below vmin get the first, above vmax the last color
+        n = self.palette.shape[0]
+        values = np.arange(self.disp_limit + 1, dtype=np.float64)
+        scaled = np.floor((values - self.cmap_min) / (self.cmap_max - self.cmap_min) * n)
+        self.disp_lut = self.palette[np.clip(scaled, 0, n - 1).astype(np.intp)]
+    
+    def display_rgba(self):
+        level = self.pyramid[self.disp_level]
+        return np.take(self.disp_lut, level).view(np.uint8).reshape(level.shape + (4,))
+    
+    def display_redraw(self):
+        self.showFrame.set_data(self.display_rgba())
+        self.draw()
+    
+    def set_contrast(self, vmin, vmax):
+        '''
+         update the contrast of the shown frame
+         - the LUT-mapped frame is written straight into the
+           canvas buffer (nearest frame pixel per canvas pixel)
+           and only the patches are drawn on top
+         - the full matplotlib redraw is deferred until the
+           contrast did not change for 250 ms
+        '''
+        self.cmap_min = vmin
+        self.cmap_max = vmax
+        if self.showFrame is None:
+            return
+        if self.cmap_max > self.disp_limit:
+            self.display_prepare()
+        else:
+            self.display_lut()
         
-        self.add_patches_and_draw(fPath)
+        try:
+            buffer = np.asarray(self.buffer_rgba())
+        except AttributeError:
+            buffer = None
+        if buffer is None or not self.has_patches:
+            self.display_redraw()
+            return
+        # frame pixels shown by the canvas pixels
+        rows_idx, cols_idx = self.display_grid(buffer.shape[:2])
+        buffer[...] = 0
+        region = buffer.view(np.uint32)[:, :, 0][rows_idx[0]:rows_idx[1], cols_idx[0]:cols_idx[1]]
+        np.take(self.disp_lut, self.disp_view, out=region, mode='clip')
+        self.axes.draw_artist(self.patch_rect)
+        self.axes.draw_artist(self.patch_elli)
+        self.update()
+        self.redraw_timer.start(250)
+    
+    def display_grid(self, shape):
+        '''
+         nearest frame pixel of every canvas pixel
+         - the canvas might show the frame slightly scaled
+           (widget margins) or zoomed
+         - returns the canvas rows/cols covered by the
+           frame, disp_view holds the frame pixels shown there
+         - recomputed if the frame, the canvas size or
+           the view limits change
+        '''
+        data = self.pyramid[self.disp_level]
+        key = (shape, self.disp_level, self.axes.get_xlim(), self.axes.get_ylim(), id(data))
+        if getattr(self, 'disp_key', None) == key:
+            return self.disp_rows, self.disp_cols
+        height, width = shape
+        rows, cols = data.shape
+        inverse = self.axes.transData.inverted()
+        # canvas pixel centers, the buffer starts at the top
+        # native pixel coordinates -> pixel of the level shown
+        x = inverse.transform(np.column_stack([np.arange(width) + 0.5, np.zeros(width)]))[:, 0]
+        y = inverse.transform(np.column_stack([np.zeros(height), height - np.arange(height) - 0.5]))[:, 1]
+        x = np.floor((x + 0.5) / self.disp_level).astype(np.intp)
+        y = np.floor((y + 0.5) / self.disp_level).astype(np.intp)
+        cols_in = np.flatnonzero((x >= 0) & (x < cols))
+        rows_in = np.flatnonzero((y >= 0) & (y < rows))
+        if cols_in.size == 0 or rows_in.size == 0:
+            self.disp_rows, self.disp_cols = (0, 0), (0, 0)
+            self.disp_view = np.zeros((0, 0), dtype=data.dtype)
+        else:
+            self.disp_rows = (rows_in[0], rows_in[-1] + 1)
+            self.disp_cols = (cols_in[0], cols_in[-1] + 1)
+            self.disp_view = data[np.ix_(y[rows_in[0]:rows_in[-1] + 1], x[cols_in[0]:cols_in[-1] + 1])]
+        self.disp_key = key
+        return self.disp_rows, self.disp_cols
         
     def add_patches_and_draw(self, fPath):
-        logging.info(self.__class__.__name__)
         '''
          NOTE TO MATPLOTLIB PATCHES COLOR
          Turns out, you need to call axes.add_artist()
@@ -128,116 +460,29 @@ class FrameView(FigureCanvas):
         self.draw()
     
     def reset_patches(self):
-        logging.info(self.__class__.__name__)
         rows, cols = self.data.shape
         self.update_patch_rect(self.patch_rect, [cols//2 - self.rect_width//2, -self.rect_offset], self.rect_width, rows//2 +self.rect_offset, 0)
         self.update_patch_elli(self.patch_elli, [cols//2, rows//2], self.elli_width, self.elli_height, 0)
         self.draw()
         
     def update_patch_rect(self, aPatch, xy, w, h, a):
-        logging.info(self.__class__.__name__)
         aPatch.set_xy(xy)
         aPatch.set_height(h)
         aPatch.set_width(w)
         aPatch.angle = a
         
     def update_patch_elli(self, aPatch, xy, w, h, a):
-        logging.info(self.__class__.__name__)
         aPatch.set_center(xy)
         aPatch.height = h
         aPatch.width = w
         aPatch.angle = a
         
-    def transform_and_clip(self, p):
-        logging.info(self.__class__.__name__)
-        # get the 'actual' rectangle path and not the 'box'
-        path = p.get_path()
-        transform = p.get_transform()
-        path = transform.transform_path(path)
-        p = PathPatch(path)
-        # draw empty picture
-        im = plt.imshow(np.zeros(self.data.shape, dtype=np.int8))#, zorder=n)
-        # clip to path
-        im.set_clip_path(p)
-    
     def convert_patches_to_mask(self, fPath, mPath):
-        logging.info(self.__class__.__name__)
+        # the frame might still be loading
+        if not fPath == self.frame_shown:
+            return
         
         fstem, fname = os.path.split(fPath)
-        # this figure has to be fixed size
-        fig = plt.figure(figsize=(np.flip(self.data.shape)), dpi=1)
-        axes = fig.add_subplot(111)
-        # turn off the white background
-        fig.patch.set_visible(False)
-        # turn off the axis
-        axes.set_axis_off()
-        # set margins to zero
-        fig.subplots_adjust(left=0.0, right=1.0, top=1.0, bottom=0.0)
-        # cut out the patches
-        self.transform_and_clip(self.patch_rect)
-        self.transform_and_clip(self.patch_elli)
-        # render the image
-        fig.canvas.draw()
-        # translate figure to array
-        data_stacked = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.int8).reshape(self.data.shape[0], self.data.shape[1], 3)
-        # continue with first layer
-        data_clip = data_stacked[:,:,0]
-        # set negatives to zero
-        data_clip[data_clip < 0] = 0
-        # set patch area to minus one
-        data_clip[data_clip > 0] = -1
-        # positive values are data
-        # set them to 1 (active)
-        self.data[self.data >=  0] = 1
-        # the dead areas are flagged negative
-        # -1:dead pixel or -2: gap area
-        # set everything it all to -1
-        self.data[self.data < 0] = -1
-        # combine data and patches
-        data = self.data + data_clip
-        # now set everything negative to 0 (inactive)
-        data[data < 0] = 0
-        
-        # calculate detector pixel per cm
-        # this is normalized to a 512x512 detector format
-        # PILATUS3-1M pixel size is 0.172 mm 
-        pix_per_512 = round((10.0 / 0.172) * (512.0 / ((self.frame_rows + self.frame_cols) / 2.0)), 6)
-        
-        # default Bruker header
-        header = bruker_header()
-        
-        # fill known header items
-        header['NCOLS']      = [self.data.shape[1]]             # Number of pixels per row; number of mosaic tiles in X; dZ/dX
-        header['NROWS']      = [self.data.shape[0]]             # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
-        header['CCDPARM'][:] = [0.00, 1.00, 1.00, 1.00, 1169523]
-        header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-        header['DETTYPE'][:] = ['PILATUS3-1M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
-        header['SITE']       = ['']                             # Site name
-        header['MODEL']      = ['Synchrotron']                  # Diffractometer model
-        header['TARGET']     = ['']                             # X-ray target material)
-        header['USER']       = ['USER']                         # Username
-        header['SOURCEK']    = ['?']                            # X-ray source kV
-        header['SOURCEM']    = ['?']                            # Source milliamps
-        header['FILENAM']    = [fname]
-        header['TYPE']       = ['ACTIVE MASK']                  # String indicating kind of data in the frame
-        header['NFRAMES']    = ['?']                            # Number of frames in the series
-        header['NEXP'][2]    = 0
-        header['MAXXY']      = np.array(np.where(data == data.max()), np.float)[:, 0]
-        header['MAXIMUM']    = [np.max(data)]
-        header['MINIMUM']    = [np.min(data)]
-        header['NCOUNTS'][:] = [data.sum(), 0]
-        header['NOVER64'][:] = [data[data > 64000].shape[0], 0, 0]
-        header['NSTEPS']     = [1]                              # steps or oscillations in this frame
-        header['NPIXELB'][:] = [1, 1]                           # bytes/pixel in main image, bytes/pixel in underflow table
-        header['COMPRES']    = ['NONE']                         # compression scheme if any
-        header['TRAILER']    = [0]                              # byte pointer to trailer info
-        header['LINEAR'][:]  = [1.00, 0.00]     
-        header['PHD'][:]     = [1.00, 0.00]
-        header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
-        header['DISPLIM'][:] = [0.0, 63.0]                      # Recommended display contrast window settings
-        
-        # write the frame
-        write_bruker_frame(mPath, header, data)
         # store the patches in a dict, saving pos and shape
         self.masks[fPath] = {}
         self.masks[fPath]['rect'] = [self.patch_rect.get_xy(),
@@ -248,5 +493,13 @@ class FrameView(FigureCanvas):
                                      self.patch_elli.width,
                                      self.patch_elli.height,
                                      self.patch_elli.angle]
+        # rasterize the patches on the frame grid
+        # - pixels (partly) covered by a patch are inactive
+        # - dead areas (-1: dead pixel, -2: gap area) are inactive
+        with log_duration(log, 'mask written frame=%s', fname):
+            data = beamstop_mask(self.data, self.masks[fPath]['rect'], self.masks[fPath]['elli'])
+            
+            # write the frame
+            write_bruker_mask(mPath, data, fname, self.frame_rows, self.frame_cols)
         self.mask_written.emit(fPath)
         self.add_patches_and_draw(fPath)
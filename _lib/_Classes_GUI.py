@@ -1,15 +1,19 @@
-import os, sys, logging, re, glob
+import os, sys, logging, time
 import numpy as np
 from PyQt5 import QtCore, uic, QtWidgets
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
 from _Classes_FrameView import FrameView
-from _Utility import read_pilatus_cbf, read_pilatus_tif, get_run_info,\
-                     convert_frame_APS_Bruker, convert_frame_SP8_Bruker,\
-                     convert_frame_DLS_Bruker
+from _Utility import get_run_info
+from _Sites import detect_site
+from _Batch import FRAME_EXTS, MASK_GEOMETRY_NAME, get_conversion, convert_pipeline, read_mask_geometry, write_mask_geometry
+from _Watch import FrameWatcher, WatchPool
+from _Index import scan_directory, get_cached_index
+from _Profile import log_duration, percentile
+
+log = logging.getLogger('pilatus3-fc.gui')
 
 class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirname(__file__), '_Main_GUI.ui'))[0]):
     def __init__(self):
-        logging.info(self.__class__.__name__)
         super(QtWidgets.QMainWindow, self).__init__()
         self.setupUi(self)
         
@@ -62,16 +66,15 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         self.statusBar.hide()
         
     def set_tooltips(self):
-        logging.info(self.__class__.__name__)
         # add tooltips
         self.tb_convert.setToolTip('Start the conversion')
         self.le_output.setToolTip('Current output directory.\nIf unlinked: Select to specify the target output directory using the file-browser.\nManual editing is allowed, non-existing paths will be created recursively.')
         self.le_input.setToolTip('Current input directory.\nIf unlinked: Select to specify the target input directory using the file-browser.')
         self.cb_link.setToolTip('Link/Unlink output directory and input directory.\nIf linked: the output directory follows the input directory (plus added suffix).\nIf unlinked: Select either to specify the target directory using the filebrowser.')
         self.cb_overwrite.setToolTip('Overwrite existing files in the output directory?')
+        self.cb_watch.setToolTip('Watch the input directory and convert new images as they are written.\nPress the button again to stop watching.')
     
     def init_file_browser(self):
-        logging.info(self.__class__.__name__)
         # use the QFileSystemModel
         self.model = QtWidgets.QFileSystemModel()
         self.model.setRootPath('')
@@ -102,7 +105,6 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         self.on_treeView_clicked(self.model.index(start_dir))
         
     def init_icons(self):
-        logging.info(self.__class__.__name__)
         # icons
         self.windowIcon = self.style().standardIcon(getattr(QtWidgets.QStyle, 'SP_BrowserReload'))
         self.ic_MessageBoxWarning = self.style().standardIcon(getattr(QtWidgets.QStyle, 'SP_MessageBoxWarning'))
@@ -111,7 +113,6 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         self.ic_MessageBoxQuestion = self.style().standardIcon(getattr(QtWidgets.QStyle, 'SP_MessageBoxQuestion'))
         
     def init_styles(self):
-        logging.info(self.__class__.__name__)
         self.pb_style = ('QProgressBar        {text-align: center; border: 1px solid grey; border-radius: 2px}'
                          'QProgressBar:chunk  {background: qlineargradient(x1: 0, y1: 0.5, x2: 1, y2: 0.5, stop: 0 rgb(  0, 171, 164), stop: 1 rgb( 55, 160, 203));}')
         
@@ -147,7 +148,6 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         self.tb_mask_next_img.setArrowType(QtCore.Qt.RightArrow)
         
     def init_vars(self):
-        logging.info(self.__class__.__name__)
         '''
          
         '''
@@ -157,150 +157,103 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         self.rList = []
         self.fList = []
         self.suffix = '_sfrm'
+        self.watcher = None
+        # directories are indexed in the background
+        self.index_pool = QtCore.QThreadPool()
+        self.index_pool.setMaxThreadCount(1)
         
         # some hardcoded limits that might make sense
         self.hs_mask_int.setMaximum(1000)
         
-        #########################################
-        ##  Add new format identifiers here!   ##
-        #########################################
-        self.exts = ('*_*.tif', '*_*.cbf')
-        self.availableFormats = [self.format_SP8,
-                                 self.format_APS,
-                                 self.format_DLS]
+        # new formats are registered in _Sites.py
+        self.exts = FRAME_EXTS
     
     ##############################################
     ##         Frame Format definitions         ##
     ##############################################
     def check_format(self, aFrame):
-        logging.info(self.__class__.__name__)
-        for aCheckFunc in self.availableFormats:
-            if aCheckFunc(aFrame):
-                return True
-            else:
-                continue
-        return False
-    
-    def format_DLS(self, aFrame):
-        logging.info(self.__class__.__name__)
         '''
-        Check the first file if reformatting to Bruker name format is possible
+        Identify the facility of the first file (see _Sites.py) and
+        check if reformatting to Bruker name format is possible
         any_name_#run_#frame.tif -> any_name_rr_ffff.sfrm
+        SPring-8: any_name_rrfff.tif, where rr is the 2 digit run numer: 00 - 99
+        fff is the 3 digit frame number: 001 - 999
         '''
         try:
-            fhead, fname = os.path.split(aFrame)
-            bname, ext = os.path.splitext(fname)
-            if not ext == '.cbf':
-                return False
-            # open file and check: _diffrn.id DLS_I19-1
-            with open(aFrame, 'rb') as oFrame:
-                try:
-                    id = re.search(b'_diffrn.id\s+(?P<id>.+)', oFrame.read(2048)).group('id').decode().strip()
-                except AttributeError:
-                    return False
-            if not id == 'DLS_I19-1':
-                return False
-            fstm, rnum, fnum, flen = get_run_info(bname)
-            self.fRnum = rnum                         # Run number
-            self.fStem = fstm                         # Frame name up to the run number
-            self.fPath = aFrame                       # Full path to frame incl. frame name
-            self.fStar = '{:>0{w}}.'.format(1, w=flen)# Number indicating start of a run
-            self.fInfo = (1679, 1475, 0)              # Frame info (rows, cols, offset)
-            self.fSite = 'DLS'                        # Facility identifier
-            self.fFunc = read_pilatus_cbf             # Frame read function (from _Utility)
-            self.fRota = False                        # rotate the frame upon conversion?
-            return True
-        except (ValueError, IndexError):
+            site = detect_site(aFrame)
+        except OSError:
+            return False
+        if site is None:
             return False
-    
-    def format_APS(self, aFrame):
-        logging.info(self.__class__.__name__)
-        '''
-        Check the first file if reformatting to Bruker name format is possible
-        any_name_#run_#frame.tif -> any_name_rr_ffff.sfrm
-        '''
         try:
-            fhead, fname = os.path.split(aFrame)
-            bname, ext = os.path.splitext(fname)
-            if not ext == '.tif':
-                return False
-            # open file and check S/N: 10-0147
-            with open(aFrame, 'rb') as oFrame:
-                SN = re.search(b'S/N\s+(?P<SN>\d+\-\d+)', oFrame.read(128)).group('SN').decode()
-            if not SN == '10-0147':
-                return False
+            bname = os.path.splitext(os.path.basename(aFrame))[0]
             fstm, rnum, fnum, flen = get_run_info(bname)
-            self.fRnum = rnum                         # Run number
-            self.fStem = fstm                         # Frame name up to the run number
-            self.fPath = aFrame                       # Full path to frame incl. frame name
-            self.fStar = '{:>0{w}}.'.format(1, w=flen)# Number indicating start of a run
-            self.fInfo = (1043, 981, 4096)            # Frame info (rows, cols, offset)
-            self.fSite = 'APS'                        # Facility identifier
-            self.fFunc = read_pilatus_tif             # Frame read function (from _Utility)
-            self.fRota = True                         # rotate the frame upon conversion?
-            return True
         except (ValueError, IndexError):
             return False
+        self.fRnum = rnum                                 # Run number
+        self.fStem = fstm                                 # Frame name up to the run number
+        self.fPath = aFrame                               # Full path to frame incl. frame name
+        self.fStar = '{:>0{w}}.'.format(1, w=flen)        # Number indicating start of a run
+        self.fInfo = (site.rows, site.cols, site.offset)  # Frame info (rows, cols, offset)
+        self.fSite = site.name                            # Facility identifier
+        self.fFunc = site.reader                          # Frame read function (from _Utility)
+        self.fRota = site.rotate                          # rotate the frame upon conversion?
+        return True
     
-    def format_SP8(self, aFrame):
-        logging.info(self.__class__.__name__)
-        '''
-        Check the first file if name is compatible with SPring-8 convention
-        e.g. any_name_rrfff.tif, where rr is the 2 digit run numer: 00 - 99
-        fff is the 3 digit frame number: 001 - 999
-        '''
-        try:
-            fhead, fname = os.path.split(aFrame)
-            bname, ext = os.path.splitext(fname)
-            if not ext == '.tif':
-                return False
-            # open file and check S/N: 10-0163
-            with open(aFrame, 'rb') as oFrame:
-                SN = re.search(b'S/N\s+(?P<SN>\d+\-\d+)', oFrame.read(128)).group('SN').decode()
-            if not SN == '10-0163':
-                return False
-            fstm, rnum, fnum, flen = get_run_info(bname)
-            ########################################
-            ## USE FNUM TO DEFINE START OF RUN!!! ##
-            ########################################
-            self.fRnum = rnum                         # Run number
-            self.fStem = fstm                         # Frame name up to the run number
-            self.fPath = aFrame                       # Full path to frame incl. frame name
-            self.fStar = '{:>0{w}}.'.format(1, w=flen)# Number indicating start of a run
-            self.fInfo = (1043, 981, 4096)            # Frame info (rows, cols, offset)
-            self.fSite = 'SP8'                        # Facility identifier
-            self.fFunc = read_pilatus_tif             # Frame read function (from _Utility)
-            self.fRota = True                         # rotate the frame upon conversion?
-            return True
-        except ValueError:
-            return False
     ##############################################
     ##       END Frame Format definitions       ##
     ##############################################
     
     def mask_prepare_writing(self):
-        logging.info(self.__class__.__name__)
         oPath = os.path.abspath(self.le_output.text())
         self.create_output_directory(oPath)
         aMask = os.path.join(oPath, '{}_xa_{:>02}_0001.sfrm'.format(self.fStem, int(self.fRnum)))
         self.FVObj.convert_patches_to_mask(self.fPath, aMask)
+        if not self.fPath in self.FVObj.masks:
+            return
+        # store the geometry of all masks, the latest is the
+        # default for runs without a mask (headless: mask command)
+        write_mask_geometry(os.path.join(oPath, MASK_GEOMETRY_NAME), self.FVObj.masks, self.FVObj.masks[self.fPath])
+    
+    def mask_load_geometry(self):
+        '''
+         restore the masks of the current runs from
+         the geometry file in the output directory
+        '''
+        gPath = os.path.join(os.path.abspath(self.le_output.text()), MASK_GEOMETRY_NAME)
+        if not os.path.exists(gPath):
+            return
+        try:
+            _, runs = read_mask_geometry(gPath)
+        except (OSError, ValueError):
+            return
+        for aFrame in self.rList:
+            entry = runs.get(os.path.basename(aFrame))
+            if entry is not None and aFrame not in self.FVObj.masks:
+                self.FVObj.masks[aFrame] = entry
     
     def mask_check_stored(self, aFrame):
-        logging.info(self.__class__.__name__)
         if aFrame in self.FVObj.masks:
             self.cb_mask_stored.setChecked(True)
         else:
             self.cb_mask_stored.setChecked(False)
     
     def mask_change_image_abs(self, idx):
-        logging.info(self.__class__.__name__)
         aFrame = os.path.abspath(self.rList[idx])
         self.check_format(aFrame)
         self.mask_check_stored(aFrame)
         self.FVObj.frame_update(aFrame, self.fFunc, *self.fInfo, rotate=self.fRota)
+        self.mask_prefetch(idx)
+    
+    def mask_prefetch(self, idx):
+        '''
+         load the first frames of the neighbouring
+         runs in the background
+        '''
+        neighbours = [self.rList[i] for i in (idx + 1, idx - 1) if 0 <= i < len(self.rList)]
+        self.FVObj.frame_prefetch(neighbours, self.fFunc, *self.fInfo, rotate=self.fRota)
     
     def mask_change_image_rel(self, inc):
-        logging.info(self.__class__.__name__)
         idx = self.cb_mask_fname.currentIndex() + int(inc)
         if idx < 0 or idx >= self.cb_mask_fname.count():
             return
@@ -309,9 +262,7 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
     
     def mask_change_frame_max_int(self):
         #logging.info(self.__class__.__name__)
-        self.FVObj.showFrame.set_clim(vmin=0, vmax=self.hs_mask_int.value())
-        self.FVObj.cmap_max = self.hs_mask_int.value()
-        self.FVObj.draw()
+        self.FVObj.set_contrast(0, self.hs_mask_int.value())
         
     def eventFilter(self, obj, event):
         #logging.info(self.__class__.__name__)
@@ -337,7 +288,6 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         return super(Main_GUI, self).eventFilter(obj, event)
 
     def popup_window(self, _title, _text, _info):
-        logging.info(self.__class__.__name__)
         '''
          _icon:
             QtWidgets.QMessageBox.NoIcon      0 the message box does not have any icon.
@@ -371,7 +321,6 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         msgBox.exec_()
     
     def check_path_link(self):
-        logging.info(self.__class__.__name__)
         '''
          switch between input / output path manipulation
          this function ONLY takes care about the stylesheet
@@ -397,19 +346,20 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
          update frame only if Frameviewer tab is opened
         '''
         if idx == 1:
+            # the overview fits into the scroll area
+            viewport = self.scrollArea.viewport()
+            self.FVObj.fit_size = (viewport.width() - 20, viewport.height() - 20)
             self.mask_check_stored(self.fPath)
             self.FVObj.frame_update(self.fPath, self.fFunc, *self.fInfo, rotate=self.fRota)
+            self.mask_prefetch(self.cb_mask_fname.currentIndex())
         else:
             return
     
     def on_treeView_clicked(self, index):
-        logging.info(self.__class__.__name__)
         '''
-         Current find run_list implementation is flawed yet simple:
-         - iterate over all frames found and find the 001. (SP8) or 
-           0001. (APS) entries that mark the beginning of a new run
-         - if the first frame is missing THIS WILL CRASH!
-           hence, to be fixed later, if ever.
+         - update the input/output paths
+         - index the frames and runs of the input directory
+           (_Index.py), see on_index_ready
         '''
         indexItem = self.model.index(index.row(), 0, index.parent())
         curPath = os.path.abspath(self.model.filePath(indexItem))
@@ -429,28 +379,70 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         self.tb_convert.setEnabled(False)
         
         # find files
-        fDir = QtCore.QDir()
-        fDir.setPath(curPath)
-        fDir.setNameFilters(self.exts)
-        fDir.setFilter(QtCore.QDir.Files | QtCore.QDir.NoDotAndDotDot)
-        fDir.setSorting(QtCore.QDir.Name)
-        nFrames = fDir.count()
+        # - a cached index (directory unchanged) is applied at once
+        # - otherwise the directory is indexed in the background
+        #   to keep the GUI responsive on huge folders
+        index = get_cached_index(curPath)
+        if index is not None:
+            self.on_index_ready(index)
+            return
+        self.tb_convert.setText('Reading Directory ...')
+        worker = self.__class__.Indexing(curPath, self.exts)
+        worker.signals.finished.connect(self.on_index_ready)
+        self.index_pool.start(worker)
+    
+    class Indexing(QtCore.QRunnable):
+        class Signals(QtCore.QObject):
+            '''
+             Custom signals can only be defined on objects derived from QObject
+            '''
+            finished = QtCore.pyqtSignal(object)
         
+        def __init__(self, path, exts):
+            '''
+             path: Directory to index
+             exts: Frame name patterns
+            '''
+            super(self.__class__, self).__init__()
+            self.path = path
+            self.exts = exts
+            self.signals = self.__class__.Signals()
+        
+        def run(self):
+            # scan_directory: returns a RunIndex (see _Index.py)
+            try:
+                with log_duration(log, 'indexed path=%s', self.path):
+                    index = scan_directory(self.path, self.exts)
+            except OSError as e:
+                log.warning('indexing failed path=%s error=%s', self.path, e)
+                return
+            self.signals.finished.emit(index)
+    
+    def on_index_ready(self, index):
+        '''
+         apply the RunIndex of the current input directory
+         - results of a directory that is no longer
+           selected are dropped
+         - the first frame found marks the beginning of a run,
+           missing frames are listed in the tooltip
+        '''
+        if index.path != os.path.abspath(self.le_input.text()):
+            return
+        
+        nFrames = len(index.frames)
         if nFrames > 0:
-            self.fList = [i.absoluteFilePath() for i in fDir.entryInfoList()]
-            if not self.check_format(os.path.abspath(self.fList[0])):
+            self.fList = list(index.frames)
+            if not self.check_format(self.fList[0]):
+                self.tb_convert.setText('Convert Images')
                 return
             
             # Incorrect/Incomplete runs may end in empty self.rList
-            # - e.g. if first frame is missing it's not considered a run!
-            # - self.fStar is updated by self.check_format()
-            self.rList = sorted([os.path.abspath(f) for f in self.fList if self.fStar in f])
-            # generate the mask list here would save calling check_format a lot!
-            # - getting the run name however is non-trivial due to different naming conventions!
-            # - here: simple counting solution - bad idea!
-            #self.mList = [os.path.join(self.le_output.text(), '{}_xa_{:>02}_0001.sfrm'.format(self.fStem, i)) for i in range(len((self.rList)))]
+            # - e.g. if no frame follows the naming convention
+            self.rList = [run.fname for run in index.runs]
             if len(self.rList) == 0:
+                self.tb_convert.setText('Convert Images')
                 return
+            self.mask_load_geometry()
             
             # clearing and adding to combobox triggers it's .currentIndexChanged()
             # block signals to not call self.mask_change_image_abs
@@ -465,30 +457,29 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
             # - the check for the .inf files (SP8 data) is done
             #   by the actual conversion function!
             self.tb_convert.setText('Convert {} Images'.format(nFrames))
+            self.tb_convert.setToolTip('Start the conversion\n' + '\n'.join('{}_{:>02}: frames {} - {}{}'.format(run.stem, run.run, run.first, run.last,
+                                       ', {} missing'.format(len(run.gaps)) if run.gaps else '') for run in index.runs))
             self.tabWidget.setTabEnabled(1, True)
             self.tb_convert.setEnabled(True)
         
-        elif self.paths_active == self.le_input:
-            self.tabWidget.setTabEnabled(1, False)
         else:
-            logging.info('You should not be able to read this message!')
+            self.tb_convert.setText('Convert Images')
+            self.tabWidget.setTabEnabled(1, False)
                     
     def create_output_directory(self, aPath):
-        logging.info(self.__class__.__name__)
         # create output file path
         if not os.path.exists(aPath):
             os.makedirs(aPath)
     
     def disable_user_input(self, toggle):
-        logging.info(self.__class__.__name__)
         self.cb_link.setDisabled(toggle)
         self.cb_overwrite.setDisabled(toggle)
+        self.cb_watch.setDisabled(toggle)
         self.le_input.setDisabled(toggle)
         self.le_output.setDisabled(toggle)
         self.treeView.setDisabled(toggle)
         
     def start_conversion(self):
-        logging.info(self.__class__.__name__)
         '''
           - assign data/sfrm paths
           - get files (again)
@@ -497,7 +488,12 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
              - check image name format
              - create sfrm directory
              - start conversion for facility
+          - in watch mode the button stops watching
         '''
+        if self.watcher is not None:
+            self.stop_watch()
+            return
+        
         #####################################
         ##     THIS MIGHT BE REDUNDANT     ##
         ## CHECK IF REASSIGNMENT IS NEEDED ##
@@ -524,93 +520,70 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
         # pass it on to the conversion function
         overwrite_flag = self.cb_overwrite.isChecked()
         
-        # create a pool of workers
-        #  - pool.apply_async, map doesn't work since we need to specify the output directory!
-        #  - the list 'results' together with 'callback=results.append' is used to track the conversion progress
-        #     - 'while len(results) != _todo' constantly checks results to update the progressbar
-        #  - pool.close(): close the pool when there are no more files left in 'self.fList'
-        #  - pool.join(): wait for remaining processes to finish
-        #########################################
-        ##  Add new format identifiers here!   ##
-        #########################################
         # fork here according to specified facility
         #  - conversion: what _Utility.py function to call
         #  - parameters: parameters for the conversion function
-        #     - path_output, dimension1, dimension2, overwrite_flag
-        #     - more if needed, e.g. SP8 2-th correction value
-        if self.fSite == 'APS':
-            rows, cols, offset = self.fInfo
-            conversion = convert_frame_APS_Bruker
-            beamflux = {}
-            for f in glob.glob(os.path.join(path_input,'*_flux.txt')):
-                with open(f) as ofile:
-                    beamflux[int(f.split('_')[-2])] = [int(float(x)) for x in ofile.read().split()[1::2]]
-            args = [path_output]
-            kwargs = {'rows':rows, 'cols':cols, 'offset':offset, 'overwrite':overwrite_flag, 'beamflux':beamflux}
-        elif self.fSite == 'SP8':
-            rows, cols, offset = self.fInfo
-            # check data collection timestamp
-            with open(self.fPath, 'rb') as ofile:
-                year = int(re.search(b'(\d{4}):\d{2}:\d{2}\s+\d{2}:\d{2}:\d{2}', ofile.read(64)).group(1).decode())
-            SP8_tth_corr = 0.0
-            if year < 2019:
-                SP8_tth_corr = 0.048
-            conversion = convert_frame_SP8_Bruker
-            args = [path_output]
-            kwargs = {'tth_corr':SP8_tth_corr, 'rows':rows, 'cols':cols, 'offset':offset, 'overwrite':overwrite_flag}
-        elif self.fSite == 'DLS':
-            rows, cols, offset = self.fInfo
-            conversion = convert_frame_DLS_Bruker
-            args = [path_output]
-            kwargs = {'rows':rows, 'cols':cols, 'offset':offset, 'overwrite':overwrite_flag}
-        else:
+        #  - shared with the headless batch conversion (_Batch.py)
+        setup = get_conversion(self.fSite, self.fPath, path_input, path_output, overwrite_flag)
+        if setup is None:
             self.popup_window('Information', 'Unknown facility!', '')
             return
+        conversion, args, kwargs = setup
+        rows, cols, offset = self.fInfo
+        kwargs.update({'rows':rows, 'cols':cols, 'offset':offset})
+        
+        if self.cb_watch.isChecked():
+            self.start_watch(path_input, conversion, args, kwargs)
+            return
         
         self.tb_convert.hide()
         self.pb_convert.show()
         self.statusBar.show()
         
-        # Now uses QRunnable and QThreadPool instead of multiprocessing.pool()
+        # read, convert and write overlap (see _Batch.convert_pipeline)
+        # a single QRunnable drives the pipeline, the GUI stays responsive
         self.num_to_convert = len(self.fList)
         self.converted = []
         self.pool = QtCore.QThreadPool()
-        for fname in self.fList:
-            worker = self.__class__.Threading(conversion, fname, args, kwargs)
-            worker.signals.finished.connect(self.conversion_process)
-            self.pool.start(worker)
+        worker = self.__class__.Pipeline(conversion, self.fList, args, kwargs, (self.fFunc, self.fInfo, self.fRota))
+        worker.signals.finished.connect(self.conversion_process)
+        self.pool.start(worker)
 
-    class Threading(QtCore.QRunnable):
+    class Pipeline(QtCore.QRunnable):
         class Signals(QtCore.QObject):
             '''
              Custom signals can only be defined on objects derived from QObject
             '''
             finished = QtCore.pyqtSignal(bool)
-    
-        def __init__(self, fn_conversion, file_name, fn_args, fn_kwargs):
+        
+        def __init__(self, fn_conversion, file_names, fn_args, fn_kwargs, frame_format):
             '''
              fn_conversion: Conversion function
-             file_name:     File name to convert
+             file_names:    File names to convert
              fn_args:       Arguments to pass to the function
              fn_kwargs:     Keywords to pass to the function
+             frame_format:  (reader, (rows, cols, offset), rotate)
+                            sizes the shared memory frame buffers
             '''
             super(self.__class__, self).__init__()
             self.conversion = fn_conversion
-            self.name = file_name
+            self.names = file_names
             self.args = fn_args
             self.kwargs = fn_kwargs
+            self.frame_format = frame_format
             self.signals = self.__class__.Signals()
         
         def run(self):
-            # conversion: returns True/False
-            # signal to conversion_process to track the process
-            self.signals.finished.emit(self.conversion(self.name, *self.args, **self.kwargs))
+            # signal every frame to conversion_process
+            with log_duration(log, 'converted frames=%d', len(self.names), level=logging.INFO):
+                convert_pipeline(self.conversion, self.names, self.args, self.kwargs, frame_format=self.frame_format,
+                                 callback=lambda fname, result, record: self.signals.finished.emit(bool(result)))
     
     def conversion_process(self, finished):
         self.converted.append(finished)
         num_converted = len(self.converted)
         progress = float(num_converted) / float(self.num_to_convert) * 100.0
-        self.pb_convert.setValue(progress)
+        self.pb_convert.setValue(int(progress))
         self.status.setText('{}'.format(os.path.basename(self.fList[num_converted-1])))
         # conversion finished
         if num_converted == self.num_to_convert:
@@ -621,13 +594,84 @@ class Main_GUI(QtWidgets.QMainWindow, uic.loadUiType(os.path.join(os.path.dirnam
             # enable main window elements
             self.disable_user_input(False)
         
+    class WatchSignals(QtCore.QObject):
+        '''
+         Custom signals can only be defined on objects derived from QObject
+        '''
+        finished = QtCore.pyqtSignal()
+    
+    def start_watch(self, path_input, conversion, args, kwargs):
+        '''
+         convert the frames while the detector writes them
+          - the FrameWatcher is polled by a QTimer, it reports
+            frames once they are complete (see _Watch.py)
+          - the frames are converted by a pool of worker
+            processes (WatchPool), a finished task signals
+            watch_process, the GUI thread never waits for it
+          - failed frames are retried (see FrameWatcher)
+          - latency: time from the frame written to the .sfrm
+            written, shown in the status bar
+        '''
+        self.watcher = FrameWatcher(path_input, exts=self.exts)
+        self.watch_signals = self.__class__.WatchSignals()
+        self.watch_signals.finished.connect(self.watch_process)
+        # the callback runs in a thread of the pool, the signal
+        # is queued to the GUI thread
+        self.watch_pool = WatchPool(self.watcher, conversion, args, kwargs,
+                                    callback=lambda future: self.watch_signals.finished.emit())
+        self.converted = []
+        self.latency = []
+        
+        log.info('watch started path=%s', path_input)
+        self.tb_convert.setText('Stop Watching')
+        self.status.setText('Watching {}'.format(path_input))
+        self.statusBar.show()
+        
+        self.watch_timer = QtCore.QTimer()
+        self.watch_timer.timeout.connect(self.watch_process)
+        self.watch_timer.start(500)
+        self.watch_process()
+    
+    def watch_process(self):
+        # signals of a stopped watch
+        if self.watcher is None:
+            return
+        self.watch_pool.add(self.watcher.poll())
+        self.watch_pool.submit()
+        for fname, record in self.watch_pool.collect(timeout=0):
+            self.watch_finished(fname, record)
+    
+    def watch_finished(self, fname, record):
+        self.converted.append(record is not None)
+        if record is not None:
+            self.latency.append(time.time() - record['mtime'] / 1e9)
+            log.info('watch frame=%s latency_ms=%.1f', fname, self.latency[-1] * 1e3)
+            self.status.setText('{} | {} converted | latency {:.2f}s (p95 {:.2f}s)'.format(os.path.basename(fname),
+                                np.count_nonzero(self.converted), self.latency[-1], percentile(sorted(self.latency), 95)))
+        
+    def stop_watch(self):
+        '''
+         queued frames are dropped, frames already handed to
+         a worker process finish in the background
+        '''
+        self.watch_timer.stop()
+        self.watcher.close()
+        self.watcher = None
+        self.watch_pool.shutdown(wait=False)
+        self.watch_pool = None
+        log.info('watch stopped converted=%d failed=%d', np.count_nonzero(self.converted),
+                 len(self.converted) - np.count_nonzero(self.converted))
+        self.popup_window('Information', 'Successfully converted {} images!'.format(np.count_nonzero(self.converted)), '')
+        self.statusBar.hide()
+        self.tb_convert.setText('Convert Images')
+        # enable main window elements
+        self.disable_user_input(False)
+    
     def closeEvent(self, event):
-        logging.info(self.__class__.__name__)
         '''
         User clicks the 'x' mark in window
         '''
         self.exitApp()
 
     def exitApp(self):
-        logging.info(self.__class__.__name__)
         sys.exit()
\ No newline at end of file
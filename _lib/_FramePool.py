@@ -0,0 +1,134 @@
+import os, sys, queue
+from multiprocessing import shared_memory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
+from _Utility import preprocess_shape
+
+# regions of a slot start at a multiple of this (cache line)
+_ALIGN = 64
+
+def slot_layout(rows, cols, offset, rotate=True, decode=False, pad=8):
+    '''
+     layout of a frame slot, sized from the frame geometry
+      - raw: the frame file as read, reused for the encoded
+        image (the raw bytes are not needed anymore by then)
+        at least offset + rows x cols x 4 bytes (.tif) or
+        the size of the encoded int32 image
+      - frame: the decoded frame (int32, rows x cols), only
+        if the frames are compressed (decode, .cbf)
+      - data: the preprocessed frame (int32, see
+        preprocess_shape, pilatus_pad + rotation)
+     returns {region: (start, size, shape)} and the slot size
+    '''
+    shape = preprocess_shape(rows, cols, rotate, pad)
+    sizes = [('raw', max(offset + rows * cols * 4, shape[0] * shape[1] * 4), None),
+             ('frame', rows * cols * 4 if decode else 0, (rows * cols,)),
+             ('data', shape[0] * shape[1] * 4, shape)]
+    layout = {}
+    pos = 0
+    for name, size, region_shape in sizes:
+        layout[name] = (pos, size, region_shape)
+        pos += -(-size // _ALIGN) * _ALIGN
+    return layout, pos
+
+class FrameSlot():
+    '''
+     views of a slot, as used by the conversion
+      - raw: memoryview of the raw region
+      - frame: int32 array the .cbf is decoded into (or None)
+      - data: int32 array the frame is preprocessed into
+      - image: buffer the encoded image is cast into
+        (the raw region)
+    '''
+    def __init__(self, buf, layout):
+        import numpy as np
+        start, size, _ = layout['raw']
+        self.raw = buf[start:start + size]
+        start, size, shape = layout['frame']
+        self.frame = np.frombuffer(buf, np.int32, size // 4, start).reshape(shape) if size else None
+        start, size, shape = layout['data']
+        self.data = np.frombuffer(buf, np.int32, size // 4, start).reshape(shape)
+        self.image = self.raw
+
+class FramePool():
+    '''
+     fixed number of frame buffers (slots) in shared memory
+      - the reader threads read a frame into the raw region
+        of a free slot, the worker processes decode and
+        preprocess it in place and cast the image back into
+        the raw region, the writer writes it from there
+      - only the slot index (and the small header/tables)
+        cross the process boundary, the frame is never pickled
+      - spec: what a worker needs to attach (see attach_slot)
+      - acquire() blocks until a slot is free
+      - close() must be called, it removes the shared memory
+    '''
+    def __init__(self, slots, rows, cols, offset, rotate=True, decode=False):
+        self.layout, self.slot_size = slot_layout(rows, cols, offset, rotate, decode)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, slots * self.slot_size))
+        self.spec = (self.shm.name, self.layout, self.slot_size)
+        self.free = queue.Queue()
+        for index in range(slots):
+            self.free.put(index)
+
+    def acquire(self):
+        return self.free.get()
+
+    def release(self, index):
+        self.free.put(index)
+
+    def raw(self, index, size=None):
+        '''
+         memoryview of the raw region of a slot (first size
+         bytes), must be released before the pool is closed
+        '''
+        start, capacity, _ = self.layout['raw']
+        start += index * self.slot_size
+        if size is None:
+            size = capacity
+        return self.shm.buf[start:start + min(size, capacity)]
+
+    def data(self, index):
+        '''
+         the preprocessed frame of a slot (int32 array view)
+        '''
+        import numpy as np
+        start, size, shape = self.layout['data']
+        start += index * self.slot_size
+        return np.frombuffer(self.shm.buf, np.int32, size // 4, start).reshape(shape)
+
+    def read_into(self, fname, index):
+        '''
+         read a frame into the raw region of a slot
+         returns the number of bytes read and the
+         os.stat_result of the frame, None if the frame
+         does not fit into the slot
+        '''
+        with open(fname, 'rb') as ofile:
+            src = os.fstat(ofile.fileno())
+            if src.st_size > self.layout['raw'][1]:
+                return None, src
+            with self.raw(index, src.st_size) as view:
+                return ofile.readinto(view), src
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # views of an interrupted conversion are still alive,
+            # the mapping is released with the process
+            pass
+        self.shm.unlink()
+
+# shared memory attached by this (worker) process, {name: SharedMemory}
+_ATTACHED = {}
+
+def attach_slot(spec, index):
+    '''
+     FrameSlot of a FramePool in a worker process
+      - the shared memory is attached once per process
+    '''
+    name, layout, slot_size = spec
+    shm = _ATTACHED.get(name)
+    if shm is None:
+        shm = _ATTACHED.setdefault(name, shared_memory.SharedMemory(name=name))
+    return FrameSlot(shm.buf[index * slot_size:(index + 1) * slot_size], layout)
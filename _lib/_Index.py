@@ -0,0 +1,98 @@
+import os, sys, re, fnmatch, logging
+from collections import namedtuple
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
+from _Utility import get_run_info
+from _Profile import log_duration
+
+log = logging.getLogger('pilatus3-fc.index')
+
+# a run of frames
+# - stem, run: name up to the run number and the run number
+# - first, last: first and last frame number found
+# - count: number of frames found
+# - gaps: missing frame numbers between first and last
+# - fname: full path of the first frame found
+Run = namedtuple('Run', 'stem run first last count gaps fname')
+
+class RunIndex():
+    '''
+     frames and runs of a directory
+      - path: the directory
+      - mtime: mtime (ns) of the directory at the time of the scan
+      - frames: full paths of all frames, sorted by name
+      - runs: list of Run, sorted by stem and run number
+    '''
+    def __init__(self, path, mtime, frames, runs):
+        self.path = path
+        self.mtime = mtime
+        self.frames = frames
+        self.runs = runs
+
+# directory index cache, {path: RunIndex}
+_INDEX_CACHE = {}
+
+def build_runs(frames):
+    '''
+     group the frames by stem and run number, frames
+     that don't follow any naming convention are ignored
+    '''
+    found = {}
+    for fname in frames:
+        basename = os.path.splitext(os.path.basename(fname))[0]
+        try:
+            stem, run, num, _ = get_run_info(basename)
+        except (ValueError, IndexError):
+            continue
+        found.setdefault((stem, run), []).append((num, fname))
+    runs = []
+    for (stem, run), nums in sorted(found.items()):
+        nums.sort()
+        first, last = nums[0][0], nums[-1][0]
+        present = set(num for num, _ in nums)
+        gaps = [num for num in range(first, last + 1) if num not in present]
+        runs.append(Run(stem, run, first, last, len(nums), gaps, nums[0][1]))
+    return runs
+
+def get_cached_index(path):
+    '''
+     return the cached RunIndex of path if the directory
+     did not change since (mtime), None otherwise
+    '''
+    path = os.path.abspath(path)
+    index = _INDEX_CACHE.get(path)
+    if index is None:
+        return None
+    try:
+        if os.stat(path).st_mtime_ns != index.mtime:
+            return None
+    except OSError:
+        return None
+    return index
+
+def scan_directory(path, exts):
+    '''
+     index all frames in path matching any of exts
+      - a single os.scandir pass, names are matched against
+        one precompiled regex instead of a glob per extension
+      - the result is cached per directory and reused as long
+        as the directory mtime is unchanged
+     returns a RunIndex
+    '''
+    path = os.path.abspath(path)
+    index = get_cached_index(path)
+    if index is not None:
+        return index
+    # stat before scanning, a frame added during
+    # the scan invalidates the cached index
+    mtime = os.stat(path).st_mtime_ns
+    match = re.compile('|'.join(fnmatch.translate(ext) for ext in exts)).match
+    frames = []
+    with log_duration(log, 'scanned path=%s', path):
+        with os.scandir(path) as it:
+            for entry in it:
+                if match(entry.name) and entry.is_file():
+                    frames.append(entry.path)
+        frames.sort()
+        index = RunIndex(path, mtime, frames, build_runs(frames))
+    _INDEX_CACHE[path] = index
+    return index
@@ -0,0 +1,140 @@
+import os, json, functools, logging
+from time import perf_counter
+from contextlib import contextmanager
+
+# profiling events of this process, None: profiling is disabled
+#  - (stage, start, duration, bytes), perf_counter seconds
+#  - every worker process appends to its own list, no locks
+_EVENTS = None
+
+def enable_profiling():
+    global _EVENTS
+    _EVENTS = []
+
+def disable_profiling():
+    global _EVENTS
+    _EVENTS = None
+
+def drain_events():
+    '''
+     return and clear the events of this process,
+     the process id is added to every event
+     (stage, start, duration, bytes, pid)
+    '''
+    global _EVENTS
+    if _EVENTS is None:
+        return []
+    pid = os.getpid()
+    events = [event + (pid,) for event in _EVENTS]
+    _EVENTS = []
+    return events
+
+def size_of_file(result, args, kwargs):
+    return os.path.getsize(args[0])
+
+def size_of_data(result, args, kwargs):
+    return result[1].nbytes
+
+def profile_stage(stage, size=None):
+    '''
+     decorator recording the wall time of a stage
+      - size(result, args, kwargs): number of bytes
+        processed, only called if profiling is enabled
+      - disabled: a single global lookup per call
+      - nested stages are recorded inclusive, e.g. 'read'
+        of a .cbf contains its 'decode'
+    '''
+    def decorator(funct):
+        @functools.wraps(funct)
+        def wrapper(*args, **kwargs):
+            if _EVENTS is None:
+                return funct(*args, **kwargs)
+            start = perf_counter()
+            result = funct(*args, **kwargs)
+            duration = perf_counter() - start
+            _EVENTS.append((stage, start, duration, size(result, args, kwargs) if size is not None else 0))
+            return result
+        return wrapper
+    return decorator
+
+def percentile(values, q):
+    '''
+     q-th percentile (nearest rank) of a sorted list
+    '''
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+def summarize_events(events, wall=None):
+    '''
+     per stage statistics of the events
+      - count, p50/p95/p99 and total time (s)
+      - MB/s: bytes processed per second spent in the stage
+      - wall: elapsed time of the batch, adds the MB/s read
+        (stage 'fetch' of the pipeline, else 'read') and
+        written (stage 'write') overall
+    '''
+    stages = {}
+    for stage, _, duration, nbytes, _ in events:
+        entry = stages.setdefault(stage, [[], 0])
+        entry[0].append(duration)
+        entry[1] += nbytes
+    summary = {}
+    for stage, (durations, nbytes) in stages.items():
+        durations.sort()
+        total = sum(durations)
+        summary[stage] = {'count':len(durations),
+                          'p50':percentile(durations, 50),
+                          'p95':percentile(durations, 95),
+                          'p99':percentile(durations, 99),
+                          'total':total,
+                          'MB':nbytes / 1e6,
+                          'MB/s':nbytes / 1e6 / total if total > 0 else 0.0}
+    if wall:
+        for stage, name in ((io_stage(summary), 'in'), ('write', 'out')):
+            if stage in summary:
+                summary[stage]['MB/s ' + name] = summary[stage]['MB'] / wall
+    return summary
+
+def io_stage(summary):
+    '''
+     the stage reading the frames from disk
+    '''
+    return 'fetch' if 'fetch' in summary else 'read'
+
+def print_summary(summary):
+    print('{:>10} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'total s', 'MB/s'))
+    for stage, entry in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        print('{:>10} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f}'.format(stage, entry['count'],
+              entry['p50'] * 1e3, entry['p95'] * 1e3, entry['p99'] * 1e3, entry['total'], entry['MB/s']))
+    for stage, name in ((io_stage(summary), 'in'), ('write', 'out')):
+        if 'MB/s ' + name in summary.get(stage, {}):
+            print('{:>10}: {:.1f} MB/s'.format(name, summary[stage]['MB/s ' + name]))
+
+def write_trace(fname, events):
+    '''
+     save the events in the Chrome trace format
+     (chrome://tracing, Perfetto), one row per process
+    '''
+    if not events:
+        return
+    t0 = min(event[1] for event in events)
+    trace = [{'name':stage, 'ph':'X', 'pid':pid, 'tid':pid,
+              'ts':(start - t0) * 1e6, 'dur':duration * 1e6,
+              'args':{'bytes':nbytes}} for stage, start, duration, nbytes, pid in events]
+    with open(fname, 'w') as ofile:
+        json.dump({'traceEvents':trace, 'displayTimeUnit':'ms'}, ofile)
+
+@contextmanager
+def log_duration(log, msg, *args, level=logging.DEBUG):
+    '''
+     log the wall time of a block as 'duration_ms' field
+      - log: logger, msg/args: %-style message and arguments,
+        formatted only if the level is enabled
+      - nothing is timed if the level is disabled
+    '''
+    if not log.isEnabledFor(level):
+        yield
+        return
+    start = perf_counter()
+    yield
+    # stacklevel: report the function containing the block
+    log.log(level, msg + ' duration_ms=%.1f', *args, (perf_counter() - start) * 1e3, stacklevel=3)
@@ -0,0 +1,114 @@
+import os, sys, re, glob
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
+from _Utility import read_pilatus_tif, read_pilatus_cbf,\
+                     convert_frame_APS_Bruker, convert_frame_SP8_Bruker, convert_frame_DLS_Bruker,\
+                     run_headers_APS, run_headers_SP8, run_headers_DLS
+
+class SitePlugin():
+    '''
+     a facility and its frame format
+      - name: facility identifier, e.g. 'APS'
+      - ext: frame extension, e.g. '.tif'
+      - ident: identifier in the head of the frames, the S/N
+        of the detector (.tif) or the _diffrn.id (.cbf)
+      - rows, cols, offset: frame geometry, offset: header bytes
+      - reader: frame read function (read_pilatus_tif/cbf)
+      - rotate: rotate the frame by 90 degrees upon conversion
+      - converter: frame conversion function (convert_frame_*)
+      - options(fPath, path_input): conversion keywords besides
+        overwrite, e.g. the APS beam flux
+      - headers: Bruker headers of the frames of a run
+        (run_headers_*), the goniometer angles are mapped
+        by the axes_*_to_Bruker function of the facility
+    '''
+    def __init__(self, name, ext, ident, rows, cols, offset, reader, rotate, converter, options, headers):
+        self.name = name
+        self.ext = ext
+        self.ident = ident
+        self.rows = rows
+        self.cols = cols
+        self.offset = offset
+        self.reader = reader
+        self.rotate = rotate
+        self.converter = converter
+        self.options = options
+        self.headers = headers
+
+# registered facilities, {name: SitePlugin}
+_SITES = {}
+# {(extension, identifier): SitePlugin}
+_SITES_BY_IDENT = {}
+
+# where the identifier is found in the head of a frame
+# {extension: (number of bytes to read, regex)}
+_IDENT_PATTERNS = {'.tif': (128, re.compile(rb'S/N\s+(\d+\-\d+)')),
+                   '.cbf': (2048, re.compile(rb'_diffrn.id\s+(.+)'))}
+
+def register_site(site):
+    _SITES[site.name] = site
+    _SITES_BY_IDENT[(site.ext, site.ident)] = site
+
+def get_site(name):
+    '''
+     the SitePlugin of a facility, None if it is unknown
+    '''
+    return _SITES.get(name)
+
+def detect_site(fname):
+    '''
+     identify the facility of a frame
+      - the head of the frame is read once, the identifier
+        is looked up by extension and identifier instead of
+        trying every facility in turn
+     returns the SitePlugin or None
+    '''
+    ext = os.path.splitext(fname)[1]
+    if ext not in _IDENT_PATTERNS:
+        return None
+    size, regex = _IDENT_PATTERNS[ext]
+    with open(fname, 'rb') as ofile:
+        match = regex.search(ofile.read(size))
+    if match is None:
+        return None
+    return _SITES_BY_IDENT.get((ext, match.group(1).decode(errors='replace').strip()))
+
+def read_beamflux(path_input):
+    '''
+     APS beam flux is stored in: ExperimentName_rr_flux.txt
+     returns a dict: {run number: [flux of frame 1, flux of frame 2, ...]}
+    '''
+    beamflux = {}
+    for f in glob.glob(os.path.join(path_input, '*_flux.txt')):
+        with open(f) as ofile:
+            beamflux[int(f.split('_')[-2])] = [int(float(x)) for x in ofile.read().split()[1::2]]
+    return beamflux
+
+def get_SP8_tth_corr(fPath):
+    '''
+     2-theta was misaligned at SPring-8 prior to 2019
+     the data collection timestamp is read from the frame
+    '''
+    with open(fPath, 'rb') as ofile:
+        year = int(re.search(rb'(\d{4}):\d{2}:\d{2}\s+\d{2}:\d{2}:\d{2}', ofile.read(64)).group(1).decode())
+    if year < 2019:
+        return 0.048
+    return 0.0
+
+#########################################
+##  Add new format identifiers here!   ##
+#########################################
+register_site(SitePlugin('APS', '.tif', '10-0147', 1043, 981, 4096, read_pilatus_tif, True,
+                         convert_frame_APS_Bruker,
+                         lambda fPath, path_input: {'beamflux':read_beamflux(path_input)},
+                         run_headers_APS))
+register_site(SitePlugin('SP8', '.tif', '10-0163', 1043, 981, 4096, read_pilatus_tif, True,
+                         convert_frame_SP8_Bruker,
+                         lambda fPath, path_input: {'tth_corr':get_SP8_tth_corr(fPath)},
+                         run_headers_SP8))
+register_site(SitePlugin('DLS', '.cbf', 'DLS_I19-1', 1679, 1475, 0, read_pilatus_cbf, False,
+                         convert_frame_DLS_Bruker,
+                         lambda fPath, path_input: {},
+                         run_headers_DLS))
+
+SITES = tuple(_SITES)
+FRAME_EXTS = tuple(dict.fromkeys('*_*' + site.ext for site in _SITES.values()))
@@ -0,0 +1,329 @@
+import os, sys, json, collections, logging
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
+from _Utility import get_run_info, get_sfrm_name, write_bruker_frame, BrukerHeaderTemplate, RunHeaders
+from _Profile import profile_stage
+
+log = logging.getLogger('pilatus3-fc.stack')
+
+# run stack file name: some_name_rr.h5
+STACK_EXT = '.h5'
+
+def get_stack_name(fname, path_stack):
+    '''
+     output file name of the run of a frame: path_stack/some_name_rr.h5
+    '''
+    path_to, frame_name = os.path.split(fname)
+    basename, ext = os.path.splitext(frame_name)
+    frame_stem, frame_run, _, _ = get_run_info(basename)
+    return os.path.join(path_to, path_stack, '{}_{:>02}{}'.format(frame_stem, frame_run, STACK_EXT))
+
+def column_kind(values):
+    '''
+     how a header entry is stored as column
+      - 'array': numpy arrays of equal dtype and length,
+        stored as (frames, n) dataset of that dtype
+      - 'int', 'float', 'str': lists of one type and equal
+        length, restored as lists (a list is formatted as
+        text, e.g. 1 and 1.0 differ)
+      - 'json': everything else (e.g. DETTYPE, mixed types),
+        one JSON string per frame
+    '''
+    import numpy as np
+    first = values[0]
+    if isinstance(first, np.ndarray):
+        if all(isinstance(v, np.ndarray) and v.dtype == first.dtype and v.shape == first.shape for v in values):
+            return 'array'
+        return 'json'
+    if not isinstance(first, list) or any(not isinstance(v, list) or len(v) != len(first) for v in values):
+        return 'json'
+    items = [x for v in values for x in v]
+    if all(isinstance(x, (int, np.integer)) and not isinstance(x, bool) for x in items):
+        return 'int'
+    if all(isinstance(x, (float, np.floating)) for x in items):
+        return 'float'
+    if all(isinstance(x, str) for x in items):
+        return 'str'
+    return 'json'
+
+def _json_default(value):
+    # numpy scalars
+    return value.item()
+
+def _json_entry(entry):
+    import numpy as np
+    if isinstance(entry, np.ndarray):
+        return json.dumps({'dtype':entry.dtype.str, 'values':entry.tolist()})
+    return json.dumps(entry, default=_json_default)
+
+def _entry_from_json(text):
+    import numpy as np
+    entry = json.loads(text)
+    if isinstance(entry, dict):
+        return np.array(entry['values'], dtype=entry['dtype'])
+    return entry
+
+class RunStack():
+    '''
+     a run in a single HDF5 file (NeXus style layout)
+      - /entry/data/data: pixels (frames, rows, cols), int32 as
+        written to the .sfrm before the overflow tables, one
+        chunk per frame, shuffle + gzip (or lzf) compressed
+      - /entry/data/source: path of the source frame
+      - /entry/data/written: frames present (a failed frame
+        leaves a gap)
+      - /entry/bruker/<KEY>: the Bruker header, one column per
+        entry, one row per frame (see column_kind), the entry
+        order is stored in the 'keys' attribute
+      - mode 'w': create(frames, shape) first, the frames are
+        written at their position within the run, the header
+        rows are kept in memory and written on close(), the
+        file is written as temporary file and moved in place
+      - mode 'r': header() reads all columns once, frame(i)
+        returns the header and pixels of frame i, run_headers()
+        the headers of all frames
+    '''
+    def __init__(self, fname, mode='r', compression='gzip', level=1):
+        import h5py
+        self.fname = fname
+        self.mode = mode
+        self.compression = compression
+        self.level = level
+        self.rows = {}
+        self.keys = None
+        self.columns = None
+        if mode == 'w':
+            self.tmpName = '{}.{}.part'.format(fname, os.getpid())
+            self.h5 = h5py.File(self.tmpName, 'w')
+        else:
+            self.h5 = h5py.File(fname, 'r')
+
+    def create(self, frames, shape):
+        import h5py
+        import numpy as np
+        entry = self.h5.create_group('entry')
+        entry.attrs['NX_class'] = 'NXentry'
+        group = entry.create_group('data')
+        group.attrs['NX_class'] = 'NXdata'
+        group.attrs['signal'] = 'data'
+        options = {}
+        if self.compression == 'gzip':
+            options = {'compression':'gzip', 'compression_opts':self.level, 'shuffle':True}
+        elif self.compression == 'lzf':
+            options = {'compression':'lzf', 'shuffle':True}
+        group.create_dataset('data', shape=(frames,) + tuple(shape), dtype=np.int32, chunks=(1,) + tuple(shape), **options)
+        group.create_dataset('source', shape=(frames,), dtype=h5py.string_dtype())
+        group.create_dataset('written', shape=(frames,), dtype=bool)
+        bruker = entry.create_group('bruker')
+        bruker.attrs['NX_class'] = 'NXcollection'
+
+    def __len__(self):
+        return self.h5['entry/data/data'].shape[0]
+
+    def write(self, index, fheader, data, source):
+        '''
+         write frame 'index' of the run
+        '''
+        group = self.h5['entry/data']
+        group['data'][index] = data
+        group['source'][index] = source
+        group['written'][index] = True
+        self.rows[index] = fheader
+
+    def write_header(self):
+        '''
+         write the header rows as columns (see column_kind)
+        '''
+        import h5py
+        import numpy as np
+        if not self.rows:
+            return
+        bruker = self.h5['entry/bruker']
+        indices = sorted(self.rows)
+        self.keys = list(self.rows[indices[0]].keys())
+        bruker.attrs['keys'] = json.dumps(self.keys)
+        # frames that failed get the row of the first frame
+        rows = [self.rows.get(i, self.rows[indices[0]]) for i in range(len(self))]
+        for key in self.keys:
+            values = [row[key] for row in rows]
+            kind = column_kind(values)
+            if kind == 'array':
+                column = bruker.create_dataset(key, data=np.stack(values))
+            elif kind == 'int':
+                column = bruker.create_dataset(key, data=np.array(values, dtype=np.int64))
+            elif kind == 'float':
+                column = bruker.create_dataset(key, data=np.array(values, dtype=np.float64))
+            elif kind == 'str':
+                column = bruker.create_dataset(key, data=np.array(values, dtype=object), dtype=h5py.string_dtype())
+            else:
+                column = bruker.create_dataset(key, data=np.array([_json_entry(v) for v in values], dtype=object),
+                                               dtype=h5py.string_dtype())
+            column.attrs['kind'] = kind
+
+    def header(self):
+        '''
+         read the header columns, {key: (kind, values)}
+        '''
+        if self.columns is None:
+            bruker = self.h5['entry/bruker']
+            self.keys = json.loads(bruker.attrs['keys'])
+            self.columns = {}
+            for key in self.keys:
+                column = bruker[key]
+                kind = column.attrs['kind']
+                if kind in ('str', 'json'):
+                    values = column.asstr()[()]
+                else:
+                    values = column[()]
+                self.columns[key] = (kind, values)
+        return self.columns
+
+    def frame_header(self, index):
+        '''
+         Bruker header (OrderedDict) of frame 'index'
+        '''
+        fheader = collections.OrderedDict()
+        for key, (kind, values) in self.header().items():
+            if kind == 'array':
+                fheader[key] = values[index].copy()
+            elif kind == 'json':
+                fheader[key] = _entry_from_json(values[index])
+            else:
+                fheader[key] = values[index].tolist()
+        return fheader
+
+    def run_headers(self):
+        '''
+         RunHeaders of all frames, the entries equal for all
+         frames are shared, the others are columns
+        '''
+        base = self.frame_header(0)
+        columns = {}
+        for key, (kind, values) in self.header().items():
+            if kind == 'json':
+                if len(set(values)) > 1:
+                    columns[key] = [_entry_from_json(v) for v in values]
+            elif (values != values[0]).any():
+                columns[key] = values if kind == 'array' else values.tolist()
+        return RunHeaders(base, columns, len(self))
+
+    def frame(self, index):
+        '''
+         header, pixels and source of frame 'index'
+        '''
+        group = self.h5['entry/data']
+        return self.frame_header(index), group['data'][index], group['source'].asstr()[index]
+
+    def written(self):
+        return self.h5['entry/data/written'][()]
+
+    def close(self):
+        if self.mode == 'w':
+            try:
+                self.write_header()
+            finally:
+                self.h5.close()
+            os.replace(self.tmpName, self.fname)
+        else:
+            self.h5.close()
+
+class RunStacks():
+    '''
+     the HDF5 stacks of a conversion, one per run
+      - fList: all frames to convert, the position of a frame
+        within its run is known up front, frames may arrive
+        in any order (see convert_pipeline)
+      - a stack is created with the first frame of its run
+        and closed when all frames of the run were handled
+        (written or failed) or on close()
+      - thread-safe, frames that failed are reported by the
+        pipeline stages, the frames are written by the writer
+      - the header rows of an open stack are kept in memory
+    '''
+    def __init__(self, path_stack, fList, compression='gzip', level=1):
+        import threading
+        self.lock = threading.RLock()
+        self.path_stack = path_stack
+        self.compression = compression
+        self.level = level
+        # {fname: (stack name, index)}, {stack name: number of frames}
+        self.position = {}
+        self.frames = collections.OrderedDict()
+        for fname in fList:
+            stack_name = get_stack_name(fname, path_stack)
+            index = self.frames.get(stack_name, 0)
+            self.position[fname] = (stack_name, index)
+            self.frames[stack_name] = index + 1
+        self.stacks = {}
+        self.done = collections.Counter()
+
+    @profile_stage('write', lambda result, args, kwargs: args[3].nbytes)
+    def write(self, fname, fheader, data):
+        stack_name, index = self.position[fname]
+        with self.lock:
+            stack = self.stacks.get(stack_name)
+            if stack is None:
+                stack = self.stacks[stack_name] = RunStack(stack_name, 'w', self.compression, self.level)
+                stack.create(self.frames[stack_name], data.shape)
+            stack.write(index, fheader, data, fname)
+            self.handled(fname)
+
+    def handled(self, fname):
+        '''
+         a frame of fList is done (written or failed)
+        '''
+        stack_name, _ = self.position[fname]
+        with self.lock:
+            self.done[stack_name] += 1
+            if self.done[stack_name] == self.frames[stack_name] and stack_name in self.stacks:
+                self.stacks.pop(stack_name).close()
+                log.debug('stack closed name=%s frames=%d', stack_name, self.frames[stack_name])
+
+    def close(self):
+        with self.lock:
+            for stack in self.stacks.values():
+                stack.close()
+            self.stacks = {}
+
+def parse_frames(selection):
+    '''
+     frame numbers from e.g. ['1', '5-10']
+    '''
+    frames = set()
+    for item in selection:
+        first, _, last = item.partition('-')
+        frames.update(range(int(first), int(last or first) + 1))
+    return frames
+
+def export_stack(fstack, path_sfrm, frames=None, overwrite=False):
+    '''
+     write .sfrm files from a run stack (see RunStack)
+      - frames: frame numbers (header NUMBER) to export,
+        all if None
+      - overwrite: False, existing .sfrm are not written
+        again, i.e. only what is missing is exported
+      - the header columns are read once (see run_headers),
+        every frame is a single chunk read, the output is
+        identical to the .sfrm the conversion would have written
+     returns the number of frames written
+    '''
+    stack = RunStack(fstack, 'r')
+    try:
+        written = stack.written()
+        sources = stack.h5['entry/data/source'].asstr()[()]
+        headers = stack.run_headers()
+        template = BrukerHeaderTemplate()
+        count = 0
+        for index in range(len(stack)):
+            if not written[index]:
+                continue
+            fheader = headers[index]
+            if frames is not None and int(fheader['NUMBER'][0]) not in frames:
+                continue
+            outName = get_sfrm_name(sources[index], path_sfrm)
+            if os.path.exists(outName) and not overwrite:
+                continue
+            write_bruker_frame(outName, fheader, stack.h5['entry/data/data'][index], template=template)
+            count += 1
+    finally:
+        stack.close()
+    return count
@@ -1,3 +1,6 @@
+import re
+from _Profile import profile_stage, size_of_file, size_of_data
+
 def kappa_to_euler(k_omg, kappa, alpha, k_phi):
     '''
      converts kappa to eulerian geometry
@@ -18,6 +21,91 @@ def kappa_to_euler(k_omg, kappa, alpha, k_phi):
     e_phi = np.round(np.rad2deg(r_k_phi + r_delta), 5)
     return e_omg, e_chi, e_phi
 
+#########################################
+##  Add new format identifiers here!   ##
+#########################################
+# goniometer angles of a facility -> Bruker header fields
+# - the angles are scalars (a frame) or arrays (all frames
+#   of a run), the scan axis and increments are per run
+# - returns a dict of the Bruker header fields:
+#    ANGLES, ENDING: setting angles at start/end (2Th, omg, phi, chi)
+#    START, INCREME: scan angle start and increment
+#    AXIS: scan axis, SCAN: scan axis name (TYPE)
+def axes_APS_to_Bruker(omg, kap, alp, phi, inc):
+    '''
+     APS: kappa geometry, phi scan
+    '''
+    # convert Kappa to Euler geometry
+    omg, chi, phi = kappa_to_euler(omg, kap, alp, phi)
+    # APS to Bruker conversion:
+    inc = -inc
+    omg =  90.0 + omg
+    phi = 360.0 - phi
+    tth = 0.0
+    # Phi is the scan axis!
+    sta = phi
+    end = phi + inc
+    return {'ANGLES':[tth, omg, sta, chi],
+            'ENDING':[tth, omg, end, chi],
+            'START':sta,
+            'INCREME':inc,
+            'AXIS':3,
+            'SCAN':'Phi'}
+
+# SP8 rotation axis name -> position in ANGLES / AXIS
+_SP8_AXES = {'Omega':1, 'Chi':2, 'Phi':0}
+
+def axes_SP8_to_Bruker(tth, omg, phi, chi, axis, sta, end, inc, tth_corr=0.0):
+    '''
+     SP8: euler geometry, scan axis by name ('Omega', 'Chi', 'Phi')
+    '''
+    # 2-th were misaligned (pre 2019 data)
+    tth = tth + (tth * tth_corr)
+    # SP8 to Bruker conversion:
+    chi = -chi
+    angles = [tth, omg, phi, chi]
+    angles[_SP8_AXES[axis]] = sta
+    ending = [tth, omg, phi, chi]
+    ending[_SP8_AXES[axis]] = end
+    return {'ANGLES':angles,
+            'ENDING':ending,
+            'START':sta,
+            'INCREME':inc,
+            'AXIS':_SP8_AXES[axis],
+            'SCAN':axis}
+
+def axes_DLS_to_Bruker(tth, omg, inc_omg, phi, inc_phi, chi, inc_chi):
+    '''
+     DLS: euler geometry, the scan axis is the first axis
+     (omega, phi, chi) with a non-zero increment
+    '''
+    import numpy as np
+    # DLS to Bruker conversion:
+    # tth and the increments are per run
+    tth = round(-tth, 4)
+    omg = np.round(180.0 - omg, 4)
+    inc_omg = round(-inc_omg, 4)
+    chi = np.round(-chi, 4)
+    inc_chi = round(-inc_chi, 4)
+    
+    # ending positions
+    end_phi = np.round(phi + inc_phi, 4)
+    end_chi = np.round(chi + inc_chi, 4)
+    end_omg = np.round(omg + inc_omg, 4)
+    end_tth = round(tth, 4)
+    
+    # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
+    ang_nam = ['Omega', 'Phi', 'Chi']
+    ang_inc = [inc_omg, inc_phi, inc_chi]
+    ang_sta = [omg, phi, chi]
+    sca_nam, sca_axs, sca_sta, sca_inc = [(ang_nam[i], int(i+2), ang_sta[i], round(v,4)) for i,v in enumerate(ang_inc) if v != 0.0][0]
+    return {'ANGLES':[tth, omg, phi, chi],
+            'ENDING':[end_tth, end_omg, end_phi, end_chi],
+            'START':sca_sta,
+            'INCREME':sca_inc,
+            'AXIS':sca_axs,
+            'SCAN':sca_nam}
+
 def read_photon2_raw(fname, dim1, dim2, bytecode):
     '''
      Read a PHOTON-II raw image file
@@ -38,63 +126,6 @@ def read_photon2_raw(fname, dim1, dim2, bytecode):
     data = np.fromstring(rawData, bytecode).reshape((dim1, dim2))
     return data
 
-def read_sfrm(fname):
-    '''
-     Read Bruker .sfrm frame
-     - header is returned as continuous stream
-     - information read from header 
-       - detector dimensions (NROWS, NCOLS)
-       - bytes per pixel of image (NPIXELB)
-       - number of pixels in 16 and 32 bit overflowtables (NOVERFL)
-     - data is returned as uint32 2D-Array
-    '''
-    #def chunkstring(string, length):
-    #    '''
-    #     return header as list of tuples
-    #      - splits once at ':'
-    #      - keys and values are stripped strings
-    #      - values with more than 1 entry are un-splitted
-    #    '''
-    #    return list(tuple(map(lambda i: i.strip(), string[0+i:length+i].split(':', 1))) for i in range(0, len(string), length)) 
-    #header_list = chunkstring(header, 80)
-    with open(fname, 'rb') as f:
-        # read the first 512 bytes
-        # find keyword 'HDRBLKS' 
-        header_0 = f.read(512).decode()
-        # header consists of HDRBLKS x 512 byte blocks
-        header_blocks = int(re.findall('\s*HDRBLKS\s*:\s*(\d+)', header_0)[0])
-        # read the remaining header
-        header = header_0 + f.read(header_blocks * 512 - 512).decode()
-        # extract frame info:
-        # - rows, cols (NROWS, NCOLS)
-        # - bytes-per-pixel of image (NPIXELB)
-        # - length of 16 and 32 bit overflow tables (NOVERFL)
-        nrows = int(re.findall('\s*NROWS\s*:\s*(\d+)', header)[0])
-        ncols = int(re.findall('\s*NCOLS\s*:\s*(\d+)', header)[0])
-        npixb = int(re.findall('\s*NPIXELB\s*:\s*(\d+)', header)[0])
-        nov16, nov32 = list(map(int, re.findall('\s*NOVERFL\s*:\s*-*\d+\s+(\d+)\s+(\d+)', header)[0]))
-        # calculate the size of the image
-        im_size = nrows * ncols * npixb
-        # bytes-per-pixel to datatype
-        bpp2dt = [None, np.uint8, np.uint16, None, np.uint32]
-        # reshape data, set datatype to np.uint32
-        data = np.fromstring(f.read(im_size), bpp2dt[npixb]).reshape((nrows, ncols)).astype(np.uint32)
-        # read the 16 bit overflow table
-        # table is padded to a multiple of 16 bytes
-        read_16 = int(np.ceil(nov16 * 2 / 16)) * 16
-        # read the table, trim the trailing zeros
-        table_16 = np.trim_zeros(np.fromstring(f.read(read_16), np.uint16))
-        # read the 32 bit overflow table
-        # table is padded to a multiple of 16 bytes
-        read_32 = int(np.ceil(nov32 * 4 / 16)) * 16
-        # read the table, trim the trailing zeros
-        table_32 = np.trim_zeros(np.fromstring(f.read(read_32), np.uint32))
-        # assign values from 16 bit overflow table
-        data[data == 255] = table_16
-        # assign values from 32 bit overflow table
-        data[data == 65535] = table_32
-        return header, data
-
 def decByteOffset_np(stream, dtype="int64"):
     '''
     The following code is taken from the FabIO package:
@@ -142,29 +173,163 @@ def decByteOffset_np(stream, dtype="int64"):
         stream = stream[idx + shift:]
     return np.ascontiguousarray(np.hstack(listnpa), dtype).cumsum()
 
-def read_pilatus_cbf(fname, *args):
+def decByteOffset_vec(stream, out=None, dtype='int64'):
     '''
-     
+     vectorised CBF byte offset decompression
+     - same output as decByteOffset_np
+     - stream: bytes, bytearray, memoryview or np.uint8 array
+     - out: optional preallocated 1D array (e.g. int32), the
+       decoded values are written into it (len(out) >= #values)
+     - only the exception markers are visited in a python loop,
+       the stream is not re-sliced for every exception
+     byte offset stream:
+     - 1 byte: signed delta (-127 to 127)
+     - 0x80 + 2 bytes: signed 16 bit delta
+     - 0x80 0x00 0x80 + 4 bytes: signed 32 bit delta
+     - 0x80 0x00 0x80 0x00 0x00 0x00 0x80 + 8 bytes: signed 64 bit delta
     '''
     import numpy as np
-    import re
+    raw = np.frombuffer(stream, dtype=np.uint8)
+    size = raw.shape[0]
+    # candidate exception markers, a 0x80 may as well be
+    # part of the payload of a preceding exception
+    cand = np.flatnonzero(raw == 0x80)
+    # length of the exception (marker + payload) at each candidate
+    # compare against the following bytes, padded to not run off the end
+    tail = np.zeros(size + 15, dtype=np.uint8)
+    tail[:size] = raw
+    is32 = (tail[cand + 1] == 0x00) & (tail[cand + 2] == 0x80)
+    is64 = is32 & (tail[cand + 3] == 0x00) & (tail[cand + 4] == 0x00) & (tail[cand + 5] == 0x00) & (tail[cand + 6] == 0x80)
+    clen = np.full(cand.shape[0], 3, dtype=np.int64)
+    clen[is32] = 7
+    clen[is64] = 15
+    # walk the candidates and skip the ones inside a payload
+    real = np.zeros(cand.shape[0], dtype=bool)
+    pos = 0
+    for i, (c, l) in enumerate(zip(cand.tolist(), clen.tolist())):
+        if c < pos:
+            continue
+        real[i] = True
+        pos = c + l
+    mark = cand[real]
+    mlen = clen[real]
+    # drop the payload bytes, keep the marker byte as placeholder
+    # for the exception value
+    keep = np.ones(size + 15, dtype=bool)
+    # payload bytes preceding each marker
+    plen = mlen - 1
+    pre = np.cumsum(plen) - plen
+    if mark.shape[0] > 0:
+        # indices of all payload bytes: mark + 1 ... mark + mlen - 1
+        starts = np.repeat(mark + 1 - pre, plen)
+        keep[starts + np.arange(plen.sum())] = False
+    keep = keep[:size]
+    delta = raw.view(np.int8)[keep].astype(np.int64)
+    # exception values, little endian
+    if mark.shape[0] > 0:
+        value = np.empty(mark.shape[0], dtype=np.int64)
+        for length, first, nbytes, dt in ((3, 1, 2, '<i2'), (7, 3, 4, '<i4'), (15, 7, 8, '<i8')):
+            sel = mlen == length
+            if not sel.any():
+                continue
+            idx = mark[sel, None] + first + np.arange(nbytes)
+            value[sel] = np.ascontiguousarray(tail[idx]).view(dt)[:, 0]
+        # position of the marker within the kept bytes
+        delta[mark - pre] = value
+    if out is None:
+        return np.cumsum(delta, dtype=dtype)
+    return np.cumsum(delta, out=out[:delta.shape[0]], dtype=out.dtype)
+
+@profile_stage('read', size_of_file)
+def read_pilatus_cbf(fname, *args, out=None, mmap=False, stream=None):
+    '''
+     read a Pilatus .cbf (byte offset compressed)
+     - the binary section is decoded without copying the stream
+     - out: optional preallocated (e.g. int32) array the
+       image is decoded into, needs at least dim1 x dim2 entries
+     - mmap: memory-map the file instead of reading it
+     - stream: the raw bytes of the file, already read
+       (bytes or memoryview, e.g. of shared memory)
+    '''
+    if stream is not None:
+        return _decode_pilatus_cbf(stream, out)
+    if mmap:
+        import mmap as _mmap
+        with open(fname, 'rb') as f, _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ) as stream:
+            return _decode_pilatus_cbf(stream, out)
     with open(fname, 'rb') as f:
         stream = f.read()
-    start = stream.find(b'\x0c\x1a\x04\xd5') +4
-    head = str(stream[:start])
+    return _decode_pilatus_cbf(stream, out)
+
+def find_in_stream(stream, sub, block=2**16):
+    '''
+     stream.find(sub) that also works on a memoryview,
+     searched in blocks, i.e. only the head is copied
+    '''
+    if not isinstance(stream, memoryview):
+        return stream.find(sub)
+    for pos in range(0, len(stream), block):
+        idx = bytes(stream[pos:pos + block + len(sub) - 1]).find(sub)
+        if idx >= 0:
+            return pos + idx
+    return -1
+
+@profile_stage('decode', size_of_data)
+def _decode_pilatus_cbf(stream, out=None):
+    '''
+     decode the header and image of a .cbf stream (bytes, mmap or memoryview)
+    '''
+    import re
+    start = find_in_stream(stream, b'\x0c\x1a\x04\xd5') +4
+    head = str(bytes(stream[:start]))
     size = int(re.search('X-Binary-Size:\s+(\d+)', head).group(1))
     dim1 = int(re.search('X-Binary-Size-Fastest-Dimension:\s+(\d+)', head).group(1))
     dim2 = int(re.search('X-Binary-Size-Second-Dimension:\s+(\d+)', head).group(1))
-    data = decByteOffset_np(stream[start:start+size]).reshape((dim2, dim1))
+    if out is not None:
+        out = out.reshape(-1)
+    with memoryview(stream) as view:
+        data = decByteOffset_vec(view[start:start+size], out=out).reshape((dim2, dim1))
     return head, data
 
-def read_pilatus_tif(fname, rows, cols, offset, bytecode):
+class PilatusHeader:
     '''
-     
+     header of a memory-mapped Pilatus .tif
+     - the header is read and decoded on first use: str(header)
+     - the SP8 conversion and the frame viewer never touch it
+    '''
+    def __init__(self, fname, offset):
+        self.fname = fname
+        self.offset = offset
+        self.header = None
+
+    def __str__(self):
+        if self.header is None:
+            with open(self.fname, 'rb') as f:
+                self.header = str(f.read(self.offset))
+        return self.header
+
+@profile_stage('read', size_of_file)
+def read_pilatus_tif(fname, rows, cols, offset, bytecode, mmap=False, stream=None):
+    '''
+     read a Pilatus .tif
+     - fixed size header of 'offset' bytes followed by the image
+     - mmap: the image is memory-mapped at 'offset' (read-only
+       np.memmap) instead of being read and copied, the header
+       is returned as PilatusHeader and decoded lazily
+       (the file is read on first access, i.e. the profiled
+       'read' stage excludes the I/O)
+     - stream: the raw bytes of the file, already read
+       (bytes or memoryview), the image is a view of it
     '''
     import numpy as np
+    if stream is not None:
+        data = np.frombuffer(stream, bytecode, rows * cols, offset).reshape((rows, cols))
+        return str(bytes(stream[:offset])), data
+    if mmap:
+        data = np.memmap(fname, dtype=bytecode, mode='r', offset=offset, shape=(rows, cols))
+        return PilatusHeader(fname, offset), data
     # translate the bytecode to the bytes per pixel
-    bpp = len(np.array(0, bytecode).tostring())
+    bpp = np.dtype(bytecode).itemsize
     # determine the image size
     size = rows * cols * bpp
     # open the file
@@ -176,7 +341,7 @@ def read_pilatus_tif(fname, rows, cols, offset, bytecode):
     header = str(h)
     # reshape the image into 2d array (rows, cols)
     # dtype = bytecode
-    data = np.fromstring(rawData, bytecode).reshape((rows, cols))
+    data = np.frombuffer(rawData, bytecode).reshape((rows, cols))
     return header, data
 
 def pilatus_pad(data, fill=-2, pad=8):
@@ -195,6 +360,81 @@ def pilatus_pad(data, fill=-2, pad=8):
     padded[offset_rows:offset_rows + rows, offset_cols:offset_cols + cols] = data
     return padded, offset_rows, offset_cols
 
+def preprocess_shape(rows, cols, rotate=True, pad=8):
+    '''
+     shape of the frame after preprocess_frame
+     (to preallocate the output buffer)
+    '''
+    import numpy as np
+    pad_rows = int(np.ceil(rows / pad) * pad)
+    pad_cols = int(np.ceil(cols / pad) * pad)
+    if rotate:
+        return pad_cols, pad_rows
+    return pad_rows, pad_cols
+
+@profile_stage('preprocess', lambda result, args, kwargs: result[0].nbytes)
+def preprocess_frame(data, rotate=True, pad=8, out=None):
+    '''
+     get the frame saint ready, replaces:
+      pilatus_pad -> np.rot90 -> dead/bad pixels to zero
+      -> baseline offset -> header statistics
+     - the frame is padded (multiple of 'pad' pixels), rotated
+       by 90 degrees (if rotate) and copied into 'out' with a
+       single strided copy, 'out' is allocated if not given
+       (np.int32, shape: preprocess_shape)
+     - dead areas (-1) and bad pixels (-2) are set to zero,
+       the padding is zero
+     - the baseline offset is applied, the statistics are
+       derived from the same reductions:
+        MINIMUM is zero by definition, MAXIMUM/MAXXY from a
+        single argmax, NCOUNTS/NOVER64 are shifted analytically
+     returns: data, offset_rows, offset_cols, stats
+      - offset_rows/cols: padding offsets (unrotated frame)
+      - stats: BASELINE, MINIMUM, MAXIMUM, MAXXY, NCOUNTS, NOVER64
+    '''
+    import numpy as np
+    (rows, cols) = data.shape
+    pad_rows = int(np.ceil(rows / pad) * pad)
+    pad_cols = int(np.ceil(cols / pad) * pad)
+    offset_rows = (pad_rows - rows) // 2
+    offset_cols = (pad_cols - cols) // 2
+    if out is None:
+        out = np.empty(preprocess_shape(rows, cols, rotate, pad), dtype=np.int32)
+    # view of 'out' in the orientation of the raw frame
+    # writing to it places the frame rotated into 'out'
+    if rotate:
+        view = np.rot90(out, k=1, axes=(0, 1))
+    else:
+        view = out
+    # zero the padding only
+    view[:offset_rows, :] = 0
+    view[offset_rows + rows:, :] = 0
+    view[:, :offset_cols] = 0
+    view[:, offset_cols + cols:] = 0
+    view[offset_rows:offset_rows + rows, offset_cols:offset_cols + cols] = data
+    # the dead areas are flagged -1
+    # bad pixels are flagged -2
+    np.maximum(out, 0, out=out, where=out >= -2)
+    # scale the data to avoid underflow tables
+    # should yield zero for Pilatus3 images!
+    # the minimum after the shift is zero
+    baseline_offset = -1 * int(out.min())
+    # position of the first maximum, X/Y pixel of maximum counts
+    idx_max = int(out.argmax())
+    data_max = int(out.flat[idx_max])
+    # statistics before the shift, corrected analytically
+    ncounts = int(out.sum(dtype=np.int64))
+    nover64 = int(np.count_nonzero(out > 64000 - baseline_offset))
+    if baseline_offset != 0:
+        out += baseline_offset
+    stats = {'BASELINE': baseline_offset,
+             'MINIMUM' : 0,
+             'MAXIMUM' : data_max + baseline_offset,
+             'MAXXY'   : np.array(np.unravel_index(idx_max, out.shape), dtype=np.float64),
+             'NCOUNTS' : ncounts + baseline_offset * out.size,
+             'NOVER64' : nover64}
+    return out, offset_rows, offset_cols, stats
+
 def bruker_header():
     '''
      default Bruker header
@@ -292,175 +532,805 @@ def bruker_header():
     header['LEPTOS']  = ['']
     header['CFR']     = ['']
     return header
+
+class RunHeaders:
+    '''
+     Bruker headers of the frames of a run
+     - base: the entries shared by all frames (OrderedDict, see
+       bruker_header), built once per run
+     - columns: {key: column} the entries that change from frame
+       to frame, arrays (frames, n) or lists of per-frame entries,
+       every key is an entry of base
+     - headers[i]: the header of frame i, a shallow copy of base
+       with row i of the columns (array rows are views), iterating
+       yields the headers of all frames
+     - frames: number of frames, default: length of the columns
+     - the entries are shared, a header must not be changed in place
+    '''
+    def __init__(self, base, columns, frames=None):
+        self.base = base
+        self.columns = columns
+        if frames is None:
+            frames = min((len(column) for column in columns.values()), default=0)
+        self.frames = frames
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, index):
+        fheader = self.base.copy()
+        for key, column in self.columns.items():
+            fheader[key] = column[index]
+        return fheader
+
+    def __iter__(self):
+        for index in range(self.frames):
+            yield self[index]
+
+def angle_columns(angles, frames):
+    '''
+     (frames, n) column of n angles, an angle is either
+     an array (per frame) or a scalar (per run)
+    '''
+    import numpy as np
+    column = np.empty((frames, len(angles)), dtype=np.float64)
+    for i, angle in enumerate(angles):
+        column[:, i] = angle
+    return column
+
+def frame_columns(frames, stats):
+    '''
+     header columns of the frames of a run (see RunHeaders)
+     - frames: (basename, frame number, created) per frame
+     - stats: statistics per frame (see preprocess_frame)
+     the flux (NCOUNTS) is zero, the angles are added by the
+     run_headers_* functions
+    '''
+    import numpy as np
+    count = len(frames)
+    ncounts = np.zeros((count, 2), dtype=np.int64)
+    ncounts[:, 0] = [s['NCOUNTS'] for s in stats]
+    nover64 = np.zeros((count, 3), dtype=np.int64)
+    nover64[:, 0] = [s['NOVER64'] for s in stats]
+    nexp = np.zeros((count, 5), dtype=np.int64)
+    nexp[:, 0] = 1
+    nexp[:, 2] = [s['BASELINE'] for s in stats]
+    return {'FILENAM':[[name] for name, _, _ in frames],
+            'NUMBER' :[[number] for _, number, _ in frames],
+            'CREATED':[[created] for _, _, created in frames],
+            'NEXP'   :nexp,
+            'MAXXY'  :np.array([s['MAXXY'] for s in stats], dtype=np.float64).reshape(count, 2),
+            'MAXIMUM':[[s['MAXIMUM']] for s in stats],
+            'MINIMUM':[[s['MINIMUM']] for s in stats],
+            'NCOUNTS':ncounts,
+            'NOVER64':nover64}
     
-def write_bruker_frame(fname, fheader, fdata):
+_BRUKER_FORMAT = {(1, 'i8'): '{:<71d} ',
+                  (2, 'i8'): '{:<35d} {:<35d} ',
+                  (3, 'i8'): '{:<23d} {:<23d} {:<23d} ',
+                  (4, 'i8'): '{:<17d} {:<17d} {:<17d} {:<17d} ',
+                  (5, 'i8'): '{:<13d} {:<13d} {:<13d} {:<13d} {:<13d}   ',
+                  (6, 'i8'): '{:<11d} {:<11d} {:<11d} {:<11d} {:<11d} {:<11d} ',
+                  (1, 'i4'): '{:<71d} ',
+                  (2, 'i4'): '{:<35d} {:<35d} ',
+                  (3, 'i4'): '{:<23d} {:<23d} {:<23d} ',
+                  (4, 'i4'): '{:<17d} {:<17d} {:<17d} {:<17d} ',
+                  (5, 'i4'): '{:<13d} {:<13d} {:<13d} {:<13d} {:<13d}   ',
+                  (6, 'i4'): '{:<11d} {:<11d} {:<11d} {:<11d} {:<11d} {:<11d} ',
+                  (1, 'f8'): '{:<71f} ',
+                  (2, 'f8'): '{:<35f} {:<35f} ',
+                  (3, 'f8'): '{:<23f} {:<23f} {:<23f} ',
+                  (4, 'f8'): '{:<17f} {:<17f} {:<17f} {:<17f} ',
+                  (5, 'f8'): '{:<13f} {:<13f} {:<13f} {:<13f} {:<15f} '}
+
+def format_bruker_entry(name, entry):
     '''
-     write a bruker image
+     format a single header entry
+     returns a list of (80 character) lines
     '''
     import numpy as np
+    headers = []
+    # TITLE has multiple lines
+    if name == 'TITLE':
+        name = '{:<7}:'.format(name)
+        number = len(entry)
+        for line in range(8):
+            if number < line:
+                headers.append(''.join((name, '{:<72}'.format(entry[line]))))
+            else:
+                headers.append(''.join((name, '{:<72}'.format(' '))))
+        return headers
+
+    # DETTYPE Mixes Entry Types
+    if name == 'DETTYPE':
+        name = '{:<7}:'.format(name)
+        string = '{:<20s} {:<11f} {:<11f} {:<1d} {:<11f} {:<10f} {:<1d} '.format(*entry)
+        headers.append(''.join((name, string)))
+        return headers
     
-    ########################
-    ## write_bruker_frame ##
-    ##     FUNCTIONS      ##
-    ########################
-    def pad_table(table, bpp):
+    # format the name
+    name = '{:<7}:'.format(name)
+    
+    # pad entries
+    if type(entry) == list or type(entry) == str:
+        headers.append(''.join(name + '{:<72}'.format(entry[0])))
+        return headers
+    
+    # fill empty fields
+    if entry.shape[0] == 0:
+        headers.append(name + '{:72}'.format(' '))
+        return headers
+    
+    # kind and size, e.g. 'i8': np.int64, 'f8': np.float64
+    dtype = '{}{}'.format(entry.dtype.kind, entry.dtype.itemsize)
+    
+    # if line has too many entries e.g.
+    # OCTMASK(8): np.int64
+    # CELL(6), MATRIX(9), DETPAR(6), ESDCELL(6): np.float64
+    # write the first 6 (np.int64) / 5 (np.float64) entries
+    # and the remainder in a new line/entry
+    if entry.shape[0] > 6 and entry.dtype == np.int64:
+        while entry.shape[0] > 6:
+            format_string = _BRUKER_FORMAT[(6, dtype)]
+            headers.append(''.join(name + format_string.format(*entry[:6].tolist())))
+            entry = entry[6:]
+    elif entry.shape[0] > 5 and entry.dtype == np.float64:
+        while entry.shape[0] > 5:
+            format_string = _BRUKER_FORMAT[(5, dtype)]
+            headers.append(''.join(name + format_string.format(*entry[:5].tolist())))
+            entry = entry[5:]
+    
+    # format line
+    format_string = _BRUKER_FORMAT[(entry.shape[0], dtype)]
+    headers.append(''.join(name + format_string.format(*entry.tolist())))
+    return headers
+
+def format_bruker_ending(headers):
+    '''
+     pad the header lines to a multiple of 512 bytes
+    '''
+    # add header ending
+    if headers[-1][:3] == 'CFR':
+        headers = headers[:-1]
+    padding = 512 - (len(headers) * 80 % 512)
+    end = '\x1a\x04'
+    if padding <= 80:
+        start = 'CFR: HDR: IMG: '
+        padding -= len(start) + 2
+        dots = ''.join(['.'] * padding)
+        headers.append(start + dots + end)
+    else:
+        while padding > 80:
+            headers.append(end + ''.join(['.'] * 78))
+            padding -= 80
+        if padding != 0:
+            headers.append(end + ''.join(['.'] * (padding - 2)))
+    return headers
+
+@profile_stage('header', lambda result, args, kwargs: len(result))
+def format_bruker_header(fheader):
+    '''
+     format the Bruker header (dict) to a string
+    '''
+    headers = []
+    for name, entry in fheader.items():
+        headers.extend(format_bruker_entry(name, entry))
+    return ''.join(format_bruker_ending(headers))
+
+class BrukerHeaderTemplate:
+    '''
+     precompiled Bruker header for a run
+     - the full header is rendered once (first frame) and the
+       byte slot of every entry is stored
+     - the entries in 'dynamic' change from frame to frame and
+       are always re-formatted and patched into the buffer
+     - all other entries are compared to the values they were
+       rendered with and only re-formatted if they changed
+     - if a re-formatted entry does not fit its slot (different
+       number of lines, too wide), the header is re-compiled
+     - render() is thread-safe (QThreadPool) and returns bytes
+    '''
+    dynamic = ('NUMBER', 'START', 'ANGLES', 'ENDING', 'NCOUNTS', 'MAXIMUM', 'MINIMUM',
+               'MAXXY', 'NOVERFL', 'NOVER64', 'NEXP', 'CREATED', 'FILENAM')
+
+    def __init__(self, dynamic=None):
+        import threading
+        if dynamic is not None:
+            self.dynamic = tuple(dynamic)
+        self.lock = threading.Lock()
+        self.keys = None
+        self.buffer = None
+        self.slots = {}
+        self.values = {}
+
+    @staticmethod
+    def freeze(entry):
         '''
-         pads a table with zeros to a multiple of 16 bytes
+         hashable/comparable copy of a header entry
         '''
-        padded = np.zeros(int(np.ceil(table.size * abs(bpp) / 16)) * 16 // abs(bpp)).astype(_BPP_TO_DT[bpp])
-        padded[:table.size] = table
-        return padded
-        
-    def format_bruker_header(fheader):
+        if type(entry) == list or type(entry) == str:
+            return tuple(entry)
+        return (entry.dtype.str, entry.tobytes())
+
+    def compile(self, fheader):
         '''
-         
+         render the full header, store the slot of each entry
         '''
-        format_dict = {(1,   'int64'): '{:<71d} ',
-                       (2,   'int64'): '{:<35d} {:<35d} ',
-                       (3,   'int64'): '{:<23d} {:<23d} {:<23d} ',
-                       (4,   'int64'): '{:<17d} {:<17d} {:<17d} {:<17d} ',
-                       (5,   'int64'): '{:<13d} {:<13d} {:<13d} {:<13d} {:<13d}   ',
-                       (6,   'int64'): '{:<11d} {:<11d} {:<11d} {:<11d} {:<11d} {:<11d} ',
-                       (1,   'int32'): '{:<71d} ',
-                       (2,   'int32'): '{:<35d} {:<35d} ',
-                       (3,   'int32'): '{:<23d} {:<23d} {:<23d} ',
-                       (4,   'int32'): '{:<17d} {:<17d} {:<17d} {:<17d} ',
-                       (5,   'int32'): '{:<13d} {:<13d} {:<13d} {:<13d} {:<13d}   ',
-                       (6,   'int32'): '{:<11d} {:<11d} {:<11d} {:<11d} {:<11d} {:<11d} ',
-                       (1, 'float64'): '{:<71f} ',
-                       (2, 'float64'): '{:<35f} {:<35f} ',
-                       (3, 'float64'): '{:<23f} {:<23f} {:<23f} ',
-                       (4, 'float64'): '{:<17f} {:<17f} {:<17f} {:<17f} ',
-                       (5, 'float64'): '{:<13f} {:<13f} {:<13f} {:<13f} {:<15f} '}
-    
         headers = []
+        self.slots = {}
+        self.values = {}
+        pos = 0
         for name, entry in fheader.items():
-            # TITLE has multiple lines
-            if name == 'TITLE':
-                name = '{:<7}:'.format(name)
-                number = len(entry)
-                for line in range(8):
-                    if number < line:
-                        headers.append(''.join((name, '{:<72}'.format(entry[line]))))
-                    else:
-                        headers.append(''.join((name, '{:<72}'.format(' '))))
-                continue
-    
-            # DETTYPE Mixes Entry Types
-            if name == 'DETTYPE':
-                name = '{:<7}:'.format(name)
-                string = '{:<20s} {:<11f} {:<11f} {:<1d} {:<11f} {:<10f} {:<1d} '.format(*entry)
-                headers.append(''.join((name, string)))
-                continue
-            
-            # format the name
-            name = '{:<7}:'.format(name)
-            
-            # pad entries
-            if type(entry) == list or type(entry) == str:
-                headers.append(''.join(name + '{:<72}'.format(entry[0])))
-                continue
-            
-            # fill empty fields
-            if entry.shape[0] == 0:
-                headers.append(name + '{:72}'.format(' '))
-                continue
-            
-            # if line has too many entries e.g.
-            # OCTMASK(8): np.int64
-            # CELL(6), MATRIX(9), DETPAR(6), ESDCELL(6): np.float64
-            # write the first 6 (np.int64) / 5 (np.float64) entries
-            # and the remainder in a new line/entry
-            if entry.shape[0] > 6 and entry.dtype == np.int64:
-                while entry.shape[0] > 6:
-                    format_string = format_dict[(6, str(entry.dtype))]
-                    headers.append(''.join(name + format_string.format(*entry[:6])))
-                    entry = entry[6:]
-            elif entry.shape[0] > 5 and entry.dtype == np.float64:
-                while entry.shape[0] > 5:
-                    format_string = format_dict[(5, str(entry.dtype))]
-                    headers.append(''.join(name + format_string.format(*entry[:5])))
-                    entry = entry[5:]
-            
-            # format line
-            format_string = format_dict[(entry.shape[0], str(entry.dtype))]
-            headers.append(''.join(name + format_string.format(*entry)))
-    
-        # add header ending
+            lines = format_bruker_entry(name, entry)
+            size = sum(len(l) for l in lines)
+            self.slots[name] = (pos, pos + size)
+            if name not in self.dynamic:
+                self.values[name] = self.freeze(entry)
+            headers.extend(lines)
+            pos += size
+        self.keys = list(fheader.keys())
+        # a trailing CFR entry is dropped by the ending
         if headers[-1][:3] == 'CFR':
-            headers = headers[:-1]
-        padding = 512 - (len(headers) * 80 % 512)
-        end = '\x1a\x04'
-        if padding <= 80:
-            start = 'CFR: HDR: IMG: '
-            padding -= len(start) + 2
-            dots = ''.join(['.'] * padding)
-            headers.append(start + dots + end)
-        else:
-            while padding > 80:
-                headers.append(end + ''.join(['.'] * 78))
-                padding -= 80
-            if padding != 0:
-                headers.append(end + ''.join(['.'] * (padding - 2)))
-        return ''.join(headers)
-    ########################
-    ## write_bruker_frame ##
-    ##   FUNCTIONS END    ##
-    ########################
-    
-    # assign bytes per pixel to numpy integers
-    # int8   Byte (-128 to 127)
-    # int16  Integer (-32768 to 32767)
-    # int32  Integer (-2147483648 to 2147483647)
-    # uint8  Unsigned integer (0 to 255)
-    # uint16 Unsigned integer (0 to 65535)
-    # uint32 Unsigned integer (0 to 4294967295)
-    _BPP_TO_DT = {1: np.uint8,
-                  2: np.uint16,
-                  4: np.uint32,
-                 -1: np.int8,
-                 -2: np.int16,
-                 -4: np.int32}
-    
+            self.slots.pop(self.keys[-1])
+            self.values.pop(self.keys[-1], None)
+        headers = format_bruker_ending(headers)
+        self.buffer = bytearray(''.join(headers).encode('ASCII'))
+
+    def patch(self, name, entry):
+        '''
+         re-format an entry into its slot
+         returns False if it does not fit
+        '''
+        start, end = self.slots[name]
+        line = ''.join(format_bruker_entry(name, entry)).encode('ASCII')
+        if len(line) != end - start:
+            return False
+        self.buffer[start:end] = line
+        return True
+
+    @profile_stage('header', lambda result, args, kwargs: len(result))
+    def render(self, fheader):
+        '''
+         returns the formatted header as bytes
+        '''
+        with self.lock:
+            if self.buffer is None or list(fheader.keys()) != self.keys:
+                self.compile(fheader)
+                return bytes(self.buffer)
+            for name, entry in fheader.items():
+                if name not in self.slots:
+                    continue
+                if name not in self.dynamic:
+                    value = self.freeze(entry)
+                    if value == self.values[name]:
+                        continue
+                    self.values[name] = value
+                if not self.patch(name, entry):
+                    self.compile(fheader)
+                    break
+            return bytes(self.buffer)
+
+def get_header_template(key):
+    '''
+     per-run BrukerHeaderTemplate (per process, see RunCache)
+     key: e.g. (path_sfrm, frame_stem, frame_run)
+    '''
+    template = _HEADER_TEMPLATES.get(key)
+    if template is None:
+        template = _HEADER_TEMPLATES.setdefault(key, BrukerHeaderTemplate())
+    return template
+
+# assign bytes per pixel to numpy integers
+# int8   Byte (-128 to 127)
+# int16  Integer (-32768 to 32767)
+# int32  Integer (-2147483648 to 2147483647)
+# uint8  Unsigned integer (0 to 255)
+# uint16 Unsigned integer (0 to 65535)
+# uint32 Unsigned integer (0 to 4294967295)
+_BPP_TO_DT = {1: 'uint8',
+              2: 'uint16',
+              4: 'uint32',
+             -1: 'int8',
+             -2: 'int16',
+             -4: 'int32'}
+
+def pad_table(table, bpp):
+    '''
+     pads a table with zeros to a multiple of 16 bytes
+    '''
+    import numpy as np
+    padded = np.zeros(-(-table.size * abs(bpp) // 16) * 16 // abs(bpp), dtype=_BPP_TO_DT[bpp])
+    padded[:table.size] = table
+    return padded
+
+def cast_image(fdata, dtype, out=None):
+    '''
+     fdata.astype(dtype), cast into the buffer 'out' if given
+     the image is C-contiguous (written without a copy,
+     see write_bruker_buffers), e.g. a rotated mask
+    '''
+    import numpy as np
+    if out is None:
+        return fdata.astype(dtype, order='C')
+    image = np.frombuffer(out, dtype, fdata.size).reshape(fdata.shape)
+    np.copyto(image, fdata, casting='unsafe')
+    return image
+
+@profile_stage('tables')
+def build_bruker_tables(fdata, bpp, bpp_u=1, underflow=False, out=None):
+    '''
+     classify all pixels once and build the Bruker tables
+     - the pixels that do not fit into 'bpp' bytes are located
+       with a single comparison, the split into the 16 and 32 bit
+       overflow tables is done on those (few) pixels only
+     - the image is cast to 'bpp' bytes and the overflowing pixels
+       are set to 255 (16 bit table) / 65535 (32 bit table)
+     - underflow: values <= 0 go to the underflow table ('bpp_u'
+       bytes), negative values are set to zero
+     - the tables are padded to a multiple of 16 bytes
+     - fdata is not modified
+     - out: buffer the image is cast into (e.g. shared memory)
+     returns: image, table_underflow, table_16, table_32,
+              [#underflows, #16 bit overflows, #32 bit overflows]
+    '''
+    import numpy as np
+    noverfl = [0, 0, 0]
+    table_underflow = table_16 = table_32 = None
+    if underflow:
+        data_underflow = fdata[fdata <= 0]
+        noverfl[0] = data_underflow.shape[0]
+        table_underflow = pad_table(data_underflow, -1 * bpp_u)
+        fdata = np.maximum(fdata, 0)
+    if bpp >= 4:
+        return cast_image(fdata, _BPP_TO_DT[bpp], out), table_underflow, table_16, table_32, noverfl
+    # everything that does not fit into bpp bytes
+    limit = 255 if bpp < 2 else 65535
+    idx_over = np.flatnonzero(fdata >= limit)
+    data_over = fdata.ravel()[idx_over]
+    # 32 bit overflow table
+    is_32 = data_over >= 65535
+    data_over_uint16 = data_over[is_32]
+    noverfl[2] = data_over_uint16.shape[0]
+    table_32 = pad_table(data_over_uint16, 4)
+    # 16 bit overflow table, the 32 bit overflows are flagged 65535
+    if bpp < 2:
+        noverfl[1] = data_over.shape[0]
+        table_16 = pad_table(np.minimum(data_over, 65535), 2)
+    # shrink data to desired bpp
+    image = cast_image(fdata, _BPP_TO_DT[bpp], out)
+    image.flat[idx_over] = limit
+    return image, table_underflow, table_16, table_32, noverfl
+
+def encode_bruker_frame(fheader, fdata, template=None, out=None):
+    '''
+     the buffers of a bruker image, in file order:
+     header (bytes), image, underflow and overflow tables
+     - template: BrukerHeaderTemplate of the run, the header
+       is patched instead of formatted from scratch
+     - out: buffer the image is cast into (see FrameSlot)
+    '''
     # read the bytes per pixel
     # frame data (bpp), underflow table (bpp_u)
     bpp, bpp_u = fheader['NPIXELB']
     
     # generate underflow table
     # does not work as APEXII reads the data as uint8/16/32!
+    underflow = fheader['NOVERFL'][0] >= 0
+    
+    # generate the tables, shrink data to desired bpp
+    fdata, table_underflow, table_data_uint16, table_data_uint32, noverfl = build_bruker_tables(fdata, bpp, bpp_u, underflow, out)
+    # a new entry, the entries of a header may be shared
+    # by the frames of a run (see RunHeaders)
+    entry = fheader['NOVERFL'].copy()
+    if underflow:
+        entry[0] = noverfl[0]
+    if bpp < 4:
+        entry[2] = noverfl[2]
+    if bpp < 2:
+        entry[1] = noverfl[1]
+    fheader['NOVERFL'] = entry
+    
+    # format the header
+    if template is None:
+        header = format_bruker_header(fheader).encode('ASCII')
+    else:
+        header = template.render(fheader)
+    buffers = [header, fdata]
     if fheader['NOVERFL'][0] >= 0:
-        data_underflow = fdata[fdata <= 0]
-        fheader['NOVERFL'][0] = data_underflow.shape[0]
-        table_underflow = pad_table(data_underflow, -1 * bpp_u)
-        fdata[fdata < 0] = 0
+        buffers.append(table_underflow)
+    if bpp < 2 and fheader['NOVERFL'][1] > 0:
+        buffers.append(table_data_uint16)
+    if bpp < 4 and fheader['NOVERFL'][2] > 0:
+        buffers.append(table_data_uint32)
+    return buffers
 
-    # generate 32 bit overflow table
-    if bpp < 4:
-        data_over_uint16 = fdata[fdata >= 65535]
-        table_data_uint32 = pad_table(data_over_uint16, 4)
-        fheader['NOVERFL'][2] = data_over_uint16.shape[0]
-        fdata[fdata >= 65535] = 65535
+@profile_stage('write', size_of_file)
+def write_bruker_buffers(fname, buffers):
+    '''
+     write the buffers of a bruker image (see encode_bruker_frame)
+     - the arrays are written without a copy (buffer protocol)
+    '''
+    # write to a temporary file and move it in place
+    # a killed job never leaves a truncated frame behind
+    import os
+    tmpName = '{}.{}.part'.format(fname, os.getpid())
+    try:
+        with open(tmpName, 'wb') as brukerFrame:
+            for buffer in buffers:
+                brukerFrame.write(buffer)
+        os.replace(tmpName, fname)
+    except BaseException:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
 
-    # generate 16 bit overflow table
-    if bpp < 2:
-        data_over_uint8 = fdata[fdata >= 255]
-        table_data_uint16 = pad_table(data_over_uint8, 2)
-        fheader['NOVERFL'][1] = data_over_uint8.shape[0]
-        fdata[fdata >= 255] = 255
+def write_bruker_frame(fname, fheader, fdata, template=None):
+    '''
+     write a bruker image
+     - template: BrukerHeaderTemplate of the run, the header
+       is patched instead of formatted from scratch
+    '''
+    write_bruker_buffers(fname, encode_bruker_frame(fheader, fdata, template))
 
-    # shrink data to desired bpp
-    fdata = fdata.astype(_BPP_TO_DT[bpp])
-    
-    # write frame
-    with open(fname, 'wb') as brukerFrame:
-        brukerFrame.write(format_bruker_header(fheader).encode('ASCII'))
-        brukerFrame.write(fdata.tobytes())
-        if fheader['NOVERFL'][0] >= 0:
-            brukerFrame.write(table_underflow.tobytes())
-        if bpp < 2 and fheader['NOVERFL'][1] > 0:
-            brukerFrame.write(table_data_uint16.tobytes())
-        if bpp < 4 and fheader['NOVERFL'][2] > 0:
-            brukerFrame.write(table_data_uint32.tobytes())
+def parse_sfrm_header(header, fields=None):
+    '''
+     split a Bruker header into its fixed 80 character slots
+     - 'KEYWORD:values', the keyword is the first 7 characters
+     - fields: only the slots of these keywords are split
+     - keywords spanning several slots (e.g. CELL) are joined
+     returns {keyword: [values as strings]}
+    '''
+    entries = {}
+    for i in range(0, len(header), 80):
+        key = header[i:i + 7].rstrip()
+        if fields is not None and key not in fields:
+            continue
+        entries.setdefault(key, []).extend(header[i + 8:i + 80].split())
+    return entries
+
+# header keywords needed to read the image and its tables
+_SFRM_FIELDS = ('HDRBLKS', 'NROWS', 'NCOLS', 'NPIXELB', 'NOVERFL')
+
+def read_sfrm_header(f):
+    '''
+     read the header of an open .sfrm file
+     - HDRBLKS is always in the first 512 bytes (3rd slot)
+     - only the keywords needed to read the frame are parsed
+     returns the header (str) and
+      nrows, ncols, [bpp, bpp_underflow], [#underflows, #16 bit, #32 bit]
+    '''
+    header = f.read(512).decode()
+    blocks = int(parse_sfrm_header(header, ('HDRBLKS',))['HDRBLKS'][0])
+    header += f.read(blocks * 512 - 512).decode()
+    entries = parse_sfrm_header(header, _SFRM_FIELDS)
+    nrows = int(entries['NROWS'][0])
+    ncols = int(entries['NCOLS'][0])
+    npixb = [int(i) for i in entries['NPIXELB']]
+    # old headers only state the image bytes per pixel
+    if len(npixb) < 2:
+        npixb.append(1)
+    noverfl = [int(i) for i in entries['NOVERFL']]
+    return header, nrows, ncols, npixb, noverfl
+
+def read_sfrm_table(stream, pos, count, bpp):
+    '''
+     read a table of 'count' entries of 'bpp' bytes at pos
+     - tables are padded to a multiple of 16 bytes
+     returns the table and the position after the padding
+    '''
+    import numpy as np
+    table = np.frombuffer(stream, _BPP_TO_DT[bpp], count, pos)
+    return table, pos + -(-count * abs(bpp) // 16) * 16
+
+def read_sfrm(fname, out=None):
+    '''
+     Read Bruker .sfrm frame
+     - header is returned as continuous stream
+     - information read from header (fixed 80 byte slots)
+       - detector dimensions (NROWS, NCOLS)
+       - bytes per pixel of image and underflow table (NPIXELB)
+       - number of pixels in the underflow, 16 and 32 bit
+         overflow tables (NOVERFL)
+     - image and tables are read from the file buffer without
+       copying, the underflow table is skipped
+     - the overflow tables are merged by position: the n-th
+       flagged pixel gets the n-th table entry, the table
+       lengths are taken from the header
+     - out: optional preallocated (rows, cols) array the
+       frame is written to
+     - data is returned as uint32 2D-Array
+    '''
+    import numpy as np
+    with open(fname, 'rb') as f:
+        header, nrows, ncols, (npixb, npixb_u), (nund, nov16, nov32) = read_sfrm_header(f)
+        stream = f.read()
+    if out is None:
+        out = np.empty((nrows, ncols), dtype=np.uint32)
+    elif out.shape != (nrows, ncols):
+        raise ValueError('{}: frame is {}x{}, expected {}x{}'.format(fname, nrows, ncols, *out.shape))
+    # the image follows the header
+    image = np.frombuffer(stream, _BPP_TO_DT[npixb], nrows * ncols).reshape((nrows, ncols))
+    pos = image.nbytes
+    # underflow table, NOVERFL[0] is -1 if there is none
+    if nund >= 0:
+        _, pos = read_sfrm_table(stream, pos, nund, -1 * npixb_u)
+    out[...] = image
+    if npixb < 2 and nov16 > 0:
+        table_16, pos = read_sfrm_table(stream, pos, nov16, 2)
+        idx_16 = np.flatnonzero(image == 255)
+        if idx_16.size != nov16:
+            raise ValueError('{}: {} pixels flagged, {} in the 16 bit overflow table'.format(fname, idx_16.size, nov16))
+        out.flat[idx_16] = table_16
+    if npixb < 4 and nov32 > 0:
+        table_32, pos = read_sfrm_table(stream, pos, nov32, 4)
+        # the 32 bit overflows are flagged 65535 in the image
+        # or, for 1 byte images, in the 16 bit overflow table
+        if npixb < 2:
+            idx_32 = idx_16[table_16 == 65535]
+        else:
+            idx_32 = np.flatnonzero(image == 65535)
+        if idx_32.size != nov32:
+            raise ValueError('{}: {} pixels flagged, {} in the 32 bit overflow table'.format(fname, idx_32.size, nov32))
+        out.flat[idx_32] = table_32
+    return header, out
+
+def read_sfrm_many(fnames, out=None):
+    '''
+     read a run of Bruker .sfrm frames into one 3D array
+     - the dimensions are taken from the first frame, all
+       frames must have the same dimensions
+     - out: optional preallocated (#frames, rows, cols) array
+     returns the list of headers and the uint32 3D-Array
+    '''
+    import numpy as np
+    fnames = list(fnames)
+    if not fnames:
+        raise ValueError('no frames to read')
+    if out is None:
+        with open(fnames[0], 'rb') as f:
+            _, nrows, ncols, _, _ = read_sfrm_header(f)
+        out = np.empty((len(fnames), nrows, ncols), dtype=np.uint32)
+    headers = []
+    for fname, frame in zip(fnames, out):
+        header, _ = read_sfrm(fname, out=frame)
+        headers.append(header)
+    return headers, out
+
+def rasterize_rectangle(mask, xy, width, height, angle):
+    '''
+     flag all pixels of a boolean mask that are (partly) covered
+     by a rectangle (matplotlib.patches.Rectangle)
+     - xy: corner of the rectangle, the rotation center
+     - angle: counterclockwise rotation in degrees
+     - data coordinates: x = column, y = row, the pixel
+       centers are at integer coordinates
+     - only the bounding box of the rectangle is tested,
+       using the separating axes of pixel and rectangle
+     - an axis aligned rectangle is snapped to the pixel
+       edges (as matplotlib does), a pixel is flagged if its
+       center is inside the snapped rectangle
+    '''
+    import numpy as np
+    rows, cols = mask.shape
+    x0, y0 = xy
+    c = np.cos(np.deg2rad(angle))
+    s = np.sin(np.deg2rad(angle))
+    u0, u1 = sorted((0.0, width))
+    v0, v1 = sorted((0.0, height))
+    # corners -> bounding box
+    x = x0 + np.array([u0, u1, u1, u0]) * c - np.array([v0, v0, v1, v1]) * s
+    y = y0 + np.array([u0, u1, u1, u0]) * s + np.array([v0, v0, v1, v1]) * c
+    if all(abs(x[k] - x[k - 1]) < 1e-4 or abs(y[k] - y[k - 1]) < 1e-4 for k in range(4)):
+        # pixel edges are at half integer coordinates,
+        # rounded: cos/sin of multiples of 90 are not exact
+        x = np.round(x, 6)
+        y = np.round(y, 6)
+        c_min = max(0, int(np.floor(x.min() + 1.0)))
+        c_max = min(cols, int(np.floor(x.max() + 1.0)))
+        r_min = max(0, int(np.floor(y.min() + 1.0)))
+        r_max = min(rows, int(np.floor(y.max() + 1.0)))
+        if c_min < c_max and r_min < r_max:
+            mask[r_min:r_max, c_min:c_max] = True
+        return mask
+    c_min = max(0, int(np.floor(x.min() - 0.5)) + 1)
+    c_max = min(cols, int(np.ceil(x.max() + 0.5)))
+    r_min = max(0, int(np.floor(y.min() - 0.5)) + 1)
+    r_max = min(rows, int(np.ceil(y.max() + 0.5)))
+    if c_min >= c_max or r_min >= r_max:
+        return mask
+    # project the pixel centers onto the rectangle axes
+    dx = np.arange(c_min, c_max)[None, :] - x0
+    dy = np.arange(r_min, r_max)[:, None] - y0
+    u = dx * c + dy * s
+    v = dy * c - dx * s
+    # half extent of a pixel on the rectangle axes
+    e = 0.5 * (abs(c) + abs(s))
+    mask[r_min:r_max, c_min:c_max] |= (u + e > u0) & (u - e < u1) & (v + e > v0) & (v - e < v1)
+    return mask
+
+def rasterize_ellipse(mask, center, width, height, angle):
+    '''
+     flag all pixels of a boolean mask that are (partly) covered
+     by an ellipse (matplotlib.patches.Ellipse)
+     - center: center of the ellipse, the rotation center
+     - width, height: diameters, angle: counterclockwise
+       rotation in degrees, coordinates as rasterize_rectangle
+     - the pixel squares are mapped onto the unit circle of the
+       ellipse, a pixel is covered if its center is inside the
+       ellipse or any of its edges is closer than 1 to the origin
+    '''
+    import numpy as np
+    rows, cols = mask.shape
+    cx, cy = center
+    a = abs(width) / 2.0
+    b = abs(height) / 2.0
+    if a == 0 or b == 0:
+        return mask
+    c = np.cos(np.deg2rad(angle))
+    s = np.sin(np.deg2rad(angle))
+    # bounding box
+    ex = np.hypot(a * c, b * s)
+    ey = np.hypot(a * s, b * c)
+    c_min = max(0, int(np.floor(cx - ex - 0.5)) + 1)
+    c_max = min(cols, int(np.ceil(cx + ex + 0.5)))
+    r_min = max(0, int(np.floor(cy - ey - 0.5)) + 1)
+    r_max = min(rows, int(np.ceil(cy + ey + 0.5)))
+    if c_min >= c_max or r_min >= r_max:
+        return mask
+    dx = np.arange(c_min, c_max)[None, :] - cx
+    dy = np.arange(r_min, r_max)[:, None] - cy
+    # pixel corners in the unit circle frame
+    corners = []
+    for ox, oy in ((-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)):
+        corners.append((((dx + ox) * c + (dy + oy) * s) / a,
+                        ((dy + oy) * c - (dx + ox) * s) / b))
+    # the ellipse center is inside the pixel
+    covered = (np.abs(dx) < 0.5) & (np.abs(dy) < 0.5)
+    # distance of the pixel edges to the origin
+    for k in range(4):
+        pu, pv = corners[k]
+        qu, qv = corners[(k + 1) % 4]
+        du, dv = qu - pu, qv - pv
+        t = np.clip(-(pu * du + pv * dv) / (du * du + dv * dv), 0.0, 1.0)
+        covered |= (pu + t * du) ** 2 + (pv + t * dv) ** 2 < 1.0
+    mask[r_min:r_max, c_min:c_max] |= covered
+    return mask
+
+def beamstop_mask(data, rect, elli):
+    '''
+     active pixel mask of a frame: 1 active, 0 inactive
+     - data: the (padded/rotated) frame, negative
+       pixels (-1: dead, -2: gap) are inactive
+     - rect, elli: beamstop patches as stored by FrameView,
+       [xy, width, height, angle], pixels covered by
+       any of them are inactive
+    '''
+    import numpy as np
+    patch = np.zeros(data.shape, dtype=bool)
+    rasterize_rectangle(patch, *rect)
+    rasterize_ellipse(patch, *elli)
+    mask = (data >= 0).astype(data.dtype)
+    mask[patch] = 0
+    return mask
+
+def write_bruker_mask(fname, data, frame_name, rows, cols):
+    '''
+     write an active pixel mask (see beamstop_mask)
+     as Bruker frame
+     - frame_name: name of the masked frame (FILENAM)
+     - rows, cols: dimensions of the original frame
+    '''
+    import numpy as np
+    
+    # calculate detector pixel per cm
+    # this is normalized to a 512x512 detector format
+    # PILATUS3-1M pixel size is 0.172 mm 
+    pix_per_512 = round((10.0 / 0.172) * (512.0 / ((rows + cols) / 2.0)), 6)
+    
+    # default Bruker header
+    header = bruker_header()
+    
+    # fill known header items
+    header['NCOLS']      = [data.shape[1]]                  # Number of pixels per row; number of mosaic tiles in X; dZ/dX
+    header['NROWS']      = [data.shape[0]]                  # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
+    header['CCDPARM'][:] = [0.00, 1.00, 1.00, 1.00, 1169523]
+    header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    header['DETTYPE'][:] = ['PILATUS3-1M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
+    header['SITE']       = ['']                             # Site name
+    header['MODEL']      = ['Synchrotron']                  # Diffractometer model
+    header['TARGET']     = ['']                             # X-ray target material)
+    header['USER']       = ['USER']                         # Username
+    header['SOURCEK']    = ['?']                            # X-ray source kV
+    header['SOURCEM']    = ['?']                            # Source milliamps
+    header['FILENAM']    = [frame_name]
+    header['TYPE']       = ['ACTIVE MASK']                  # String indicating kind of data in the frame
+    header['NFRAMES']    = ['?']                            # Number of frames in the series
+    header['NEXP'][2]    = 0
+    header['MAXXY']      = np.array(np.where(data == data.max()), np.float64)[:, 0]
+    header['MAXIMUM']    = [np.max(data)]
+    header['MINIMUM']    = [np.min(data)]
+    header['NCOUNTS'][:] = [data.sum(), 0]
+    header['NOVER64'][:] = [data[data > 64000].shape[0], 0, 0]
+    header['NSTEPS']     = [1]                              # steps or oscillations in this frame
+    header['NPIXELB'][:] = [1, 1]                           # bytes/pixel in main image, bytes/pixel in underflow table
+    header['COMPRES']    = ['NONE']                         # compression scheme if any
+    header['TRAILER']    = [0]                              # byte pointer to trailer info
+    header['LINEAR'][:]  = [1.00, 0.00]     
+    header['PHD'][:]     = [1.00, 0.00]
+    header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
+    header['DISPLIM'][:] = [0.0, 63.0]                      # Recommended display contrast window settings
+    
+    # write the frame
+    write_bruker_frame(fname, header, data)
+
+def get_mask_name(fname, path_mask):
+    '''
+     mask file name of the run of a frame: path_mask/some_name_xa_rr_0001.sfrm
+    '''
+    import os
+    basename, ext = os.path.splitext(os.path.basename(fname))
+    frame_stem, frame_run, _, _ = get_run_info(basename)
+    return os.path.join(path_mask, '{}_xa_{:>02}_0001.sfrm'.format(frame_stem, frame_run))
+
+def convert_frame_to_mask(fname, path_mask, geometry, reader=None, rows=1043, cols=981, offset=4096, rotate=True):
+    '''
+     write the active pixel mask of the run of a frame,
+     headless counterpart of FrameView.convert_patches_to_mask
+     - geometry: {'rect':[xy, w, h, angle], 'elli':[xy, w, h, angle]}
+     - reader: frame read function (read_pilatus_tif/cbf)
+     - the frame is padded and rotated as shown by FrameView
+    '''
+    import os
+    import numpy as np
+    _, data = reader(fname, rows, cols, offset, np.uint32, mmap=True)
+    data, _, _ = pilatus_pad(data)
+    if rotate:
+        data = np.rot90(data, k=1, axes=(1, 0))
+    mask = beamstop_mask(data, geometry['rect'], geometry['elli'])
+    write_bruker_mask(get_mask_name(fname, path_mask), mask, os.path.basename(fname), rows, cols)
+    return True
+
+def verify_frame(fname, path_sfrm, reader=None, rows=1043, cols=981, offset=4096, rotate=True):
+    '''
+     compare a converted .sfrm with its source frame
+     - the source is read and transformed as by the converters
+       (preprocess_frame: pad, rotate, dead/bad pixels, offset)
+     - the .sfrm pixels are read including the overflow tables
+     - the header fields NCOUNTS, MAXIMUM and NOVERFL
+       are checked against the transformed source
+     returns a list of mismatches, empty if the frames agree
+    '''
+    import os
+    import numpy as np
+    sfrmName = get_sfrm_name(fname, path_sfrm)
+    if not os.path.exists(sfrmName):
+        return ['missing {}'.format(os.path.basename(sfrmName))]
+    _, data = reader(fname, rows, cols, offset, np.int32, mmap=True)
+    expected, _, _, stats = preprocess_frame(data, rotate=rotate)
+    header, data = read_sfrm(sfrmName)
+    if data.shape != expected.shape:
+        return ['shape {}x{}, expected {}x{}'.format(*data.shape, *expected.shape)]
+    mismatch = []
+    # the transformed frame is never negative
+    differ = np.flatnonzero(data.view(np.int32) != expected)
+    if differ.size > 0:
+        row, col = np.unravel_index(differ[0], data.shape)
+        mismatch.append('{} pixels differ, first at {},{}: {}, expected {}'.format(differ.size, row, col, data[row, col], expected[row, col]))
+    entries = parse_sfrm_header(header, ('NCOUNTS', 'MAXIMUM', 'NOVERFL', 'NPIXELB'))
+    bpp = int(entries['NPIXELB'][0])
+    noverfl = [int(i) for i in entries['NOVERFL']]
+    expect = {'NCOUNTS':stats['NCOUNTS'],
+              'MAXIMUM':stats['MAXIMUM'],
+              'NOVERFL 16':int(np.count_nonzero(expected >= 255)) if bpp < 2 else noverfl[1],
+              'NOVERFL 32':int(np.count_nonzero(expected >= 65535)) if bpp < 4 else noverfl[2]}
+    found = {'NCOUNTS':int(float(entries['NCOUNTS'][0])),
+             'MAXIMUM':int(float(entries['MAXIMUM'][0])),
+             'NOVERFL 16':noverfl[1],
+             'NOVERFL 32':noverfl[2]}
+    for name, value in expect.items():
+        if found[name] != value:
+            mismatch.append('{} {}, expected {}'.format(name, found[name], value))
+    return mismatch
 
 def fix_bad_pixel(data, flag, bad_int=-2, sat_val=2**20):
     '''
@@ -524,6 +1394,128 @@ def fix_bad_pixel(data, flag, bad_int=-2, sat_val=2**20):
         data[data == bad_int] = 0
     return data
 
+class HeaderParser:
+    '''
+     precompiled regexes for a set of header fields
+     - fields: {name: pattern}, patterns may have several groups
+     - parse(text) returns {name: (group, ...)} of the first
+       match of every field
+     - every pattern starts with a literal field name the regex
+       engine can skip to, this is faster than one combined
+       alternation that is tried at every position of the text
+    '''
+    def __init__(self, fields):
+        self.fields = {name: re.compile(pattern) for name, pattern in fields.items()}
+
+    @profile_stage('parse', lambda result, args, kwargs: len(args[1]))
+    def parse(self, text):
+        found = {}
+        for name, regex in self.fields.items():
+            match = regex.search(text)
+            if match is None:
+                raise ValueError('Header entry not found: {}'.format(name))
+            found[name] = match.groups()
+        return found
+
+#########################################
+##  Header fields of the facilities    ##
+##  _STATIC: constant within a run     ##
+##  _FRAME: parsed for every frame     ##
+#########################################
+_APS_STATIC = HeaderParser({'Exposure_time'    :r'Exposure_time\s+(\d+\.\d+)\s+s',
+                            'Exposure_period'  :r'Exposure_period\s+(\d+\.\d+)\s+s',
+                            'Detector_distance':r'Detector_distance\s+(\d+\.\d+)\s+m',
+                            'Wavelength'       :r'Wavelength\s+(\d+\.\d+)\s+A',
+                            'Kappa'            :r'Kappa\s+(-*\d+\.\d+)\s+deg.',
+                            'Alpha'            :r'Alpha\s+(-*\d+\.\d+)\s+deg.',
+                            'Phi_increment'    :r'Phi_increment\s+(-*\d+\.\d+)\s+deg.',
+                            'Beam_xy'          :r'Beam_xy\s+\((\d+\.\d+),\s+(\d+\.\d+)\)\s+pixels'})
+_APS_FRAME = HeaderParser({'Flux'              :r'Flux\s+(\d+\.\d+)',
+                           'Omega'             :r'Omega\s+(-*\d+\.\d+)\s+deg.',
+                           'Phi'               :r'Phi\s+(-*\d+\.\d+)\s+deg.'})
+
+_SP8_STATIC = HeaderParser({'CCD_SPATIAL_BEAM_POSITION':r'CCD_SPATIAL_BEAM_POSITION\s*=\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*;',
+                            'SATURATED_VALUE'          :r'SATURATED_VALUE\s*=\s*(\d+)\s*;',
+                            'SCAN_WAVELENGTH'          :r'SCAN_WAVELENGTH\s*=\s*(\d+\.\d+)\s*;',
+                            'SOURCE_VOLTAGE'           :r'SOURCE_VOLTAGE\s*=\s*(\d+\.\d+)\s*GeV\s*;',
+                            'SCAN_DET_RELZERO'         :r'SCAN_DET_RELZERO\s*=\s*-*\d+\.\d+\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*;',
+                            'ROTATION_AXIS_NAME'       :r'ROTATION_AXIS_NAME\s*=\s*(\w+)\s*;',
+                            'SCAN_SEQ_INFO'            :r'SCAN_SEQ_INFO\s*=\s*\d+\s*\d+\s*(\d+)\s*;'})
+_SP8_FRAME = HeaderParser({'SOURCE_AMPERAGE'           :r'SOURCE_AMPERAGE\s*=\s*(\d+\.\d+)\s*mA\s*;',
+                           'CRYSTAL_GONIO_VALUES'      :r'CRYSTAL_GONIO_VALUES\s*=\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*;',
+                           'SCAN_ROTATION'             :r'SCAN_ROTATION\s*=\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*;'})
+
+_DLS_STATIC = HeaderParser({'Exposure_time'    :r'Exposure_time\s+(\d+\.\d+)\s+s',
+                            'Exposure_period'  :r'Exposure_period\s+(\d+\.\d+)\s+s',
+                            'Detector_distance':r'Detector_distance\s+(\d+\.\d+)\s+m',
+                            'Wavelength'       :r'Wavelength\s+(\d+\.\d+)\s+A',
+                            'Phi_increment'    :r'Phi_increment\s+(-*\d+\.\d+)\s+deg.',
+                            'Chi_increment'    :r'Chi_increment\s+(-*\d+\.\d+)\s+deg.',
+                            'Omega_increment'  :r'Omega_increment\s+(-*\d+\.\d+)\s+deg.',
+                            'Detector_2theta'  :r'Detector_2theta\s+(-*\d+\.\d+)\s+deg.',
+                            'Beam_xy'          :r'Beam_xy\s+\((\d+\.\d+),\s+(\d+\.\d+)\)\s+pixels'})
+_DLS_FRAME = HeaderParser({'Phi'               :r'Phi\s+(-*\d+\.\d+)\s+deg.',
+                           'Chi'               :r'Chi\s+(-*\d+\.\d+)\s+deg.',
+                           'Omega'             :r'Omega\s+(-*\d+\.\d+)\s+deg.'})
+
+class RunCache:
+    '''
+     per-process cache of the runs being converted
+     - keeps the 'size' runs used last, older runs are dropped
+     - emptied when a process starts converting (see
+       clear_run_caches), a run that is collected again under
+       the same name is not mixed up with the old one
+     - thread-safe
+    '''
+    def __init__(self, size=16):
+        import collections, threading
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def setdefault(self, key, value):
+        with self.lock:
+            value = self.entries.setdefault(key, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_RUN_METADATA = RunCache()
+_RUN_HEADERS = RunCache()
+_HEADER_TEMPLATES = RunCache()
+
+def clear_run_caches():
+    '''
+     empty the per-run caches of this process, called at
+     the start of every batch and watch (pool initializer)
+    '''
+    _RUN_METADATA.clear()
+    _RUN_HEADERS.clear()
+    _HEADER_TEMPLATES.clear()
+
+def get_run_metadata(key, parser, text):
+    '''
+     per-run cache of the static header fields (per process)
+     - parsed from the first frame of a run that is converted
+     - key: e.g. (site, path_to, frame_stem, frame_run)
+    '''
+    metadata = _RUN_METADATA.get(key)
+    if metadata is None:
+        metadata = _RUN_METADATA.setdefault(key, parser.parse(text))
+    return metadata
+
 def get_run_info(basename):
     # try to get the run and frame number from the filename
     # any_name_runNum_frmNum is assumed.
@@ -544,11 +1536,298 @@ def get_run_info(basename):
     stem = basename[:-6]
     return stem, runNum, frmNum, 3
     
-def convert_frame_APS_Bruker(fname, path_sfrm, rows=1043, cols=981, offset=4096, overwrite=True, beamflux=None):
+def get_sfrm_name(fname, path_sfrm):
     '''
+     output file name of a frame: path_sfrm/some_name_rr_ffff.sfrm
+    '''
+    import os
+    path_to, frame_name = os.path.split(fname)
+    basename, ext = os.path.splitext(frame_name)
+    frame_stem, frame_run, frame_num, _ = get_run_info(basename)
+    return os.path.join(path_to, path_sfrm, '{}_{:>02}_{:>04}.sfrm'.format(frame_stem, frame_run, frame_num))
+
+def get_run_headers(key, build, *args, **kwargs):
+    '''
+     RunHeaders from build (run_headers_*), the run entries
+     (base) are built once per run and cached (per process,
+     see RunCache)
+     key: e.g. (site, path_to, frame_stem, frame_run)
+    '''
+    headers = build(*args, base=_RUN_HEADERS.get(key), **kwargs)
+    _RUN_HEADERS.setdefault(key, headers.base)
+    return headers
+
+#########################################
+##  Bruker headers of the facilities   ##
+##  all frames of a run at once:       ##
+##  - run_info: the _STATIC fields     ##
+##  - frm_info: the _FRAME fields and  ##
+##    stats, frames: see frame_columns ##
+##    one entry per frame              ##
+##  - shape, offsets: of the           ##
+##    preprocessed frame               ##
+##  - base: the run entries of a       ##
+##    previous call (get_run_headers)  ##
+##  returns RunHeaders                 ##
+#########################################
+def run_headers_APS(run_info, frm_info, stats, frames, shape, offsets, rows=1043, cols=981, flux=None, base=None):
+    '''
+     APS, flux: beam flux per frame (default: Flux of frm_info)
+    '''
+    import numpy as np
+    
+    scan_ext = float(run_info['Exposure_time'][0])
+    scan_exp = float(run_info['Exposure_period'][0])
+    goni_dxt = float(run_info['Detector_distance'][0]) * 1000.0
+    source_w = float(run_info['Wavelength'][0])
+    goni_kap = float(run_info['Kappa'][0])
+    goni_alp = float(run_info['Alpha'][0])
+    scan_inc = float(run_info['Phi_increment'][0])
+    goni_omg = np.array([float(i['Omega'][0]) for i in frm_info])
+    goni_phi = np.array([float(i['Phi'][0]) for i in frm_info])
+    if flux is None:
+        flux = [float(i['Flux'][0]) for i in frm_info]
+    
+    # APS to Bruker angles
+    axes = axes_APS_to_Bruker(goni_omg, goni_kap, goni_alp, goni_phi, scan_inc)
     
+    if base is None:
+        temp     = run_info['Beam_xy']
+        p_x, p_y = float(temp[0]), float(temp[1])
+        offset_rows, offset_cols = offsets
+        
+        # adjust the beam center to the rotation
+        beam_x = p_y + offset_rows
+        beam_y = cols - p_x + offset_cols
+        
+        # calculate detector pixel per cm
+        # this is normalized to a 512x512 detector format
+        # PILATUS3-1M pixel size is 0.172 mm 
+        pix_per_512 = round((10.0 / 0.172) * (512.0 / ((rows + cols) / 2.0)), 6)
+        
+        # default bruker header
+        header = bruker_header()
+        
+        # fill known header items
+        header['NCOLS']      = [shape[1]]                                # Number of pixels per row; number of mosaic tiles in X; dZ/dX
+        header['NROWS']      = [shape[0]]                                # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
+        header['CENTER'][:]  = [beam_x, beam_y, beam_x, beam_y]          # 
+        header['CCDPARM'][:] = [0.00, 1.00, 1.00, 1.00, 1169523]
+        header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        header['DETTYPE'][:] = ['PILATUS3-1M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
+        header['SITE']       = ['ANL/APS/15ID-D']                        # Site name
+        header['MODEL']      = ['Synchrotron']                           # Diffractometer model
+        header['TARGET']     = ['Undulator']                             # X-ray target material)
+        header['USER']       = ['USER']                                  # Username
+        header['SOURCEK']    = ['?']                                     # X-ray source kV
+        header['SOURCEM']    = ['?']                                     # Source milliamps
+        header['WAVELEN'][:] = [source_w, source_w, source_w]            # Wavelengths (average, a1, a2)
+        header['CUMULAT']    = [scan_exp]                                # Accumulated exposure time in real hours
+        header['ELAPSDR']    = [scan_ext]                                # Requested time for this frame in seconds
+        header['ELAPSDA']    = [scan_exp]                                # Actual time for this frame in seconds
+        header['TYPE']       = ['Generic {} Scan'.format(axes['SCAN'])]  # String indicating kind of data in the frame
+        header['DISTANC']    = [goni_dxt / 10.0]                         # Sample-detector distance, cm
+        header['RANGE']      = [abs(axes['INCREME'])]                    # Magnitude of scan range in decimal degrees
+        header['INCREME']    = [axes['INCREME']]                         # Signed scan angle increment between frames
+        header['NFRAMES']    = ['?']                                     # Number of frames in the series
+        header['AXIS'][:]    = [axes['AXIS']]                            # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
+        header['LOWTEMP'][:] = [1, int((-273.15 + 20.0) * 100.0), -6000] # Low temp flag; experiment temperature*100; detector temp*100
+        header['NPIXELB'][:] = [1, 1]                                    # bytes/pixel in main image, bytes/pixel in underflow table
+        header['NSTEPS']     = [1]                                       # steps or oscillations in this frame
+        header['COMPRES']    = ['NONE']                                  # compression scheme if any
+        header['TRAILER']    = [0]                                       # byte pointer to trailer info
+        header['LINEAR'][:]  = [1.00, 0.00]     
+        header['PHD'][:]     = [1.00, 0.00]
+        header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
+        header['DISPLIM'][:] = [0.0, 63.0]                               # Recommended display contrast window settings
+        header['FILTER2'][:] = [90.0, 0.0, 0.0, 1.0]                     # Monochromator 2-theta, roll (both deg)
+        base = header
+    
+    # the entries that change from frame to frame
+    columns = frame_columns(frames, stats)
+    columns['NCOUNTS'][:, 1] = flux
+    columns['START']  = angle_columns([axes['START']], len(frames))      # Starting scan angle value, decimal deg
+    columns['ANGLES'] = angle_columns(axes['ANGLES'], len(frames))       # Diffractometer setting angles, deg. (2Th, omg, phi, chi)
+    columns['ENDING'] = angle_columns(axes['ENDING'], len(frames))       # Setting angles read at end of scan
+    return RunHeaders(base, columns)
+
+def run_headers_SP8(run_info, frm_info, stats, frames, shape, offsets, rows=1043, cols=981, tth_corr=0.0, base=None):
+    '''
+     SP8, tth_corr: 2-theta correction (see get_SP8_tth_corr)
     '''
-    import os, re
+    import numpy as np
+    
+    det_maxv = int(run_info['SATURATED_VALUE'][0])
+    source_w = float(run_info['SCAN_WAVELENGTH'][0])
+    source_v = float(run_info['SOURCE_VOLTAGE'][0])
+    goni_tth, goni_dxt = [float(i) for i in run_info['SCAN_DET_RELZERO']]
+    scan_rax = str(run_info['ROTATION_AXIS_NAME'][0])
+    scan_num = float(run_info['SCAN_SEQ_INFO'][0])
+    source_a = [float(i['SOURCE_AMPERAGE'][0]) for i in frm_info]
+    goni_omg, goni_chi, goni_phi = np.array([i['CRYSTAL_GONIO_VALUES'] for i in frm_info], dtype=np.float64).reshape(-1, 3).T
+    scan_sta, scan_end, scan_inc, scan_exp = np.array([i['SCAN_ROTATION'] for i in frm_info], dtype=np.float64).reshape(-1, 4).T
+    
+    # For some reason the distance is missing for some runs.
+    # At SPring-8 the detector distance 'cannot' be changed.
+    # So, we hard-code 130.0 on missing entry here!
+    if goni_dxt == 0.0:
+        goni_dxt = 130.0
+    
+    # SP8 to Bruker angles
+    # 2-th were misaligned (pre 2019 data)
+    axes = axes_SP8_to_Bruker(goni_tth, goni_omg, goni_phi, goni_chi, scan_rax, scan_sta, scan_end, scan_inc, tth_corr)
+    
+    if base is None:
+        det_beam_x, det_beam_y = [float(i) for i in run_info['CCD_SPATIAL_BEAM_POSITION']]
+        offset_rows, offset_cols = offsets
+        
+        # initial frame dimensions are needed to calculate
+        # the beamcenter of the reshaped frame and
+        # adjust the beam center to the rotation
+        beam_x = det_beam_y + offset_rows
+        beam_y = cols - det_beam_x + offset_cols
+        
+        # calculate detector pixel per cm
+        # this is normalized to a 512x512 detector format
+        # PILATUS3-1M pixel size is 0.172 mm 
+        pix_per_512 = round((10.0 / 0.172) * (512.0 / ((rows + cols) / 2.0)), 6)
+        
+        # default bruker header
+        header = bruker_header()
+        
+        # fill known header items
+        header['NCOLS']      = [shape[1]]                                           # Number of pixels per row; number of mosaic tiles in X; dZ/dX
+        header['NROWS']      = [shape[0]]                                           # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
+        header['CENTER'][:]  = [beam_x, beam_y, beam_x, beam_y]                     # adjust the beam center for the filling/cutting of the frame
+        header['CCDPARM'][:] = [1.00, 1.00, 1.00, 1.00, det_maxv]
+        header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        header['DETTYPE'][:] = ['PILATUS3-1M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
+        header['SITE']       = ['SPring-8/BL02B1']                                  # Site name
+        header['MODEL']      = ['Synchrotron']                                      # Diffractometer model
+        header['TARGET']     = ['Bending Magnet']                                   # X-ray target material)
+        header['USER']       = ['USER']                                             # Username
+        header['SOURCEK']    = [source_v]                                           # X-ray source kV
+        header['WAVELEN'][:] = [source_w, source_w, source_w]                       # Wavelengths (average, a1, a2)
+        header['TYPE']       = ['Generic {} Scan'.format(axes['SCAN'])]             # String indicating kind of data in the frame
+        header['DISTANC']    = [float(goni_dxt) / 10.0]                             # Sample-detector distance, cm
+        header['NFRAMES']    = [int(scan_num)]                                      # Number of frames in the series
+        header['AXIS'][:]    = [axes['AXIS']]                                       # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
+        header['LOWTEMP'][:] = [1, int((-273.15 + 20.0) * 100.0), -6000]            # Low temp flag; experiment temperature*100; detector temp*100
+        header['NSTEPS']     = [1]                                                  # steps or oscillations in this frame
+        header['NPIXELB'][:] = [1, 1]                                               # bytes/pixel in main image, bytes/pixel in underflow table
+        header['COMPRES']    = ['NONE']                                             # compression scheme if any
+        header['TRAILER']    = [0]                                                  # byte pointer to trailer info
+        header['LINEAR'][:]  = [1.00, 0.00]     
+        header['PHD'][:]     = [1.00, 0.00]
+        header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
+        header['DISPLIM'][:] = [0.0, 100.0]                                         # Recommended display contrast window settings
+        header['FILTER2'][:] = [90.0, 0.0, 0.0, 1.0]                                # Monochromator 2-theta, roll (both deg)
+        base = header
+    
+    # the entries that change from frame to frame
+    # the current, exposure and scan range are read per frame
+    columns = frame_columns(frames, stats)
+    columns['SOURCEM'] = [[i] for i in source_a]                                    # Source milliamps
+    columns['CUMULAT'] = [[i] for i in scan_exp.tolist()]                           # Accumulated exposure time in real hours
+    columns['ELAPSDR'] = [[i] for i in scan_exp.tolist()]                           # Requested time for this frame in seconds
+    columns['ELAPSDA'] = [[i] for i in scan_exp.tolist()]                           # Actual time for this frame in seconds
+    columns['START']   = angle_columns([axes['START']], len(frames))                # Starting scan angle value, decimal deg
+    columns['ANGLES']  = angle_columns(axes['ANGLES'], len(frames))                 # Diffractometer setting angles, deg. (2Th, omg, phi, chi)
+    columns['ENDING']  = angle_columns(axes['ENDING'], len(frames))                 # Setting angles read at end of scan
+    columns['RANGE']   = [[abs(i)] for i in axes['INCREME'].tolist()]               # Magnitude of scan range in decimal degrees
+    columns['INCREME'] = [[i] for i in axes['INCREME'].tolist()]                    # Signed scan angle increment between frames
+    return RunHeaders(base, columns)
+
+def run_headers_DLS(run_info, frm_info, stats, frames, shape, offsets, rows=1679, cols=1475, base=None):
+    '''
+     DLS
+    '''
+    import numpy as np
+    
+    sca_ext = float(run_info['Exposure_time'][0])
+    sca_exp = float(run_info['Exposure_period'][0])
+    gon_dxt = float(run_info['Detector_distance'][0]) * 1000.0
+    src_wav = float(run_info['Wavelength'][0])
+    inc_phi = float(run_info['Phi_increment'][0])
+    inc_chi = float(run_info['Chi_increment'][0])
+    inc_omg = float(run_info['Omega_increment'][0])
+    sta_tth = float(run_info['Detector_2theta'][0])
+    sta_phi = np.array([float(i['Phi'][0]) for i in frm_info])
+    sta_chi = np.array([float(i['Chi'][0]) for i in frm_info])
+    sta_omg = np.array([float(i['Omega'][0]) for i in frm_info])
+    
+    # DLS to Bruker angles
+    axes = axes_DLS_to_Bruker(sta_tth, sta_omg, inc_omg, sta_phi, inc_phi, sta_chi, inc_chi)
+    
+    if base is None:
+        pil_x   = float(run_info['Beam_xy'][0])
+        pil_y   = float(run_info['Beam_xy'][1])
+        offset_rows, offset_cols = offsets
+        
+        # initial frame dimensions are needed to calculate
+        # the beamcenter of the reshaped frame and
+        # adjust the beam center to the Bruker flip
+        # numpy array starts in the upper left corner
+        # Bruker starts lower left
+        beam_y = rows - pil_y + offset_rows
+        beam_x = pil_x + offset_cols
+        
+        # calculate detector pixel per cm
+        # this is normalized to a 512x512 detector format
+        # PILATUS3 pixel size is 0.172 mm 
+        pix_per_512 = round((10.0 / 0.172) * (512.0 / ((rows + cols) / 2.0)), 6)
+        
+        # default bruker header
+        header = bruker_header()
+        
+        # fill known header items
+        header['NCOLS']      = [shape[1]]                                # Number of pixels per row; number of mosaic tiles in X; dZ/dX
+        header['NROWS']      = [shape[0]]                                # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
+        header['CENTER'][:]  = [beam_x, beam_y, beam_x, beam_y]          # 
+        header['CCDPARM'][:] = [0.00, 1.00, 1.00, 1.00, 1169523]
+        header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        header['DETTYPE'][:] = ['PILATUS3-2M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
+        header['SITE']       = ['DLS/I19-1']                             # Site name
+        header['MODEL']      = ['Synchrotron']                           # Diffractometer model
+        header['TARGET']     = ['Undulator']                             # X-ray target material)
+        header['USER']       = ['?']                                     # Username
+        header['SOURCEK']    = ['?']                                     # X-ray source kV
+        header['SOURCEM']    = ['?']                                     # Source milliamps
+        header['WAVELEN'][:] = [src_wav, src_wav, src_wav]               # Wavelengths (average, a1, a2)
+        header['CUMULAT']    = [sca_exp]                                 # Accumulated exposure time in real hours
+        header['ELAPSDR']    = [sca_ext]                                 # Requested time for this frame in seconds
+        header['ELAPSDA']    = [sca_exp]                                 # Actual time for this frame in seconds
+        header['TYPE']       = ['Generic {} Scan'.format(axes['SCAN'])]  # String indicating kind of data in the frame
+        header['DISTANC']    = [float(gon_dxt) / 10.0]                   # Sample-detector distance, cm
+        header['RANGE']      = [abs(axes['INCREME'])]                    # Magnitude of scan range in decimal degrees
+        header['INCREME']    = [axes['INCREME']]                         # Signed scan angle increment between frames
+        header['NFRAMES']    = ['?']                                     # Number of frames in the series
+        header['AXIS'][:]    = [axes['AXIS']]                            # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
+        header['LOWTEMP'][:] = [1, 0, 0]                                 # Low temp flag; experiment temperature*100; detector temp*100
+        header['NPIXELB'][:] = [1, 1]                                    # bytes/pixel in main image, bytes/pixel in underflow table
+        header['NSTEPS']     = [1]                                       # steps or oscillations in this frame
+        header['COMPRES']    = ['NONE']                                  # compression scheme if any
+        header['TRAILER']    = [0]                                       # byte pointer to trailer info
+        header['LINEAR'][:]  = [1.00, 0.00]     
+        header['PHD'][:]     = [1.00, 0.00]
+        header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
+        header['DISPLIM'][:] = [0.0, 63.0]                               # Recommended display contrast window settings
+        header['FILTER2'][:] = [90.0, 0.0, 0.0, 1.0]                     # Monochromator 2-theta, roll (both deg)
+        base = header
+    
+    # the entries that change from frame to frame
+    columns = frame_columns(frames, stats)
+    columns['START']  = angle_columns([axes['START']], len(frames))      # Starting scan angle value, decimal deg
+    columns['ANGLES'] = angle_columns(axes['ANGLES'], len(frames))       # Diffractometer setting angles, deg. (2Th, omg, phi, chi)
+    columns['ENDING'] = angle_columns(axes['ENDING'], len(frames))       # Setting angles read at end of scan
+    return RunHeaders(base, columns)
+
+@profile_stage('convert', size_of_file)
+def convert_frame_APS_Bruker(fname, path_sfrm, rows=1043, cols=981, offset=4096, overwrite=True, beamflux=None, stream=None, encode=False, slot=None, stack=False):
+    '''
+    
+    '''
+    import os
     import numpy as np
     from datetime import datetime as dt
     
@@ -558,132 +1837,72 @@ def convert_frame_APS_Bruker(fname, path_sfrm, rows=1043, cols=981, offset=4096,
     frame_stem, frame_run, frame_num, _ = get_run_info(basename)
     
     # output file format: some_name_rr_ffff.sfrm
-    outName = os.path.join(path_to, path_sfrm, '{}_{:>02}_{:>04}.sfrm'.format(frame_stem, frame_run, frame_num))
+    outName = get_sfrm_name(fname, path_sfrm)
 
     # check if file exists and overwrite flag
     if os.path.exists(outName) and overwrite == False:
         return False
     
     # read in the frame
-    header, data = read_pilatus_tif(fname, rows, cols, offset, np.int32)
+    # the header is only decoded if needed
+    # stream: the raw bytes, fetched by the pipeline
+    header, data = read_pilatus_tif(fname, rows, cols, offset, np.int32, mmap=True, stream=stream)
+    # slot: shared memory buffers of the pipeline (see _FramePool.py)
+    # the frame is preprocessed and encoded in place
+    out_data = None if slot is None else slot.data
+    out_image = None if slot is None else slot.image
     
     # get the frame saint ready 
     # - pad with zeros
-    data, offset_rows, offset_cols = pilatus_pad(data)
-    
-    # the frame has to be rotated by 90 degrees
-    data = np.rot90(data, k=1, axes=(1, 0))
-    
-    # the dead areas are flagged -1
-    data[data == -1] = 0
-    # bad pixels are flagged -2
-    data[data == -2] = 0
-    
-    # scale the data to avoid underflow tables
-    # should yield zero for Pilatus3 images!
-    baseline_offset = -1 * data.min()
-    data += baseline_offset
+    # - the frame has to be rotated by 90 degrees
+    # - dead areas (-1) and bad pixels (-2) to zero
+    # - scale the data to avoid underflow tables
+    data, offset_rows, offset_cols, stats = preprocess_frame(data, rotate=True, out=out_data)
     
     # extract scan info from tif header
-    scan_flx = float(re.search('Flux\s+(\d+\.\d+)', header).groups()[0])
-    scan_ext = float(re.search('Exposure_time\s+(\d+\.\d+)\s+s', header).groups()[0])
-    scan_exp = float(re.search('Exposure_period\s+(\d+\.\d+)\s+s', header).groups()[0])
-    goni_dxt = float(re.search('Detector_distance\s+(\d+\.\d+)\s+m', header).groups()[0]) * 1000.0
-    source_w = float(re.search('Wavelength\s+(\d+\.\d+)\s+A', header).groups()[0])
-    goni_omg = float(re.search('Omega\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    goni_kap = float(re.search('Kappa\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    goni_phi = float(re.search('Phi\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    goni_alp = float(re.search('Alpha\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    scan_inc = float(re.search('Phi_increment\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    temp     = re.search('Beam_xy\s+\((\d+\.\d+),\s+(\d+\.\d+)\)\s+pixels', header).groups()
-    p_x, p_y = float(temp[0]), float(temp[1])
-    
-    # convert Kappa to Euler geometry
-    goni_omg, goni_chi, goni_phi = kappa_to_euler(goni_omg, goni_kap, goni_alp, goni_phi)
-    
-    # adjust the beam center to the rotation
-    beam_x = p_y + offset_rows
-    beam_y = cols - p_x + offset_cols
-    
-    # APS to Bruker conversion:
-    scan_inc = -scan_inc
-    goni_omg =  90.0 + goni_omg
-    goni_phi = 360.0 - goni_phi
-    goni_tth = 0.0
-    
-    # Phi is the scan axis!
-    scan_sta = goni_phi
-    scan_end = goni_phi + scan_inc
-    
-    # calculate detector pixel per cm
-    # this is normalized to a 512x512 detector format
-    # PILATUS3-1M pixel size is 0.172 mm 
-    pix_per_512 = round((10.0 / 0.172) * (512.0 / ((rows + cols) / 2.0)), 6)
+    # - the static fields are parsed once per run
+    # - the angles and the flux are parsed per frame
+    header = str(header)
+    run_info = get_run_metadata(('APS', path_to, frame_stem, frame_run), _APS_STATIC, header)
+    frm_info = _APS_FRAME.parse(header)
     
+    # the beam flux file is preferred
+    scan_flx = float(frm_info['Flux'][0])
     if beamflux is not None:
         try:
             scan_flx = beamflux[frame_run][frame_num -1]
-        except IndexError:
+        except (IndexError, KeyError):
             print('WARNING: Beamflux not found for {}!'.format(basename))
     
-    # default bruker header
-    header = bruker_header()
+    # APS to Bruker header
+    # - the entries of the run are built once (per process)
+    # - the angles, flux and statistics of the frame are the
+    #   single row of the frame columns (see run_headers_APS)
+    created = dt.fromtimestamp(os.path.getmtime(fname)).strftime('%Y-%m-%d %H:%M:%S') # use creation time of raw data!
+    headers = get_run_headers(('APS', path_to, frame_stem, frame_run), run_headers_APS, run_info, [frm_info], [stats],
+                              [(basename, frame_num, created)], data.shape, (offset_rows, offset_cols), rows, cols, flux=[scan_flx])
+    header = headers[0]
     
-    # fill known header items
-    header['NCOLS']      = [data.shape[1]]                           # Number of pixels per row; number of mosaic tiles in X; dZ/dX
-    header['NROWS']      = [data.shape[0]]                           # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
-    header['CENTER'][:]  = [beam_x, beam_y, beam_x, beam_y]          # 
-    header['CCDPARM'][:] = [0.00, 1.00, 1.00, 1.00, 1169523]
-    header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-    header['DETTYPE'][:] = ['PILATUS3-1M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
-    header['SITE']       = ['ANL/APS/15ID-D']                        # Site name
-    header['MODEL']      = ['Synchrotron']                           # Diffractometer model
-    header['TARGET']     = ['Undulator']                             # X-ray target material)
-    header['USER']       = ['USER']                                  # Username
-    header['SOURCEK']    = ['?']                                     # X-ray source kV
-    header['SOURCEM']    = ['?']                                     # Source milliamps
-    header['WAVELEN'][:] = [source_w, source_w, source_w]            # Wavelengths (average, a1, a2)
-    header['FILENAM']    = [basename]
-    header['CUMULAT']    = [scan_exp]                                # Accumulated exposure time in real hours
-    header['ELAPSDR']    = [scan_ext]                                # Requested time for this frame in seconds
-    header['ELAPSDA']    = [scan_exp]                                # Actual time for this frame in seconds
-    header['START'][:]   = scan_sta                                  # Starting scan angle value, decimal deg
-    header['ANGLES'][:]  = [goni_tth, goni_omg, scan_sta, goni_chi]  # Diffractometer setting angles, deg. (2Th, omg, phi, chi)
-    header['ENDING'][:]  = [goni_tth, goni_omg, scan_end, goni_chi]  # Setting angles read at end of scan
-    header['TYPE']       = ['Generic Phi Scan']                      # String indicating kind of data in the frame
-    header['DISTANC']    = [goni_dxt / 10.0]                         # Sample-detector distance, cm
-    header['RANGE']      = [abs(scan_inc)]                           # Magnitude of scan range in decimal degrees
-    header['INCREME']    = [scan_inc]                                # Signed scan angle increment between frames
-    header['NUMBER']     = [frame_num]                               # Number of this frame in series (zero-based)
-    header['NFRAMES']    = ['?']                                     # Number of frames in the series
-    header['AXIS'][:]    = [3]                                       # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
-    header['LOWTEMP'][:] = [1, int((-273.15 + 20.0) * 100.0), -6000] # Low temp flag; experiment temperature*100; detector temp*100
-    header['NEXP'][2]    = baseline_offset
-    header['MAXXY']      = np.array(np.where(data == data.max()), np.float)[:, 0]
-    header['MAXIMUM']    = [np.max(data)]
-    header['MINIMUM']    = [np.min(data)]
-    header['NCOUNTS'][:] = [data.sum(), scan_flx]
-    header['NPIXELB'][:] = [1, 1]                                    # bytes/pixel in main image, bytes/pixel in underflow table
-    header['NOVER64'][:] = [data[data > 64000].shape[0], 0, 0]
-    header['NSTEPS']     = [1]                                       # steps or oscillations in this frame
-    header['COMPRES']    = ['NONE']                                  # compression scheme if any
-    header['TRAILER']    = [0]                                       # byte pointer to trailer info
-    header['LINEAR'][:]  = [1.00, 0.00]     
-    header['PHD'][:]     = [1.00, 0.00]
-    header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
-    header['DISPLIM'][:] = [0.0, 63.0]                               # Recommended display contrast window settings
-    header['FILTER2'][:] = [90.0, 0.0, 0.0, 1.0]                     # Monochromator 2-theta, roll (both deg)
-    header['CREATED']    = [dt.fromtimestamp(os.path.getmtime(fname)).strftime('%Y-%m-%d %H:%M:%S')]# use creation time of raw data!
+    # stack: return the header and the frame, the pipeline
+    # writes them to the HDF5 stack of the run (see _Stack.py)
+    if stack:
+        return header, data
     
     # write the frame
-    write_bruker_frame(outName, header, data)
+    # the header template is shared by all frames of the run
+    # encode: return the buffers, the pipeline writes them
+    template = get_header_template((path_sfrm, frame_stem, frame_run))
+    if encode:
+        return encode_bruker_frame(header, data, template=template, out=out_image)
+    write_bruker_frame(outName, header, data, template=template)
     return True
 
-def convert_frame_SP8_Bruker(fname, path_sfrm, tth_corr=0.0, rows=1043, cols=981, offset=4096, overwrite=True):
+@profile_stage('convert', size_of_file)
+def convert_frame_SP8_Bruker(fname, path_sfrm, tth_corr=0.0, rows=1043, cols=981, offset=4096, overwrite=True, stream=None, encode=False, slot=None, stack=False):
     '''
      
     '''
-    import os, re
+    import os
     import numpy as np
     from datetime import datetime as dt
     
@@ -693,32 +1912,26 @@ def convert_frame_SP8_Bruker(fname, path_sfrm, tth_corr=0.0, rows=1043, cols=981
     frame_stem, frame_run, frame_num, _ = get_run_info(basename)
     
     # output file format: some_name_rr_ffff.sfrm
-    outName = os.path.join(path_to, path_sfrm, '{}_{:>02}_{:>04}.sfrm'.format(frame_stem, frame_run, frame_num))
+    outName = get_sfrm_name(fname, path_sfrm)
 
     # check if file exists and overwrite flag
     if os.path.exists(outName) and overwrite == False:
         return False
     
     # read in the frame
-    _, data = read_pilatus_tif(fname, rows, cols, offset, np.int32)
+    # stream: the raw bytes, fetched by the pipeline
+    _, data = read_pilatus_tif(fname, rows, cols, offset, np.int32, mmap=True, stream=stream)
+    # slot: shared memory buffers of the pipeline (see _FramePool.py)
+    # the frame is preprocessed and encoded in place
+    out_data = None if slot is None else slot.data
+    out_image = None if slot is None else slot.image
     
-    # get the frame saint ready
+    # get the frame saint ready 
     # - pad with zeros
-    data, offset_rows, offset_cols = pilatus_pad(data)
-    
-    # the frame has to be rotated by 90 degrees
-    data = np.rot90(data, k=1, axes=(1, 0))
-    
-    # the dead areas are flagged -1
-    data[data == -1] = 0
-    
-    # bad pixels are flagged -2
-    data[data == -2] = 0
-    
-    # scale the data to avoid underflow tables
-    # should yield zero for Pilatus3 images!
-    baseline_offset = -1 * data.min()
-    data += baseline_offset
+    # - the frame has to be rotated by 90 degrees
+    # - dead areas (-1) and bad pixels (-2) to zero
+    # - scale the data to avoid underflow tables
+    data, offset_rows, offset_cols, stats = preprocess_frame(data, rotate=True, out=out_data)
     
     # info file name
     infFile = os.path.join(path_to, basename + '.inf')
@@ -729,110 +1942,46 @@ def convert_frame_SP8_Bruker(fname, path_sfrm, tth_corr=0.0, rows=1043, cols=981
         return False
     
     # extract header information
+    # - the static fields are parsed once per run
+    # - current, angles and scan range are parsed per frame
     with open(infFile) as rFile:
         infoFile = rFile.read()
-        #det_dim_x = int(re.search('SIZE1\s*=\s*(\d+)\s*;', infoFile).groups()[0])
-        #det_dim_y = int(re.search('SIZE2\s*=\s*(\d+)\s*;', infoFile).groups()[0])
-        #det_size_x, det_size_y = [float(i) for i in re.search('CCD_DETECTOR_SIZE\s*=\s*(\d+\.\d+)\s*(\d+\.\d+)\s*;', infoFile).groups()]
-        det_beam_x, det_beam_y = [float(i) for i in re.search('CCD_SPATIAL_BEAM_POSITION\s*=\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*;', infoFile).groups()]
-        det_maxv = int(re.search('SATURATED_VALUE\s*=\s*(\d+)\s*;', infoFile).groups()[0])
-        source_w = float(re.search('SCAN_WAVELENGTH\s*=\s*(\d+\.\d+)\s*;', infoFile).groups()[0])
-        source_a = float(re.search('SOURCE_AMPERAGE\s*=\s*(\d+\.\d+)\s*mA\s*;', infoFile).groups()[0])
-        source_v = float(re.search('SOURCE_VOLTAGE\s*=\s*(\d+\.\d+)\s*GeV\s*;', infoFile).groups()[0])
-        goni_omg, goni_chi, goni_phi = [float(i) for i in re.search('CRYSTAL_GONIO_VALUES\s*=\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*;', infoFile).groups()]
-        goni_tth, goni_dxt = [float(i) for i in re.search('SCAN_DET_RELZERO\s*=\s*-*\d+\.\d+\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*;', infoFile).groups()]
-        scan_rax = str(re.search('ROTATION_AXIS_NAME\s*=\s*(\w+)\s*;', infoFile).groups()[0])
-        scan_num = float(re.search('SCAN_SEQ_INFO\s*=\s*\d+\s*\d+\s*(\d+)\s*;', infoFile).groups()[0])
-        scan_sta, scan_end, scan_inc, scan_exp = [float(i) for i in re.search('SCAN_ROTATION\s*=\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*(-*\d+\.\d+)\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*-*\d+\.\d+\s*;', infoFile).groups()]
-    
-    # For some reason the distance is missing for some runs.
-    # At SPring-8 the detector distance 'cannot' be changed.
-    # So, we hard-code 130.0 on missing entry here!
-    if goni_dxt == 0.0:
-        goni_dxt = 130.0
-    
-    # initial frame dimensions are needed to calculate
-    # the beamcenter of the reshaped frame and
-    # adjust the beam center to the rotation
-    beam_x = det_beam_y + offset_rows
-    beam_y = cols - det_beam_x + offset_cols
-    
-    # 2-th were misaligned (pre 2019 data)
-    goni_tth = goni_tth + (goni_tth * tth_corr)
-    
-    # SP8 to Bruker conversion:
-    goni_chi = -goni_chi
-
-    # calculate detector pixel per cm
-    # this is normalized to a 512x512 detector format
-    # PILATUS3-1M pixel size is 0.172 mm 
-    pix_per_512 = round((10.0 / 0.172) * (512.0 / ((rows + cols) / 2.0)), 6)
-
-    # convert SP8 to Bruker angles
-    RAXIS2BRUKER = {'Omega':1, 'Chi':2, 'Phi':0}
-    axis_start = [goni_tth, goni_omg, goni_phi, goni_chi]
-    axis_start[RAXIS2BRUKER[scan_rax]] = scan_sta
-    axis_end = [goni_tth, goni_omg, goni_phi, goni_chi]
-    axis_end[RAXIS2BRUKER[scan_rax]] = scan_end
+    run_info = get_run_metadata(('SP8', path_to, frame_stem, frame_run), _SP8_STATIC, infoFile)
+    frm_info = _SP8_FRAME.parse(infoFile)
+    #det_dim_x = int(re.search('SIZE1\s*=\s*(\d+)\s*;', infoFile).groups()[0])
+    #det_dim_y = int(re.search('SIZE2\s*=\s*(\d+)\s*;', infoFile).groups()[0])
+    #det_size_x, det_size_y = [float(i) for i in re.search('CCD_DETECTOR_SIZE\s*=\s*(\d+\.\d+)\s*(\d+\.\d+)\s*;', infoFile).groups()]
     
-    # default bruker header
-    header = bruker_header()
+    # SP8 to Bruker header
+    # - the entries of the run are built once (per process)
+    # - the angles, current and statistics of the frame are the
+    #   single row of the frame columns (see run_headers_SP8)
+    # - 2-th were misaligned (pre 2019 data)
+    created = dt.fromtimestamp(os.path.getmtime(fname)).strftime('%Y-%m-%d %H:%M:%S') # use creation time of raw data!
+    headers = get_run_headers(('SP8', path_to, frame_stem, frame_run), run_headers_SP8, run_info, [frm_info], [stats],
+                              [(basename, frame_num, created)], data.shape, (offset_rows, offset_cols), rows, cols, tth_corr=tth_corr)
+    header = headers[0]
     
-    # fill known header items
-    header['NCOLS']      = [data.shape[1]]                                      # Number of pixels per row; number of mosaic tiles in X; dZ/dX
-    header['NROWS']      = [data.shape[0]]                                      # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
-    header['CENTER'][:]  = [beam_x, beam_y, beam_x, beam_y]                     # adjust the beam center for the filling/cutting of the frame
-    header['CCDPARM'][:] = [1.00, 1.00, 1.00, 1.00, det_maxv]
-    header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-    header['DETTYPE'][:] = ['PILATUS3-1M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
-    header['SITE']       = ['SPring-8/BL02B1']                                  # Site name
-    header['MODEL']      = ['Synchrotron']                                      # Diffractometer model
-    header['TARGET']     = ['Bending Magnet']                                   # X-ray target material)
-    header['USER']       = ['USER']                                             # Username
-    header['SOURCEK']    = [source_v]                                           # X-ray source kV
-    header['SOURCEM']    = [source_a]                                           # Source milliamps
-    header['WAVELEN'][:] = [source_w, source_w, source_w]                       # Wavelengths (average, a1, a2)
-    header['FILENAM']    = [basename]
-    header['CUMULAT']    = [scan_exp]                                           # Accumulated exposure time in real hours
-    header['ELAPSDR']    = [scan_exp]                                           # Requested time for this frame in seconds
-    header['ELAPSDA']    = [scan_exp]                                           # Actual time for this frame in seconds
-    header['START'][:]   = scan_sta                                             # Starting scan angle value, decimal deg
-    header['ANGLES'][:]  = axis_start                                           # Diffractometer setting angles, deg. (2Th, omg, phi, chi)
-    header['ENDING'][:]  = axis_end                                             # Setting angles read at end of scan
-    header['TYPE']       = ['Generic {} Scan'.format(scan_rax)]                 # String indicating kind of data in the frame
-    header['DISTANC']    = [float(goni_dxt) / 10.0]                             # Sample-detector distance, cm
-    header['RANGE']      = [abs(scan_inc)]                                      # Magnitude of scan range in decimal degrees
-    header['INCREME']    = [scan_inc]                                           # Signed scan angle increment between frames
-    header['NUMBER']     = [frame_num]                                          # Number of this frame in series (zero-based)
-    header['NFRAMES']    = [int(scan_num)]                                      # Number of frames in the series
-    header['AXIS'][:]    = [RAXIS2BRUKER[scan_rax]]                             # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
-    header['LOWTEMP'][:] = [1, int((-273.15 + 20.0) * 100.0), -6000]            # Low temp flag; experiment temperature*100; detector temp*100
-    header['NEXP'][2]    = baseline_offset
-    header['MAXXY']      = np.array(np.where(data == data.max()), np.float)[:, 0]
-    header['MAXIMUM']    = [np.max(data)]
-    header['MINIMUM']    = [np.min(data)]
-    header['NCOUNTS'][:] = [data.sum(), 0]
-    header['NOVER64'][:] = [data[data > 64000].shape[0], 0, 0]
-    header['NSTEPS']     = [1]                                                  # steps or oscillations in this frame
-    header['NPIXELB'][:] = [1, 1]                                               # bytes/pixel in main image, bytes/pixel in underflow table
-    header['COMPRES']    = ['NONE']                                             # compression scheme if any
-    header['TRAILER']    = [0]                                                  # byte pointer to trailer info
-    header['LINEAR'][:]  = [1.00, 0.00]     
-    header['PHD'][:]     = [1.00, 0.00]
-    header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
-    header['DISPLIM'][:] = [0.0, 100.0]                                         # Recommended display contrast window settings
-    header['FILTER2'][:] = [90.0, 0.0, 0.0, 1.0]                                # Monochromator 2-theta, roll (both deg)
-    header['CREATED']    = [dt.fromtimestamp(os.path.getmtime(fname)).strftime('%Y-%m-%d %H:%M:%S')]# use creation time of raw data!
+    # stack: return the header and the frame, the pipeline
+    # writes them to the HDF5 stack of the run (see _Stack.py)
+    if stack:
+        return header, data
     
     # write the frame
-    write_bruker_frame(outName, header, data)
+    # the header template is shared by all frames of the run
+    # encode: return the buffers, the pipeline writes them
+    template = get_header_template((path_sfrm, frame_stem, frame_run))
+    if encode:
+        return encode_bruker_frame(header, data, template=template, out=out_image)
+    write_bruker_frame(outName, header, data, template=template)
     return True
 
-def convert_frame_DLS_Bruker(fname, path_sfrm, rows=1679, cols=1475, offset=0, overwrite=True):
+@profile_stage('convert', size_of_file)
+def convert_frame_DLS_Bruker(fname, path_sfrm, rows=1679, cols=1475, offset=0, overwrite=True, stream=None, encode=False, slot=None, stack=False):
     '''
     
     '''
-    import os, re
+    import os
     import numpy as np
     from datetime import datetime as dt
     
@@ -842,125 +1991,51 @@ def convert_frame_DLS_Bruker(fname, path_sfrm, rows=1679, cols=1475, offset=0, o
     frame_stem, frame_run, frame_num, _ = get_run_info(basename)
     
     # output file format: some_name_rr_ffff.sfrm
-    outName = os.path.join(path_to, path_sfrm, '{}_{:>02}_{:>04}.sfrm'.format(frame_stem, frame_run, frame_num))
+    outName = get_sfrm_name(fname, path_sfrm)
 
     # check if file exists and overwrite flag
     if os.path.exists(outName) and overwrite == False:
         return False
     
     # read in the frame
-    header, data = read_pilatus_cbf(fname)
+    # stream: the raw bytes, fetched by the pipeline
+    # slot: shared memory buffers of the pipeline (see _FramePool.py)
+    # the frame is decoded, preprocessed and encoded in place
+    header, data = read_pilatus_cbf(fname, mmap=True, stream=stream, out=None if slot is None else slot.frame)
+    out_data = None if slot is None else slot.data
+    out_image = None if slot is None else slot.image
     
     # get the frame saint ready 
-    # - multiple of 128x128 pixels
     # - pad with zeros
-    data, offset_rows, offset_cols = pilatus_pad(data)
+    # - dead areas (-1) and bad pixels (-2) to zero
+    # - scale the data to avoid underflow tables
+    data, offset_rows, offset_cols, stats = preprocess_frame(data, rotate=False, out=out_data)
     
-    # the dead areas are flagged -1
-    data[data == -1] = 0
-    # bad pixels are flagged -2
-    data[data == -2] = 0
-    
-    # scale the data to avoid underflow tables
-    baseline_offset = -1 * data.min()
-    data += baseline_offset
+    # extract scan info from cbf header
+    # - the static fields are parsed once per run
+    # - the angles are parsed per frame
+    run_info = get_run_metadata(('DLS', path_to, frame_stem, frame_run), _DLS_STATIC, header)
+    frm_info = _DLS_FRAME.parse(header)
     
-    # extract scan info from tif header
-    sca_ext = float(re.search('Exposure_time\s+(\d+\.\d+)\s+s', header).groups()[0])
-    sca_exp = float(re.search('Exposure_period\s+(\d+\.\d+)\s+s', header).groups()[0])
-    gon_dxt = float(re.search('Detector_distance\s+(\d+\.\d+)\s+m', header).groups()[0]) * 1000.0
-    src_wav = float(re.search('Wavelength\s+(\d+\.\d+)\s+A', header).groups()[0])
-    sta_phi = float(re.search('Phi\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    inc_phi = float(re.search('Phi_increment\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    sta_chi = float(re.search('Chi\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    inc_chi = float(re.search('Chi_increment\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    sta_omg = float(re.search('Omega\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    inc_omg = float(re.search('Omega_increment\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    sta_tth = float(re.search('Detector_2theta\s+(-*\d+\.\d+)\s+deg.', header).groups()[0])
-    pil_x   = float(re.search('Beam_xy\s+\((\d+\.\d+),\s+(\d+\.\d+)\)\s+pixels', header).groups()[0])
-    pil_y   = float(re.search('Beam_xy\s+\((\d+\.\d+),\s+(\d+\.\d+)\)\s+pixels', header).groups()[1])
-    
-    # initial frame dimensions are needed to calculate
-    # the beamcenter of the reshaped frame and
-    # adjust the beam center to the Bruker flip
-    # numpy array starts in the upper left corner
-    # Bruker starts lower left
-    beam_y = rows - pil_y + offset_rows
-    beam_x = pil_x + offset_cols
+    # DLS to Bruker header
+    # - the entries of the run are built once (per process)
+    # - the angles and statistics of the frame are the single
+    #   row of the frame columns (see run_headers_DLS)
+    created = dt.fromtimestamp(os.path.getmtime(fname)).strftime('%Y-%m-%d %H:%M:%S') # use creation time of raw data!
+    headers = get_run_headers(('DLS', path_to, frame_stem, frame_run), run_headers_DLS, run_info, [frm_info], [stats],
+                              [(basename, frame_num, created)], data.shape, (offset_rows, offset_cols), rows, cols)
+    header = headers[0]
     
-    # DLS to Bruker conversion:
-    sta_tth = round(-sta_tth, 4)
-    sta_omg = round(180.0 - sta_omg, 4)
-    inc_omg = round(-inc_omg, 4)
-    sta_chi = round(-sta_chi, 4)
-    inc_chi = round(-inc_chi, 4)
-    
-    # ending positions
-    end_phi = round(sta_phi + inc_phi, 4)
-    end_chi = round(sta_chi + inc_chi, 4)
-    end_omg = round(sta_omg + inc_omg, 4)
-    end_tth = round(sta_tth, 4)
-    
-    # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
-    ang_nam = ['Omega',  'Phi' ,  'Chi' ]
-    ang_inc = [inc_omg, inc_phi, inc_chi]
-    ang_sta = [sta_omg, sta_phi, sta_chi]
-    sca_nam, sca_axs, sca_sta, sca_inc = [(ang_nam[i], int(i+2), ang_sta[i], round(v,4)) for i,v in enumerate(ang_inc) if v != 0.0][0]
-    
-    # calculate detector pixel per cm
-    # this is normalized to a 512x512 detector format
-    # PILATUS3 pixel size is 0.172 mm 
-    pix_per_512 = round((10.0 / 0.172) * (512.0 / ((rows + cols) / 2.0)), 6)
-    
-    # default bruker header
-    header = bruker_header()
-    
-    # fill known header items
-    header['NCOLS']      = [data.shape[1]]                           # Number of pixels per row; number of mosaic tiles in X; dZ/dX
-    header['NROWS']      = [data.shape[0]]                           # Number of rows in frame; number of mosaic tiles in Y; dZ/dY value
-    header['CENTER'][:]  = [beam_x, beam_y, beam_x, beam_y]          # 
-    header['CCDPARM'][:] = [0.00, 1.00, 1.00, 1.00, 1169523]
-    header['DETPAR'][:]  = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-    header['DETTYPE'][:] = ['PILATUS3-2M', pix_per_512, 0.00, 0, 0.001, 0.0, 0]
-    header['SITE']       = ['DLS/I19-1']                             # Site name
-    header['MODEL']      = ['Synchrotron']                           # Diffractometer model
-    header['TARGET']     = ['Undulator']                             # X-ray target material)
-    header['USER']       = ['?']                                     # Username
-    header['SOURCEK']    = ['?']                                     # X-ray source kV
-    header['SOURCEM']    = ['?']                                     # Source milliamps
-    header['WAVELEN'][:] = [src_wav, src_wav, src_wav]               # Wavelengths (average, a1, a2)
-    header['FILENAM']    = [basename]
-    header['CUMULAT']    = [sca_exp]                                 # Accumulated exposure time in real hours
-    header['ELAPSDR']    = [sca_ext]                                 # Requested time for this frame in seconds
-    header['ELAPSDA']    = [sca_exp]                                 # Actual time for this frame in seconds
-    header['START'][:]   = sca_sta                                   # Starting scan angle value, decimal deg
-    header['ANGLES'][:]  = [sta_tth, sta_omg, sta_phi, sta_chi]      # Diffractometer setting angles, deg. (2Th, omg, phi, chi)
-    header['ENDING'][:]  = [end_tth, end_omg, end_phi, end_chi]      # Setting angles read at end of scan
-    header['TYPE']       = ['Generic {} Scan'.format(sca_nam)]       # String indicating kind of data in the frame
-    header['DISTANC']    = [float(gon_dxt) / 10.0]                   # Sample-detector distance, cm
-    header['RANGE']      = [abs(sca_inc)]                            # Magnitude of scan range in decimal degrees
-    header['INCREME']    = [sca_inc]                                 # Signed scan angle increment between frames
-    header['NUMBER']     = [frame_num]                               # Number of this frame in series (zero-based)
-    header['NFRAMES']    = ['?']                                     # Number of frames in the series
-    header['AXIS'][:]    = [sca_axs]                                 # Scan axis (1=2-theta, 2=omega, 3=phi, 4=chi)
-    header['LOWTEMP'][:] = [1, 0, 0]                                 # Low temp flag; experiment temperature*100; detector temp*100
-    header['NEXP'][2]    = baseline_offset
-    header['MAXXY']      = np.array(np.where(data == data.max()), np.float)[:, 0]
-    header['MAXIMUM']    = [np.max(data)]
-    header['MINIMUM']    = [np.min(data)]
-    header['NCOUNTS'][:] = [data.sum(), 0]
-    header['NPIXELB'][:] = [1, 1]                                    # bytes/pixel in main image, bytes/pixel in underflow table
-    header['NOVER64'][:] = [data[data > 64000].shape[0], 0, 0]
-    header['NSTEPS']     = [1]                                       # steps or oscillations in this frame
-    header['COMPRES']    = ['NONE']                                  # compression scheme if any
-    header['TRAILER']    = [0]                                       # byte pointer to trailer info
-    header['LINEAR'][:]  = [1.00, 0.00]     
-    header['PHD'][:]     = [1.00, 0.00]
-    header['OCTMASK'][:] = [0, 0, 0, 1023, 1023, 2046, 1023, 1023]
-    header['DISPLIM'][:] = [0.0, 63.0]                               # Recommended display contrast window settings
-    header['FILTER2'][:] = [90.0, 0.0, 0.0, 1.0]                     # Monochromator 2-theta, roll (both deg)
-    header['CREATED']    = [dt.fromtimestamp(os.path.getmtime(fname)).strftime('%Y-%m-%d %H:%M:%S')]# use creation time of raw data!
+    # stack: return the header and the frame, the pipeline
+    # writes them to the HDF5 stack of the run (see _Stack.py)
+    if stack:
+        return header, data
     
     # write the frame
-    write_bruker_frame(outName, header, data)
+    # the header template is shared by all frames of the run
+    # encode: return the buffers, the pipeline writes them
+    template = get_header_template((path_sfrm, frame_stem, frame_run))
+    if encode:
+        return encode_bruker_frame(header, data, template=template, out=out_image)
+    write_bruker_frame(outName, header, data, template=template)
     return True
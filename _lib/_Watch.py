@@ -0,0 +1,332 @@
+import os, sys, time, fnmatch, select, struct, logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
+from _Batch import FRAME_EXTS, ConversionManifest, get_conversion, convert_chunk
+from _Utility import get_sfrm_name, clear_run_caches
+from _Profile import percentile
+
+log = logging.getLogger('pilatus3-fc.watch')
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+def inotify_watch(path):
+    '''
+     inotify file descriptor watching path for closed
+     and moved-in files, None if inotify is not available
+     (not Linux, no libc, watch limit reached)
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+    except (OSError, AttributeError):
+        return None
+    return fd
+
+class FrameWatcher():
+    '''
+     follow a directory and report frames once the detector
+     has finished writing them
+      - inotify (Linux): a frame is complete once the writer
+        closed it (or it was moved into the directory)
+      - polling fallback: a frame is complete once its size and
+        mtime did not change for 'settle' seconds
+      - inotify only reports events, the directory is still
+        scanned to pick up frames written before the watch
+        started and to catch overflowing event queues
+      - poll() never blocks, wait() blocks until an inotify
+        event arrived or the timeout expired
+      - a reported frame is not reported again until done()
+        was called for it, a frame is known once it converted,
+        a failed frame is reported again after a backoff of
+        'retry' seconds, doubled with every failure (at most
+        'max_retry' seconds), e.g. an SP8 frame whose .inf
+        file was written after the image
+      - a frame that failed 'attempts' times is given up
+        (known), e.g. a corrupt frame
+    '''
+    def __init__(self, path, exts=FRAME_EXTS, settle=1.0, known=(), use_inotify=True, retry=1.0, max_retry=60.0, attempts=8):
+        self.path = os.path.abspath(path)
+        self.exts = exts
+        self.settle = settle
+        self.retry = retry
+        self.max_retry = max_retry
+        self.attempts = attempts
+        # frames converted or given up (or converted earlier)
+        self.known = set(known)
+        # frames reported, not yet done
+        self.active = set()
+        # failed frames: name: (failures, time of the next attempt)
+        self.failed = {}
+        # name: (size, mtime_ns, time the state was first seen)
+        self.state = {}
+        # frames closed by the writer (inotify)
+        self.closed = set()
+        self.fd = inotify_watch(self.path) if use_inotify else None
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        select.select([self.fd], [], [], timeout)
+
+    def read_events(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            if not buf:
+                return
+            # struct inotify_event: wd, mask, cookie, len, name
+            pos = 0
+            while pos < len(buf):
+                _, mask, _, nlen = struct.unpack_from('iIII', buf, pos)
+                name = buf[pos + 16:pos + 16 + nlen].rstrip(b'\0')
+                pos += 16 + nlen
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    name = os.fsdecode(name)
+                    if self.match(name):
+                        self.closed.add(os.path.join(self.path, name))
+
+    def match(self, name):
+        return any(fnmatch.fnmatch(name, ext) for ext in self.exts)
+
+    def poll(self):
+        '''
+         returns the frames that are complete since the
+         last call, sorted by name
+        '''
+        if self.fd is not None:
+            self.read_events()
+        now = time.time()
+        ready = []
+        retry = set()
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.path in self.known or entry.path in self.active:
+                    continue
+                if not self.match(entry.name):
+                    continue
+                if entry.path in self.failed:
+                    # complete already, wait for the backoff
+                    retry.add(entry.path)
+                    if now >= self.failed[entry.path][1]:
+                        ready.append(entry.path)
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if stat.st_size == 0:
+                    continue
+                if entry.path in self.closed:
+                    ready.append(entry.path)
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                previous = self.state.get(entry.path)
+                if previous is None or previous[:2] != current:
+                    self.state[entry.path] = current + (now,)
+                elif now - previous[2] >= self.settle:
+                    ready.append(entry.path)
+        # failed frames that were removed
+        for fname in set(self.failed) - retry:
+            del self.failed[fname]
+        for fname in ready:
+            self.active.add(fname)
+            self.state.pop(fname, None)
+            self.closed.discard(fname)
+        return sorted(ready)
+
+    def done(self, fname, success=True):
+        '''
+         a reported frame converted (known) or failed
+         (reported again after the backoff)
+         returns the backoff in seconds, None if the frame
+         is finished (converted or given up)
+        '''
+        self.active.discard(fname)
+        failures = self.failed.pop(fname, (0, 0))[0] + 1
+        if success or failures >= self.attempts:
+            self.known.add(fname)
+            return None
+        delay = min(self.retry * 2 ** (failures - 1), self.max_retry)
+        self.failed[fname] = (failures, time.time() + delay)
+        return delay
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class WatchPool():
+    '''
+     convert the frames reported by a FrameWatcher in a pool
+     of worker processes (convert_chunk, see _Batch.py)
+      - add(): queue frames, frames already converted are
+        skipped if overwrite is False
+      - submit(): as many frames as are queued, at most
+        'chunksize' per task
+      - back-pressure: at most 2 * workers tasks are in flight,
+        the other frames wait in the queue
+      - collect(): the finished frames as (fname, record)
+        tuples, the record is None if the conversion failed,
+        the watcher is told (done()), a frame that is retried
+        is not returned
+      - callback: called with the future of every finished
+        task (in a thread of the pool), e.g. to wake up an
+        event loop, collect() never blocks with timeout=0
+      - shutdown(wait=False): queued tasks are cancelled,
+        running tasks finish in the background
+    '''
+    def __init__(self, watcher, conversion, args, kwargs, workers=None, chunksize=16, callback=None):
+        self.watcher = watcher
+        self.conversion = conversion
+        self.args = args
+        self.kwargs = kwargs
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.callback = callback
+        self.queue = []
+        self.pending = {}
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=clear_run_caches)
+
+    def add(self, frames):
+        '''
+         returns the frames skipped (output exists)
+        '''
+        skipped = []
+        for fname in frames:
+            if not self.kwargs.get('overwrite', True) and os.path.exists(get_sfrm_name(fname, self.args[0])):
+                self.watcher.done(fname)
+                skipped.append(fname)
+            else:
+                self.queue.append(fname)
+        return skipped
+
+    def submit(self):
+        while self.queue and len(self.pending) < 2 * self.workers:
+            chunk, self.queue = self.queue[:self.chunksize], self.queue[self.chunksize:]
+            log.debug('submit first=%s frames=%d queued=%d', os.path.basename(chunk[0]), len(chunk), len(self.queue))
+            future = self.pool.submit(convert_chunk, self.conversion, chunk, self.args, self.kwargs, True)
+            self.pending[future] = chunk
+            if self.callback is not None:
+                future.add_done_callback(self.callback)
+
+    def collect(self, timeout=0):
+        results = []
+        if not self.pending:
+            return results
+        done, _ = wait(list(self.pending), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk = self.pending.pop(future)
+            try:
+                records = [record for _, record in future.result()]
+            except Exception as e:
+                # the pool is broken (a worker died)
+                print('ERROR: Conversion failed: {}'.format(e))
+                records = [None] * len(chunk)
+            for fname, record in zip(chunk, records):
+                delay = self.watcher.done(fname, record is not None)
+                if delay is None:
+                    results.append((fname, record))
+                else:
+                    log.info('retry frame=%s delay_s=%.1f', fname, delay)
+        return results
+
+    def busy(self):
+        return bool(self.queue or self.pending)
+
+    def shutdown(self, wait=True):
+        self.queue = []
+        self.pool.shutdown(wait=wait, cancel_futures=True)
+
+def run_watch(path_input, path_output, site, workers=None, chunksize=16, overwrite=True, interval=0.5, settle=1.0, idle=None):
+    '''
+     convert the frames in path_input while they are written
+      - new frames are streamed to a pool of worker processes
+        (WatchPool), failed frames are retried, a frame is
+        reported as failed once it is given up
+      - frames listed as complete in the manifest of the output
+        directory are not converted again
+      - latency: time from the frame written (mtime) to its
+        .sfrm written, reported per frame and summarised at the end
+      - stops after 'idle' seconds without new frames (None:
+        until interrupted, Ctrl+C)
+    '''
+    path_input = os.path.abspath(path_input)
+    path_output = os.path.abspath(path_output)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Make directories recursively
+    if not os.path.exists(path_output):
+        os.makedirs(path_output)
+
+    manifest = ConversionManifest(path_output)
+    stale = set(manifest.pending(list(manifest.records)))
+    known = [fname for fname in manifest.records if fname not in stale]
+    watcher = FrameWatcher(path_input, settle=settle, known=known)
+    print('Watching {} ({})'.format(path_input, 'inotify' if watcher.fd is not None else 'polling'), flush=True)
+
+    pool = None
+    latency = []
+    converted = 0
+    last_frame = time.time()
+    try:
+        while True:
+            ready = watcher.poll()
+            # retries do not count as new frames
+            if any(fname not in watcher.failed for fname in ready):
+                last_frame = time.time()
+
+            # the conversion needs a first frame (SP8 timestamp)
+            if pool is None and ready:
+                setup = get_conversion(site, ready[0], path_input, path_output, overwrite)
+                if setup is None:
+                    print('ERROR: Unknown facility: {}'.format(site))
+                    return False
+                conversion, args, kwargs = setup
+                pool = WatchPool(watcher, conversion, args, kwargs, workers, chunksize)
+
+            if pool is not None:
+                for fname in pool.add(ready):
+                    print('{:>6} {} exists'.format('', os.path.basename(fname)), flush=True)
+                pool.submit()
+
+            if pool is None or not pool.busy():
+                # frames waiting for a retry keep the watch alive
+                if idle is not None and not watcher.failed and time.time() - last_frame > idle:
+                    break
+                watcher.wait(interval)
+                continue
+
+            for fname, record in pool.collect(interval):
+                if record is None:
+                    print('{:>6} {} failed'.format('', os.path.basename(fname)), flush=True)
+                    continue
+                manifest.add(record)
+                converted += 1
+                latency.append(time.time() - record['mtime'] / 1e9)
+                print('{:>6} {} {:.2f}s'.format(converted, os.path.basename(fname), latency[-1]), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        watcher.close()
+        manifest.close()
+
+    print('Successfully converted {} images!'.format(converted))
+    if latency:
+        print('Latency: p50 {:.2f}s, p95 {:.2f}s, max {:.2f}s'.format(percentile(sorted(latency), 50), percentile(sorted(latency), 95), max(latency)))
+    return True
@@ -1,19 +1,127 @@
 _REVISION = 'v2019-07-02'
 
-import sys, os, logging
-from PyQt5 import QtWidgets
+import sys, os, logging, argparse
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '_lib'))
-from _Classes_GUI import Main_GUI
+from _Sites import SITES
+from _Batch import MASK_GEOMETRY_NAME, run_convert, run_masks, run_verify, run_export
+from _Watch import run_watch
+from _Benchmark import run_benchmark
 
 def main():
-    logging.debug(__name__)
+    # PyQt5 is only needed for the GUI
+    # the headless commands must run without an X display
+    from PyQt5 import QtWidgets
+    from _Classes_GUI import Main_GUI
     app = QtWidgets.QApplication(sys.argv)
     w = Main_GUI()
     w.setWindowTitle('Convert Pilatus3 Data to Bruker Format, {} | lkrause@chem.au.dk'.format(_REVISION))
     w.show()
     sys.exit(app.exec_())
 
+def main_convert(args):
+    if not run_convert(args.input, args.output, args.site, workers=args.workers,
+                       chunksize=args.chunksize, overwrite=not args.skip_existing, resume=args.resume, verify=args.verify,
+                       profile=args.profile, trace=args.trace, io_threads=args.io_threads, inflight=args.inflight, hdf5=args.hdf5):
+        sys.exit(1)
+
+def main_verify(args):
+    if not run_verify(args.input, args.output, args.site, workers=args.workers, chunksize=args.chunksize):
+        sys.exit(1)
+
+def main_export(args):
+    if not run_export(args.stacks, args.output, frames=args.frames, overwrite=args.overwrite):
+        sys.exit(1)
+
+def main_watch(args):
+    if not run_watch(args.input, args.output, args.site, workers=args.workers, chunksize=args.chunksize,
+                     overwrite=not args.skip_existing, interval=args.interval, settle=args.settle, idle=args.idle):
+        sys.exit(1)
+
+def main_mask(args):
+    if not run_masks(args.input, args.output, args.site, geometry=args.geometry, workers=args.workers):
+        sys.exit(1)
+
+def main_benchmark(args):
+    if not run_benchmark(sites=args.site, frames=args.frames, workers=args.workers,
+                         repeat=args.repeat, path=args.path, fjson=args.json, headers=args.headers):
+        sys.exit(1)
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='pilatus3-fc', description='Convert Pilatus3 Data to Bruker Format, {}'.format(_REVISION))
+    parser.add_argument('--log-level', default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), help='logging level, DEBUG traces every step including its duration (default: WARNING)')
+    subparsers = parser.add_subparsers(dest='command')
+    # headless conversion
+    p_convert = subparsers.add_parser('convert', help='convert all frames in a directory without the GUI')
+    p_convert.add_argument('input', help='input directory containing the frames')
+    p_convert.add_argument('output', help='output directory, non-existing paths will be created recursively')
+    p_convert.add_argument('--site', required=True, choices=SITES, help='facility the data was collected at')
+    p_convert.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of cores)')
+    p_convert.add_argument('--chunksize', type=int, default=16, help='number of frames written per batch (default: 16)')
+    p_convert.add_argument('--io-threads', type=int, default=4, help='number of threads reading the frames (default: 4)')
+    p_convert.add_argument('--inflight', type=int, default=None, help='maximum number of frames held in memory (default: 4 x workers)')
+    g_convert = p_convert.add_mutually_exclusive_group()
+    g_convert.add_argument('--skip-existing', action='store_true', help='do not overwrite existing files in the output directory')
+    g_convert.add_argument('--resume', action='store_true', help='only convert frames that are missing, truncated or stale according to the manifest of the output directory')
+    p_convert.add_argument('--verify', action='store_true', help='compare every converted frame with its source, failed frames are not recorded in the manifest')
+    p_convert.add_argument('--profile', action='store_true', help='time the stages of every frame and print a summary')
+    p_convert.add_argument('--trace', default=None, help='save the stage timings to this file (Chrome trace format), implies --profile')
+    p_convert.add_argument('--hdf5', action='store_true', help='write one HDF5 stack per run instead of .sfrm files (needs h5py), see export')
+    p_convert.set_defaults(func=main_convert)
+    # .sfrm from HDF5 stacks
+    p_export = subparsers.add_parser('export', help='write the .sfrm files of HDF5 run stacks')
+    p_export.add_argument('stacks', nargs='+', help='HDF5 run stacks (some_name_rr.h5)')
+    p_export.add_argument('output', help='output directory, non-existing paths will be created recursively')
+    p_export.add_argument('--frames', nargs='+', default=None, help='frame numbers to export, e.g. 1 5-10 (default: all)')
+    p_export.add_argument('--overwrite', action='store_true', help='overwrite existing .sfrm files (default: only write missing files)')
+    p_export.set_defaults(func=main_export)
+    # headless verification
+    p_verify = subparsers.add_parser('verify', help='compare the converted frames with their source frames')
+    p_verify.add_argument('input', help='input directory containing the frames')
+    p_verify.add_argument('output', help='output directory containing the converted frames')
+    p_verify.add_argument('--site', required=True, choices=SITES, help='facility the data was collected at')
+    p_verify.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of cores)')
+    p_verify.add_argument('--chunksize', type=int, default=16, help='number of frames submitted per task (default: 16)')
+    p_verify.set_defaults(func=main_verify)
+    # headless conversion during data collection
+    p_watch = subparsers.add_parser('watch', help='convert new frames while they are written')
+    p_watch.add_argument('input', help='input directory the detector writes to')
+    p_watch.add_argument('output', help='output directory, non-existing paths will be created recursively')
+    p_watch.add_argument('--site', required=True, choices=SITES, help='facility the data was collected at')
+    p_watch.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of cores)')
+    p_watch.add_argument('--chunksize', type=int, default=16, help='maximum number of frames submitted per task (default: 16)')
+    p_watch.add_argument('--skip-existing', action='store_true', help='do not overwrite existing files in the output directory')
+    p_watch.add_argument('--interval', type=float, default=0.5, help='directory polling interval in seconds (default: 0.5)')
+    p_watch.add_argument('--settle', type=float, default=1.0, help='seconds size and mtime of a frame must be stable, if inotify is not available (default: 1.0)')
+    p_watch.add_argument('--idle', type=float, default=None, help='stop after this many seconds without new frames (default: run until Ctrl+C)')
+    p_watch.set_defaults(func=main_watch)
+    # headless beamstop masks
+    p_mask = subparsers.add_parser('mask', help='write the beamstop masks of all runs from a geometry file')
+    p_mask.add_argument('input', help='input directory containing the frames')
+    p_mask.add_argument('output', help='output directory, non-existing paths will be created recursively')
+    p_mask.add_argument('--site', required=True, choices=SITES, help='facility the data was collected at')
+    p_mask.add_argument('--geometry', default=None, help='beamstop geometry file (default: {} in the output directory)'.format(MASK_GEOMETRY_NAME))
+    p_mask.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of cores)')
+    p_mask.set_defaults(func=main_mask)
+    # conversion benchmark
+    p_bench = subparsers.add_parser('benchmark', help='benchmark the conversion on synthetic frames')
+    p_bench.add_argument('--site', nargs='+', default=list(SITES), choices=SITES, help='facilities to benchmark (default: all)')
+    p_bench.add_argument('--frames', type=int, default=20, help='number of synthetic frames per facility (default: 20)')
+    p_bench.add_argument('--workers', type=int, default=None, help='maximum number of worker processes, timed with 1, 2, 4, ... workers (default: number of cores)')
+    p_bench.add_argument('--repeat', type=int, default=5, help='number of single frame conversions timed per stage (default: 5)')
+    p_bench.add_argument('--path', default=None, help='directory the synthetic frames are written to and kept (default: temporary directory)')
+    p_bench.add_argument('--headers', type=int, default=10000, help='number of frames of the run the Bruker headers are timed for (default: 10000)')
+    p_bench.add_argument('--json', default='pilatus3-fc_benchmark.json', help='file the results are saved to (default: pilatus3-fc_benchmark.json)')
+    p_bench.set_defaults(func=main_benchmark)
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    args = parse_args()
     # create logger
-    logging.basicConfig(level=logging.INFO, style='{', format='{message:>20s} > {funcName}')
-    main()
+    # - named loggers per subsystem: pilatus3-fc.gui/.viewer/.batch/.watch/.index
+    # - messages are 'event key=value ...', durations in 'duration_ms'
+    logging.basicConfig(level=getattr(logging, args.log_level), style='{',
+                        format='{asctime} {levelname:<7} {name:<19} {funcName}: {message}')
+    if args.command is None:
+        main()
+    else:
+        args.func(args)